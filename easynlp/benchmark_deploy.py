@@ -0,0 +1,285 @@
+from header import *
+from config import *
+from dataloader import *
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import http.client
+import subprocess
+import threading
+import test_api
+
+'''
+reproducible latency/throughput benchmark of the /recall, /rerank and /pipeline apis:
+1. the requests are replayed from the load_*_data generators of test_api.py with the fixed random seed;
+2. inprocess mode sends the requests to the flask handlers by the test client, http mode sends them to the deployed service;
+3. the requests are sent by `concurrency` workers; if rate > 0, the requests arrive at the fixed rate (open-loop)
+   and the latency is measured from the scheduled arrival time, so the queueing time is counted;
+4. p50/p95/p99 latency, throughput and the per-stage (core/recall/rerank/overhead) breakdown are saved into the json file
+   with the commit id, and compared with the baseline json file if --baseline is set;
+5. --synthetic serves the cpu-only stand-ins (config/synthetic.yaml): tiny randomly initialized bert and the faiss index of random vectors
+'''
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(description='deploy benchmark parameters')
+    parser.add_argument('--mode', type=str, default='inprocess', help='inprocess or http')
+    parser.add_argument('--apis', type=str, default='recall,rerank,pipeline')
+    parser.add_argument('--dataset', type=str, default='restoration-200k')
+    parser.add_argument('--size', type=int, default=200, help='number of the requests for each api')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--block_size', type=int, default=4, help='maximum number of the segments in one request')
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0., help='requests per second, 0 means closed-loop')
+    parser.add_argument('--url', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=23331)
+    parser.add_argument('--timeout', type=float, default=60.)
+    parser.add_argument('--synthetic', action='store_true', dest='synthetic')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch cpu threads, 0 means the default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--baseline', type=str, default=None, help='json file of the previous benchmark to compare with')
+    return vars(parser.parse_args())
+
+
+def get_commit_id():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def load_synthetic_deploy_args(args):
+    '''deploy configuration of the cpu-only stand-ins, only /recall, /rerank and /pipeline are activated'''
+    with open('config/synthetic.yaml') as f:
+        synthetic = yaml.load(f, Loader=yaml.FullLoader)
+
+    def load(**kwargs):
+        config = load_base_config()
+        config.update(config['deploy'])
+        config.update(synthetic)
+        config.update(kwargs)
+        config['dataset'] = args['dataset']
+        config['lang'] = config['datasets'][args['dataset']]
+        config['tokenizer'] = config['tokenizer'][config['lang']]
+        config['pretrained_model'] = config['pretrained_model'][config['lang']]
+        config['mode'] = 'test'
+        return config
+
+    recall_args = load(activate=True, model='synthetic', topk=args['topk'], with_source=False)
+    rerank_args = load(activate=True, model='synthetic')
+    deploy_args = {
+        'recall': recall_args,
+        'rerank': rerank_args,
+        'pipeline': {
+            'activate': True,
+            'root_dir': recall_args['root_dir'],
+            'dataset': args['dataset'],
+            'logging': recall_args['logging'],
+            'recall': recall_args,
+            'rerank': rerank_args,
+        },
+    }
+    for api_name in ['generation', 'generation_dialog', 'pipeline_evaluation', 'evaluation']:
+        deploy_args[api_name] = {'activate': False}
+    # log folders of the stand-in agents
+    for folder in ['synthetic', 'pipeline']:
+        os.makedirs(f'{recall_args["root_dir"]}/log/{args["dataset"]}/{folder}', exist_ok=True)
+    return deploy_args
+
+
+def load_app(args):
+    # deploy.py is shadowed by the deploy package, load it by its path
+    spec = importlib.util.spec_from_file_location('deploy_app', 'deploy.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    deploy_args = load_synthetic_deploy_args(args) if args['synthetic'] else None
+    return module.create_app(deploy_args=deploy_args)
+
+
+def load_benchmark_data(args, api_name):
+    '''replay the load_*_data generators of test_api.py'''
+    test_api.args = args
+    random.seed(args['seed'])
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/test.txt'
+    size = args['size'] + args['warmup']
+    if api_name == 'recall':
+        data = test_api.load_fake_recall_data(path, size=size)
+    elif api_name == 'rerank':
+        data = test_api.load_fake_partial_rerank_data(path, size=size)
+    elif api_name == 'pipeline':
+        data = test_api.load_pipeline_data(path, size=size)
+    else:
+        raise Exception(f'[!] Unknown api: {api_name}')
+    random.seed(args['seed'])
+    random.shuffle(data)
+    return data[:size]
+
+
+class InProcessClient:
+
+    '''send the requests to the flask handlers without the network, one test client for each worker thread'''
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def send(self, method, data):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        rest = self.local.client.post(method, data=data, content_type='application/json')
+        return json.loads(rest.data)
+
+
+class HTTPClient:
+
+    def __init__(self, url, port, timeout=60.):
+        self.url, self.port, self.timeout = url, port, timeout
+
+    def send(self, method, data):
+        connection = http.client.HTTPConnection(self.url, self.port, timeout=self.timeout)
+        try:
+            connection.request('POST', method, data, {'Content-type': 'application/json'})
+            rest = connection.getresponse().read()
+        finally:
+            connection.close()
+        return json.loads(rest)
+
+
+def parse_stages(api_name, header):
+    '''per-stage time cost (ms) in the response header'''
+    stages = {'core': header.get('core_time_cost_ms', 0.)}
+    if api_name == 'pipeline':
+        stages['recall'] = 1000 * header.get('recall_core_time', 0.)
+        stages['rerank'] = 1000 * header.get('rerank_core_time', 0.)
+        for name, value in header.get('stage_core_time', {}).items():
+            stages[f'stage_{name}'] = 1000 * value
+    return stages
+
+
+def replay(client, api_name, data, concurrency, rate):
+    records = [None] * len(data)
+    payloads = [json.dumps(item) for item in data]
+    begin = time.perf_counter()
+
+    def worker(idx):
+        scheduled = begin + idx / rate if rate > 0 else time.perf_counter()
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            rest = client.send(f'/{api_name}', payloads[idx])
+            succ = rest['header']['ret_code'] == 'succ'
+        except Exception as error:
+            print(f'[!] ERROR happens in request {idx}: {error}')
+            rest, succ = None, False
+        latency = 1000 * (time.perf_counter() - scheduled)
+        records[idx] = {
+            'succ': succ,
+            'latency': latency,
+            'segments': len(data[idx]['segment_list']),
+            'stages': parse_stages(api_name, rest['header']) if succ else {},
+        }
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(tqdm(executor.map(worker, range(len(data))), total=len(data), desc=f'[!] /{api_name}'))
+    duration = time.perf_counter() - begin
+    return records, duration
+
+
+def summarize(values):
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'mean': round(float(values.mean()), 3),
+        'p50': round(float(p50), 3),
+        'p95': round(float(p95), 3),
+        'p99': round(float(p99), 3),
+        'max': round(float(values.max()), 3),
+    }
+
+
+def summarize_records(records, duration):
+    succ_records = [r for r in records if r['succ']]
+    latency = [r['latency'] for r in succ_records]
+    stages = {}
+    for r in succ_records:
+        for name, value in r['stages'].items():
+            stages.setdefault(name, []).append(value)
+        # time cost out of the agent: queueing, (de)serialization, flask and the network
+        stages.setdefault('overhead', []).append(r['latency'] - r['stages']['core'])
+    return {
+        'requests': len(records),
+        'fail': len(records) - len(succ_records),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(succ_records) / duration, 3),
+        'throughput_segments_ps': round(sum(r['segments'] for r in succ_records) / duration, 3),
+        'latency_ms': summarize(latency),
+        'stages_ms': {name: summarize(values) for name, values in stages.items()},
+    }
+
+
+def compare_with_baseline(results, path):
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f'[!] compare with the baseline {path} (commit {baseline["meta"]["commit"]})')
+    for api_name, result in results['results'].items():
+        if api_name not in baseline['results'] or result['latency_ms'] is None or baseline['results'][api_name]['latency_ms'] is None:
+            continue
+        old = baseline['results'][api_name]
+        for name in ['p50', 'p95', 'p99']:
+            a, b = old['latency_ms'][name], result['latency_ms'][name]
+            print(f'[!] /{api_name} {name}: {a} ms -> {b} ms ({round(100 * (b - a) / max(a, 1e-6), 2)}%)')
+        a, b = old['throughput_rps'], result['throughput_rps']
+        print(f'[!] /{api_name} throughput: {a} -> {b} requests/s ({round(100 * (b - a) / max(a, 1e-6), 2)}%)')
+
+
+def main(args):
+    if args['mode'] == 'inprocess':
+        client = InProcessClient(load_app(args))
+    elif args['mode'] == 'http':
+        client = HTTPClient(args['url'], args['port'], timeout=args['timeout'])
+    else:
+        raise Exception(f'[!] Unknown mode: {args["mode"]}')
+
+    results = {
+        'meta': {
+            'commit': get_commit_id(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'torch_threads': torch.get_num_threads(),
+            'cuda': torch.cuda.is_available(),
+            **{key: args[key] for key in ['mode', 'apis', 'dataset', 'size', 'warmup', 'block_size', 'topk', 'concurrency', 'rate', 'synthetic', 'seed']},
+        },
+        'results': {},
+    }
+    for api_name in args['apis'].split(','):
+        data = load_benchmark_data(args, api_name)
+        warmup, data = data[:args['warmup']], data[args['warmup']:]
+        for item in warmup:
+            client.send(f'/{api_name}', json.dumps(item))
+        records, duration = replay(client, api_name, data, args['concurrency'], args['rate'])
+        result = summarize_records(records, duration)
+        results['results'][api_name] = result
+        print(f'[!] /{api_name}: {result["throughput_rps"]} requests/s; latency (ms): {result["latency_ms"]}; fail: {result["fail"]}')
+
+    with open(args['output'], 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    print(f'[!] save the benchmark results into {args["output"]}')
+    if args['baseline']:
+        compare_with_baseline(results, args['baseline'])
+
+
+if __name__ == '__main__':
+    args = parser_args()
+    args['root_dir'] = load_base_config()['root_dir']
+    if args['num_threads'] > 0:
+        torch.set_num_threads(args['num_threads'])
+    if args['output'] is None:
+        commit = get_commit_id()
+        commit = commit[:8] if commit else 'unknown'
+        args['output'] = f'{args["root_dir"]}/log/{args["dataset"]}/benchmark_deploy_{args["mode"]}_{commit}.json'
+    random.seed(args['seed'])
+    torch.manual_seed(args['seed'])
+    main(args)
@@ -50,6 +50,9 @@ def load_deploy_config(api_name):
         # load deploy parameters from base config
         args.update(args['deploy'])
         args.update(args['deploy'][api_name])
+        if api_name == 'recall':
+            # the other datasets (indexes) served by the same recall agent
+            args['tenants'] = [load_deploy_stage_config(tenant, api_name='recall') for tenant in args.get('tenants') or []]
         model = args['model']
 
         if model in [None, 'bm25', 'full']:
@@ -81,6 +84,8 @@ def load_deploy_config(api_name):
 
         args['rerank'] = rerank_args
         args['recall'] = recall_args
+        # the optional cascade of the scorers after the recall
+        args['cascade'] = [load_deploy_stage_config(stage) for stage in args.get('cascade') or []]
         return args
     elif api_name in ['evaluation']:
         args.update(args['deploy'])
@@ -102,3 +107,31 @@ def load_deploy_config(api_name):
         return args
     else:
         raise Exception(f'[!] Unknow deploy mode: {api_name}')
+
+def load_deploy_stage_config(stage, api_name='rerank'):
+    '''stage: {model, topk, budget_ms, ...} of the pipeline cascade (rerank), or {dataset, ...} of the recall tenant (recall),
+    the parameters of the stage rewrite the deploy parameters of the api and the model config'''
+    args = load_base_config()
+    args.update(args['deploy'])
+    args.update(args['deploy'][api_name])
+    args.update(stage)
+    if api_name == 'recall':
+        args['tenants'] = []
+    model = args['model']
+    if model in [None, 'bm25', 'full']:
+        return args
+
+    config_path = f'config/{model}.yaml'
+    with open(config_path) as f:
+        configuration = yaml.load(f, Loader=yaml.FullLoader)
+    print(f'[!] load configuration: {config_path}')
+    args.update(configuration)
+    args.update(stage)
+
+    # load by lang
+    args['lang'] = args['datasets'][args['dataset']]
+    args['tokenizer'] = args['tokenizer'][args['lang']]
+    args['pretrained_model'] = args['pretrained_model'][args['lang']]
+
+    args['mode'] = 'test'
+    return args
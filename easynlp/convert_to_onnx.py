@@ -0,0 +1,118 @@
+from header import *
+from config import *
+from model import *
+from dataloader import *
+
+'''
+export the context and candidate encoders of the dual-encoder (get_ctx/get_cand) into onnx models,
+quantize them into int8, and check the parity of the scores and the latency of the backends on the test set:
+1. parity: cosine of the embeddings, max absolute error of the context-candidate scores,
+   and top-1 agreement and R@1 of the score matrix, compared with the torch backend;
+2. latency: p50/p95 ms per batch of the encode_queries and the encode_candidates.
+The report is saved into rest/<dataset>/<model>/onnx_parity_<pretrained_model>_<version>.json
+'''
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(description='onnx export parameters')
+    parser.add_argument('--dataset', default='restoration-200k', type=str)
+    parser.add_argument('--model', default='dual-bert', type=str)
+    parser.add_argument('--quantize', action='store_true', dest='quantize')
+    parser.add_argument('--no-quantize', action='store_false', dest='quantize')
+    parser.add_argument('--parity_size', type=int, default=512, help='number of the test sessions for the parity check')
+    parser.add_argument('--bsz', type=int, default=32)
+    parser.add_argument('--num_threads', type=int, default=0, help='cpu threads of the torch and onnx runtime, 0 means the default')
+    parser.set_defaults(quantize=True)
+    return vars(parser.parse_args())
+
+
+def load_parity_data(args):
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/test.txt'
+    data = read_text_data_utterances(path, lang=args['lang'])
+    # the ground-truth of each session
+    data = [utterances for label, utterances in data if label == 1][:args['parity_size']]
+    contexts = [utterances[:-1] for utterances in data]
+    responses = [utterances[-1] for utterances in data]
+    return contexts, responses
+
+
+def encode(func, texts, bsz):
+    vectors, times = [], []
+    for idx in range(0, len(texts), bsz):
+        bt = time.perf_counter()
+        vectors.append(func(texts[idx:idx+bsz]))
+        times.append(1000 * (time.perf_counter() - bt))
+    return np.concatenate(vectors).astype(np.float32), times
+
+
+def latency(times):
+    p50, p95 = np.percentile(times, [50, 95])
+    return {'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'mean_ms': round(float(np.mean(times)), 2)}
+
+
+def parity(ctx, cand, ref_ctx, ref_cand):
+    scores, ref_scores = ctx @ cand.T, ref_ctx @ ref_cand.T    # [N, N]
+    cosine = (ctx * ref_ctx).sum(axis=-1) / (np.linalg.norm(ctx, axis=-1) * np.linalg.norm(ref_ctx, axis=-1) + 1e-8)
+    labels = np.arange(len(scores))
+    return {
+        'ctx_cosine_min': round(float(cosine.min()), 6),
+        'ctx_cosine_mean': round(float(cosine.mean()), 6),
+        'score_max_abs_error': round(float(np.abs(scores - ref_scores).max()), 6),
+        'top1_agreement': round(float((scores.argmax(axis=-1) == ref_scores.argmax(axis=-1)).mean()), 4),
+        'R@1': round(float((scores.argmax(axis=-1) == labels).mean()), 4),
+    }
+
+
+def main(**args):
+    args['mode'] = 'test'
+    config = load_config(args)
+    args.update(config)
+    if args['num_threads'] > 0:
+        torch.set_num_threads(args['num_threads'])
+
+    agent = load_model(args)
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    save_path = f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt'
+    agent.load_model(save_path)
+    agent.model.eval()
+    paths = agent.export_onnx(quantize=args['quantize'], max_len=args['res_max_len'])
+
+    contexts, responses = load_parity_data(args)
+    print(f'[!] check the parity and the latency on {len(contexts)} test sessions')
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ref_ctx, ctx_times = encode(agent.encode_queries, contexts, args['bsz'])
+    ref_cand, cand_times = encode(agent.encode_candidates, responses, args['bsz'])
+    report = {
+        'paths': paths,
+        'backends': {
+            f'torch-{device}': {
+                'encode_queries': latency(ctx_times),
+                'encode_candidates': latency(cand_times),
+                'parity': parity(ref_ctx, ref_cand, ref_ctx, ref_cand),
+            }
+        }
+    }
+    backends = [('onnx', False)] + ([('onnx-int8', True)] if args['quantize'] else [])
+    for name, quantize in backends:
+        agent.load_onnx_backend(quantize=quantize, num_threads=args['num_threads'], candidate=True)
+        ctx, ctx_times = encode(agent.encode_queries, contexts, args['bsz'])
+        cand, cand_times = encode(agent.encode_candidates, responses, args['bsz'])
+        report['backends'][name] = {
+            'encode_queries': latency(ctx_times),
+            'encode_candidates': latency(cand_times),
+            'parity': parity(ctx, cand, ref_ctx, ref_cand),
+        }
+    agent.onnx_ctx_encoder, agent.onnx_cand_encoder = None, None
+
+    for name, rest in report['backends'].items():
+        print(f'[!] {name}: encode_queries {rest["encode_queries"]}; encode_candidates {rest["encode_candidates"]}')
+        print(f'[!] {name}: parity {rest["parity"]}')
+    path = f'{args["root_dir"]}/rest/{args["dataset"]}/{args["model"]}/onnx_parity_{pretrained_model_name}_{args["version"]}.json'
+    with open(path, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(f'[!] save the parity and latency report into {path}')
+
+
+if __name__ == "__main__":
+    args = parser_args()
+    main(**args)
@@ -5245,6 +5245,149 @@ class BERTDualBM25SCMLiteDataset(Dataset):
             }
             
             
+class BERTDualANCEDataset(Dataset):
+
+    '''the hard negatives of the train set are refreshed by the HardNegativeRefresher (model/utils/hn_refresh.py) during training,
+    the random negatives of the corpus are used before the first refresh is published'''
+
+    def __init__(self, vocab, path, **args):
+        self.args = args
+        self.vocab = vocab
+        self.vocab.add_tokens(['[EOS]'])
+        self.pad = self.vocab.convert_tokens_to_ids('[PAD]')
+        self.sep = self.vocab.convert_tokens_to_ids('[SEP]')
+        self.eos = self.vocab.convert_tokens_to_ids('[EOS]')
+        self.cls = self.vocab.convert_tokens_to_ids('[CLS]')
+        self.gray_cand_num = args['gray_cand_num']
+        # [N, ance_topk] corpus indexes, swapped by the reference in update_hard_negatives
+        self.hard_negatives = None
+
+        self.data = []
+        if self.args['mode'] == 'train':
+            suffix = args['tokenizer'].replace('/', '_')
+            self.pp_path = f'{os.path.splitext(path)[0]}_dual_ance_{suffix}.pt'
+            if os.path.exists(self.pp_path):
+                self.data, self.corpus = torch.load(self.pp_path)
+                print(f'[!] load preprocessed file from {self.pp_path}')
+                return None
+            data = read_text_data_utterances(path, lang=self.args['lang'])
+            # the corpus of the negatives is all the responses of the train set
+            responses = sorted(set([utterances[-1] for _, utterances in data]))
+            response_index = {res: idx for idx, res in enumerate(responses)}
+            self.corpus = []
+            for idx in tqdm(range(0, len(responses), 1024)):
+                rids = self.vocab.batch_encode_plus(responses[idx:idx+1024], add_special_tokens=False)['input_ids']
+                self.corpus.extend([[self.cls] + i[:(self.args['res_max_len']-2)] + [self.sep] for i in rids])
+            for label, utterances in tqdm(data):
+                if label == 0:
+                    continue
+                item = self.vocab.batch_encode_plus(utterances[:-1], add_special_tokens=False)['input_ids']
+                ids = []
+                for u in item:
+                    ids.extend(u + [self.sep])
+                ids.pop()
+                ids = ids[-(self.args['max_len']-2):]    # ignore [CLS] and [SEP]
+                ids = [self.cls] + ids + [self.sep]
+                self.data.append({
+                    'ids': ids,
+                    'pos': response_index[utterances[-1]],
+                })
+            torch.save((self.data, self.corpus), self.pp_path)
+            print(f'[!] save preprocessed file into {self.pp_path}')
+        else:
+            data = read_text_data_utterances(path, lang=self.args['lang'])
+            if args['dataset'] in ['ubuntu'] and args['mode'] == 'valid':
+                data = data[:10000]    # 1000 sampels for ubuntu
+            for i in tqdm(range(0, len(data), 10)):
+                batch = data[i:i+10]
+                rids = []
+                gt_text = []
+                for label, utterances in batch:
+                    item = self.vocab.batch_encode_plus(utterances, add_special_tokens=False)['input_ids']
+                    cids, rids_ = item[:-1], item[-1]
+                    ids = []
+                    for u in cids:
+                        ids.extend(u + [self.sep])
+                    ids.pop()
+                    ids = ids[-(self.args['max_len']-2):]    # ignore [CLS] and [SEP]
+                    rids_ = rids_[:(self.args['res_max_len']-2)]
+                    ids = [self.cls] + ids + [self.sep]
+                    rids_ = [self.cls] + rids_ + [self.sep]
+                    rids.append(rids_)
+                    if label == 1:
+                        gt_text.append(utterances[-1])
+                self.data.append({
+                    'label': [b[0] for b in batch],
+                    'ids': ids,
+                    'rids': rids,
+                    'text': gt_text,
+                })    
+        print(f'[!] dataset size: {len(self.data)}')
+
+    def update_hard_negatives(self, negatives):
+        self.hard_negatives = negatives
+
+    def sample_negatives(self, i, pos):
+        negatives = self.hard_negatives
+        cands = [] if negatives is None else [j for j in negatives[i].tolist() if j != -1]
+        if len(cands) >= self.gray_cand_num:
+            return random.sample(cands, self.gray_cand_num)
+        # random negatives of the corpus fill the rest
+        while len(cands) < self.gray_cand_num:
+            j = random.randrange(len(self.corpus))
+            if j != pos and j not in cands:
+                cands.append(j)
+        return cands
+                
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        bundle = self.data[i]
+        if self.args['mode'] == 'train':
+            cands = self.sample_negatives(i, bundle['pos'])
+            ids = torch.LongTensor(bundle['ids'])
+            rids = [torch.LongTensor(self.corpus[j]) for j in [bundle['pos']] + cands]
+            return ids, rids
+        else:
+            ids = torch.LongTensor(bundle['ids'])
+            rids = [torch.LongTensor(i) for i in bundle['rids']]
+            return ids, rids, bundle['label'], bundle['text']
+
+    def collate(self, batch):
+        if self.args['mode'] == 'train':
+            ids = [i[0] for i in batch]
+            rids = []
+            for i in batch:
+                rids.extend(i[1])
+            ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
+            rids = pad_sequence(rids, batch_first=True, padding_value=self.pad)
+            ids_mask = generate_mask(ids)
+            rids_mask = generate_mask(rids)
+            ids, rids, ids_mask, rids_mask = to_cuda(ids, rids, ids_mask, rids_mask)
+            return {
+                'ids': ids, 
+                'rids': rids,
+                'ids_mask': ids_mask, 
+                'rids_mask': rids_mask,
+            }
+        else:
+            # batch size is batch_size * 10
+            assert len(batch) == 1
+            ids, rids, label, text = batch[0]
+            rids = pad_sequence(rids, batch_first=True, padding_value=self.pad)
+            rids_mask = generate_mask(rids)
+            label = torch.LongTensor(label)
+            ids, rids, rids_mask, label = to_cuda(ids, rids, rids_mask, label)
+            return {
+                'ids': ids, 
+                'rids': rids, 
+                'rids_mask': rids_mask, 
+                'label': label,
+                'text': text
+            }
+
+
 class BERTDualFullCorruptSCMDataset(Dataset):
 
     def __init__(self, vocab, path, **args):
@@ -0,0 +1,81 @@
+from header import *
+import shutil
+
+'''flat storage of the post-train datasets (the directory <train>_post_train_*_flat):
+1. tokens.npy: int32 token ids of all the utterances; offsets.npy: int64, the utterance i is tokens[offsets[i]:offsets[i+1]];
+2. table.npy: int64 [S, 3] sessions (begin, end, max-length) over the utterance indexes;
+3. the arrays are loaded by the memory mapping, all the ranks share the os page cache instead of
+   unpickling their own lists, and only the utterances of the sample are converted into the lists'''
+
+
+class FlatUtterances:
+
+    '''the list-like utterances over the flat token and offset arrays, the slice returns the list of utterances'''
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            begin, end, step = i.indices(len(self))
+            assert step == 1, f'[!] the step of the slice must be 1'
+            if begin >= end:
+                return []
+            tokens = self.tokens[self.offsets[begin]:self.offsets[end]].tolist()
+            bounds = (self.offsets[begin:end+1] - self.offsets[begin]).tolist()
+            return [tokens[b:e] for b, e in zip(bounds[:-1], bounds[1:])]
+        if i < 0:
+            i += len(self)
+        return self.tokens[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    @classmethod
+    def from_lists(cls, data):
+        lengths = np.fromiter((len(u) for u in data), dtype=np.int64, count=len(data))
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter(chain.from_iterable(data), dtype=np.int32, count=int(offsets[-1]))
+        return cls(tokens, offsets)
+
+
+def flat_table(table):
+    return np.array(table, dtype=np.int64).reshape(-1, 3)
+
+
+def save_flat_dataset(path, data, table):
+    '''the arrays are written into the temporary directory, which is renamed as path at last,
+    so the incomplete files are never loaded and the rank that saves the dataset first wins'''
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(f'{tmp_path}/tokens.npy', data.tokens)
+    np.save(f'{tmp_path}/offsets.npy', data.offsets)
+    np.save(f'{tmp_path}/table.npy', table)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # saved by the other rank
+        shutil.rmtree(tmp_path)
+
+
+def load_flat_dataset(path):
+    tokens = np.load(f'{path}/tokens.npy', mmap_mode='r')
+    offsets = np.load(f'{path}/offsets.npy', mmap_mode='r')
+    table = np.load(f'{path}/table.npy', mmap_mode='r')
+    return FlatUtterances(tokens, offsets), table
+
+
+def load_flat_cache(path, legacy_path=None):
+    '''the flat dataset of path, or the one converted from the legacy preprocessed file (torch.save of the lists),
+    None if neither of them exists'''
+    if os.path.exists(path):
+        data, table = load_flat_dataset(path)
+        print(f'[!] load memory-mapped flat dataset from {path}')
+        return data, table
+    if legacy_path and os.path.exists(legacy_path):
+        data, table = torch.load(legacy_path)
+        print(f'[!] convert the legacy preprocessed file {legacy_path} into the flat dataset')
+        return FlatUtterances.from_lists(data), flat_table(table)
+    return None
@@ -2,6 +2,7 @@ from header import *
 from .utils import *
 from .util_func import *
 from .randomaccess import *
+import bisect
 
 
 class GPT2ForContrastiveForBigDataset(Dataset):
@@ -237,3 +238,98 @@ class GPT2ForContrastiveCommonCrawlForBigDataset(Dataset):
         return {'ids': ids, 'ods': ods, 'ids_mask': ids_mask}
 
 
+
+
+class GPT2PretokenizedShardDataset(Dataset):
+
+    '''random windows of max_len tokens over the binary token shards of pretokenize.py (memory-mapped):
+    1. the shards are cut into the windows of max_len tokens after the random shift of each epoch,
+       and the windows are visited in the order of the random affine permutation of each epoch (seed + epoch);
+    2. the n-th sample of the rank is the global sample n * world_size + rank, so the ranks read the disjoint windows,
+       and the samples are only decided by the number of the consumed samples, which is resumed by set_step;
+    3. the index of __getitem__ is ignored in train mode (DistributedSampler only counts the samples)'''
+
+    def __init__(self, vocab, path, **args):
+        self.args = args
+        self.vocab = vocab
+        self.pad = self.vocab.pad_token_id
+        self.max_len = args['max_len']
+        self.path = args['pretokenized_path'] if args.get('pretokenized_path') else f'{args["root_dir"]}/data/{args["dataset"]}/pretokenized/{"train" if args["mode"] == "train" else "test"}'
+        with open(f'{self.path}/index.json') as f:
+            self.index = json.load(f)
+        self.shards = [
+            np.memmap(f'{self.path}/{shard["path"]}', dtype=self.index['dtype'], mode='r', shape=(shard['tokens'],))
+            for shard in self.index['shards']
+        ]
+        self.epoch_cache = {}
+
+        if self.args['mode'] == 'train':
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+            self.counter = 0
+            # each epoch visits the same number of the windows, which are available under any shift
+            self.epoch_size = self.num_windows(shift=self.max_len - 1)
+            if self.epoch_size == 0:
+                raise Exception(f'[!] the shards of {self.path} have no window of {self.max_len} tokens')
+            # the length only decides the size of the DistributedSampler
+            self.size = min(self.epoch_size, 10000000)
+        else:
+            # the sequential windows without the shift
+            self.windows = np.cumsum([len(shard) // self.max_len for shard in self.shards]).tolist()
+            self.size = min(self.windows[-1], self.args.get('pretokenized_test_size', 10000))
+        print(f'[!] load {self.index["tokens"]} tokens of {len(self.shards)} shards from {self.path}, dataset size: {self.size}')
+
+    def __len__(self):
+        return self.size
+
+    def num_windows(self, shift=0):
+        return sum(max(len(shard) - shift, 0) // self.max_len for shard in self.shards)
+
+    def epoch_windows(self, epoch):
+        '''the cumulative number of the windows of the shards, the shift and the affine permutation of the epoch'''
+        if epoch in self.epoch_cache:
+            return self.epoch_cache[epoch]
+        rng = random.Random(self.args['seed'] * 1000003 + epoch)
+        shift = rng.randrange(self.max_len)
+        windows = np.cumsum([max(len(shard) - shift, 0) // self.max_len for shard in self.shards]).tolist()
+        total = windows[-1]
+        a = rng.randrange(1, total) if total > 1 else 1
+        while math.gcd(a, total) != 1:
+            a += 1
+        b = rng.randrange(total)
+        # the caches of two epochs are enough
+        if len(self.epoch_cache) >= 2:
+            self.epoch_cache.pop(min(self.epoch_cache))
+        self.epoch_cache[epoch] = (windows, shift, a, b)
+        return self.epoch_cache[epoch]
+
+    def set_step(self, step):
+        '''resume from the samples of the rank consumed before the step'''
+        self.counter = step * self.args['batch_size']
+        print(f'[!] rank {self.rank} resumes the pretokenized shards from the sample {self.counter}')
+
+    def window(self, windows, shift, idx):
+        k = bisect.bisect_right(windows, idx)
+        begin = shift + (idx - (windows[k-1] if k > 0 else 0)) * self.max_len
+        return self.shards[k][begin:begin+self.max_len]
+
+    def __getitem__(self, i):
+        if self.args['mode'] == 'train':
+            n = self.counter * self.world_size + self.rank
+            self.counter += 1
+            windows, shift, a, b = self.epoch_windows(n // self.epoch_size)
+            # the first epoch_size positions of the permutation over all the windows of the epoch
+            idx = (a * (n % self.epoch_size) + b) % windows[-1]
+            return self.window(windows, shift, idx)
+        else:
+            return self.window(self.windows, 0, i)
+
+    def save(self):
+        pass
+
+    def collate(self, batch):
+        # all the windows have max_len tokens, no padding
+        ids = torch.from_numpy(np.stack(batch).astype(np.int64))
+        ids_mask = torch.ones_like(ids)
+        ids, ods, ids_mask = ids[:, :-1], ids[:, 1:], ids_mask[:, :-1]
+        ids, ods, ids_mask = to_cuda(ids, ods, ids_mask)
+        return {'ids': ids, 'ods': ods, 'ids_mask': ids_mask}
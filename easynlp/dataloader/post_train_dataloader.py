@@ -2,6 +2,7 @@ from header import *
 from randomaccess import RandomAccessReader
 from .utils import *
 from .util_func import *
+from .flat_dataset import *
 
 
 class PostTrainDataset(Dataset):
@@ -24,10 +25,10 @@ class PostTrainDataset(Dataset):
         self.special_tokens = set([self.pad, self.sep, self.cls, self.unk, self.mask, self.eos])
 
         suffix = args['tokenizer'].replace('/', '_')
-        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_{suffix}.pt'
-        if os.path.exists(self.pp_path):
-            self.data, self.table = torch.load(self.pp_path)
-            print(f'[!] load preprocessed file from {self.pp_path}')
+        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_{suffix}_flat'
+        cache = load_flat_cache(self.pp_path, legacy_path=f'{os.path.splitext(path)[0]}_post_train_{suffix}.pt')
+        if cache is not None:
+            self.data, self.table = cache
             return None
 
         data = read_text_data_utterances(path, lang=self.args['lang'])
@@ -54,12 +55,13 @@ class PostTrainDataset(Dataset):
 
                 if l[i] > 0:
                     self.table.append((offset, offset+i, len(self.data)))
+        self.data, self.table = FlatUtterances.from_lists(self.data), flat_table(self.table)
 
     def __len__(self):
         return len(self.table)
 
     def __getitem__(self, i):
-        begin, end, max_l = self.table[i]
+        begin, end, max_l = self.table[i].tolist()
         session = self.data[begin:end+1]
         tokens = []
         for utterance in session[:-1]:
@@ -102,7 +104,7 @@ class PostTrainDataset(Dataset):
         return ids, tids, mask_labels, label
 
     def save(self):
-        data = torch.save((self.data, self.table), self.pp_path)
+        save_flat_dataset(self.pp_path, self.data, self.table)
         print(f'[!] save preprocessed dataset into {self.pp_path}; size: {len(self.table)}')
         
     def collate(self, batch):
@@ -230,10 +232,10 @@ class PostTrainNoCLSDataset(Dataset):
         self.special_tokens = set([self.pad, self.sep, self.cls, self.unk, self.mask])
 
         suffix = args['tokenizer'].replace('/', '_')
-        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_no_cls_{suffix}.pt'
-        if os.path.exists(self.pp_path):
-            self.data, self.table = torch.load(self.pp_path)
-            print(f'[!] load preprocessed file from {self.pp_path}')
+        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_no_cls_{suffix}_flat'
+        cache = load_flat_cache(self.pp_path, legacy_path=f'{os.path.splitext(path)[0]}_post_train_no_cls_{suffix}.pt')
+        if cache is not None:
+            self.data, self.table = cache
             return None
 
         data = read_text_data_utterances(path, lang=self.args['lang'])
@@ -257,12 +259,13 @@ class PostTrainNoCLSDataset(Dataset):
                 # check if the context and response are legal
                 if sum(l[:i+1]) > self.args['min_token_length'] and l[i] > 0:
                     self.table.append((offset, offset+i, len(self.data)))
+        self.data, self.table = FlatUtterances.from_lists(self.data), flat_table(self.table)
 
     def __len__(self):
         return len(self.table)
 
     def __getitem__(self, i):
-        begin, end, max_l = self.table[i]
+        begin, end, max_l = self.table[i].tolist()
         session = self.data[begin:end+1]
         tokens = []
         for utterance in session[:-1]:
@@ -285,7 +288,7 @@ class PostTrainNoCLSDataset(Dataset):
         return ids, tids, mask_labels
 
     def save(self):
-        data = torch.save((self.data, self.table), self.pp_path)
+        save_flat_dataset(self.pp_path, self.data, self.table)
         print(f'[!] save preprocessed dataset into {self.pp_path}; size: {len(self.table)}')
         
     def collate(self, batch):
@@ -341,10 +344,10 @@ class PostTrainMultiStrategiesDataset(Dataset):
         self.special_tokens = set([self.pad, self.sep, self.cls, self.unk, self.mask, self.eos])
 
         suffix = args['tokenizer'].replace('/', '_')
-        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_multi_strategy_{suffix}.pt'
-        if os.path.exists(self.pp_path):
-            self.data, self.table = torch.load(self.pp_path)
-            print(f'[!] load preprocessed file from {self.pp_path}')
+        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_multi_strategy_{suffix}_flat'
+        cache = load_flat_cache(self.pp_path, legacy_path=f'{os.path.splitext(path)[0]}_post_train_multi_strategy_{suffix}.pt')
+        if cache is not None:
+            self.data, self.table = cache
             return None
 
         data = read_text_data_utterances(path, lang=self.args['lang'])
@@ -372,6 +375,7 @@ class PostTrainMultiStrategiesDataset(Dataset):
                     offset+i, 
                     len(self.data)
                 ))
+        self.data, self.table = FlatUtterances.from_lists(self.data), flat_table(self.table)
 
     def __len__(self):
         return len(self.table)
@@ -533,7 +537,7 @@ class PostTrainMultiStrategiesDataset(Dataset):
         return None, None
 
     def __getitem__(self, i):
-        begin, end, max_l = self.table[i]
+        begin, end, max_l = self.table[i].tolist()
         session = self.data[begin:end+1]
         # avoid the very long utterance
         session = [u[:self.args['res_max_len']-2] for u in session]
@@ -595,7 +599,7 @@ class PostTrainMultiStrategiesDataset(Dataset):
         return ids, tids, mask_labels, label
 
     def save(self):
-        data = torch.save((self.data, self.table), self.pp_path)
+        save_flat_dataset(self.pp_path, self.data, self.table)
         print(f'[!] save preprocessed dataset into {self.pp_path}; size: {len(self.table)}')
         
     def collate(self, batch):
@@ -642,10 +646,10 @@ class PostTrainComparisonDataset(Dataset):
         self.special_tokens = set([self.pad, self.sep, self.cls, self.unk, self.mask, self.eos])
 
         suffix = args['tokenizer'].replace('/', '_')
-        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_compare_{suffix}.pt'
-        if os.path.exists(self.pp_path):
-            self.data, self.table = torch.load(self.pp_path)
-            print(f'[!] load preprocessed file from {self.pp_path}')
+        self.pp_path = f'{os.path.splitext(path)[0]}_post_train_compare_{suffix}_flat'
+        cache = load_flat_cache(self.pp_path, legacy_path=f'{os.path.splitext(path)[0]}_post_train_compare_{suffix}.pt')
+        if cache is not None:
+            self.data, self.table = cache
             return None
 
         data = read_text_data_utterances(path, lang=self.args['lang'])
@@ -672,6 +676,7 @@ class PostTrainComparisonDataset(Dataset):
 
                 if l[i] > 0:
                     self.table.append((offset, offset+i, len(self.data)))
+        self.data, self.table = FlatUtterances.from_lists(self.data), flat_table(self.table)
 
     def __len__(self):
         return len(self.table)
@@ -694,7 +699,7 @@ class PostTrainComparisonDataset(Dataset):
         return ids, tids, sids_, cpids
 
     def __getitem__(self, i):
-        begin, end, max_l = self.table[i]
+        begin, end, max_l = self.table[i].tolist()
         session = self.data[begin:end+1]
         cids, sids, cache = [], [], 0
         for u in session[:-1]:
@@ -738,7 +743,7 @@ class PostTrainComparisonDataset(Dataset):
         return ids, tids, sids, cpids, mask_labels, label
 
     def save(self):
-        data = torch.save((self.data, self.table), self.pp_path)
+        save_flat_dataset(self.pp_path, self.data, self.table)
         print(f'[!] save preprocessed dataset into {self.pp_path}; size: {len(self.table)}')
         
     def collate(self, batch):
@@ -9,46 +9,131 @@ def parser_args():
     parser.add_argument('--base_port', type=int, default=22330)
     return vars(parser.parse_args())
 
-def create_app():
+def create_app(deploy_args=None):
+    '''deploy_args: optional dict of the deploy configuration of each api (benchmark_deploy.py),
+    if it is None, the configurations are loaded from the config/base.yaml'''
     app = Flask(__name__)
 
-    rerank_args = load_deploy_config('rerank')
-    generation_args = load_deploy_config('generation')
-    generation_dialog_args = load_deploy_config('generation_dialog')
-    recall_args = load_deploy_config('recall')
-    pipeline_args = load_deploy_config('pipeline')
-    pipeline_evaluation_args = load_deploy_config('pipeline_evaluation')
-    evaluation_args = load_deploy_config('evaluation')
+    def load_args(api_name):
+        if deploy_args is None:
+            return load_deploy_config(api_name)
+        return deploy_args[api_name]
+
+    rerank_args = load_args('rerank')
+    generation_args = load_args('generation')
+    generation_dialog_args = load_args('generation_dialog')
+    recall_args = load_args('recall')
+    pipeline_args = load_args('pipeline')
+    pipeline_evaluation_args = load_args('pipeline_evaluation')
+    evaluation_args = load_args('evaluation')
+    init_tracing(load_base_config())
+    # the agents that can be reloaded by the admin apis
+    hot_swap_agents = {}
     if rerank_args['activate']:
-        rerankagent = RerankAgent(rerank_args)
+        rerankagent = HotSwapAgent('rerank', RerankAgent, rerank_args)
+        hot_swap_agents['rerank'] = rerankagent
         print(f'[!] Rerank agent activate')
-        rerank_logger = init_logging(rerank_args)
+        rerank_logger = init_logging(rerank_args, 'rerank')
     if generation_dialog_args['activate']:
         generationdialogagent = DeployGenerationDialogAgent(generation_dialog_args)
         print(f'[!] Generation Dialog agent activate')
-        generation_dialog_logger = init_logging(generation_dialog_args)
+        generation_dialog_logger = init_logging(generation_dialog_args, 'generation_dialog')
     if generation_args['activate']:
         generationagent = DeployGenerationAgent(generation_args)
         print(f'[!] Generation agent activate')
-        generation_logger = init_logging(generation_args)
+        generation_logger = init_logging(generation_args, 'generation')
     if recall_args['activate']:
-        recallagent = RecallAgent(recall_args)
+        recallagent = HotSwapAgent('recall', build_recall_agent, recall_args)
+        hot_swap_agents['recall'] = recallagent
         print(f'[!] Recall agent activate')
-        recall_logger = init_logging(recall_args)
+        recall_logger = init_logging(recall_args, 'recall')
     if pipeline_args['activate']:
-        pipelineagent = PipelineAgent(pipeline_args)
+        pipelineagent = HotSwapAgent('pipeline', PipelineAgent, pipeline_args)
+        hot_swap_agents['pipeline'] = pipelineagent
         print(f'[!] Pipeline agent activate')
-        pipeline_logger = init_logging(pipeline_args, pipeline=True)
+        pipeline_logger = init_logging(pipeline_args, 'pipeline', pipeline=True)
     if pipeline_evaluation_args['activate']:
         pipelineevaluationagent = PipelineEvaluationAgent(pipeline_evaluation_args)
         print(f'[!] Pipeline evaluation agent activate')
-        pipeline_evaluation_logger = init_logging(pipeline_evaluation_args, pipeline=True)
+        pipeline_evaluation_logger = init_logging(pipeline_evaluation_args, 'pipeline_evaluation', pipeline=True)
     if evaluation_args['activate']:
         evaluationagent = DeployEvaluationAgent(evaluation_args)
         print(f'[!] Evaluation evaluation agent activate')
-        evaluation_logger = init_logging(evaluation_args)
+        evaluation_logger = init_logging(evaluation_args, 'evaluation')
     
+    @app.route('/admin/status', methods=['GET'])
+    def admin_status_api():
+        '''live and rollback versions, reload state and memory headroom of the agents'''
+        return jsonify({api_name: agent.describe() for api_name, agent in hot_swap_agents.items()})
+
+    @app.route('/admin/reload', methods=['POST'])
+    def admin_reload_api():
+        '''
+        {
+            'api': 'recall',
+            # optional, update the deploy args of the agent, e.g., the checkpoint version or the index type
+            'args': {'version': 1},
+            # optional, reload even if the memory headroom is not enough
+            'force': false,
+        }
+        the new agent is built in the background, the state can be checked by /admin/status
+        '''
+        data = json.loads(request.data)
+        if data['api'] not in hot_swap_agents:
+            return jsonify({'started': False, 'message': f'[!] {data["api"]} is not activated'})
+        rest = hot_swap_agents[data['api']].reload(overrides=data.get('args', {}), force=data.get('force', False))
+        return jsonify(rest)
+
+    @app.route('/admin/rollback', methods=['POST'])
+    def admin_rollback_api():
+        '''{'api': 'recall'}: swap back to the previous agent'''
+        data = json.loads(request.data)
+        if data['api'] not in hot_swap_agents:
+            return jsonify({'succ': False, 'message': f'[!] {data["api"]} is not activated'})
+        return jsonify(hot_swap_agents[data['api']].rollback())
+
+    @app.route('/admin/index', methods=['POST'])
+    def admin_index_api():
+        '''
+        {
+            # recall or pipeline (the updatable index is shared by them)
+            'api': 'recall',
+            # optional, the recall tenant, the default dataset is used if it is missing
+            'dataset': 'douban',
+            'add': ['new candidate1', ...],
+            'delete': ['bad candidate1', ...],
+            'delete_ids': [0, 1, ...],
+            # optional, compact the index and write the snapshot now
+            'compact': false,
+        }
+        '''
+        data = json.loads(request.data)
+        try:
+            api_name = data.get('api', 'recall')
+            with hot_swap_agents[api_name].acquire() as agent:
+                recall = (agent.recallagent if api_name == 'pipeline' else agent).route(data.get('dataset'))
+                result = {
+                    'add_ids': recall.add_candidates(data['add']) if data.get('add') else [],
+                    'delete_ids': recall.delete_candidates(ids=data.get('delete_ids'), texts=data.get('delete')),
+                }
+                if data.get('compact', False):
+                    recall.searcher.compact()
+                result['index'] = recall.searcher.describe()
+            result['ret_code'] = 'succ'
+        except Exception as error:
+            print('ERROR:', error)
+            result = {'ret_code': 'fail', 'message': str(error)}
+        return jsonify(result)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_api():
+        '''histograms of the request and per-stage time cost in the prometheus text format'''
+        response = make_response(METRICS.render())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+
     @app.route('/pipeline_evaluation', methods=['POST'])
+    @traced('pipeline_evaluation')
     def pipeline_evaluation_api():
         '''
         {
@@ -98,6 +183,7 @@ def create_app():
                 'recall_core_time_cost_ms': 1000 * recall_t,
                 'rerank_core_time_cost_ms': 1000 * rerank_t,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         if succ:
@@ -114,11 +200,16 @@ def create_app():
             result['item_list'] = None
 
         # log
-        push_to_log(result, pipeline_evaluation_logger)
+        with trace_span('logging'):
+            push_to_log(result, pipeline_evaluation_logger)
 
-        return jsonify(result)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
     
     @app.route('/pipeline', methods=['POST'])
+    @traced('pipeline')
     def pipeline_api():
         '''
         {
@@ -126,6 +217,8 @@ def create_app():
                 {'str': 'context sentence1', 'status': 'editing'},
                 ...
             ]
+            # optional, the recall tenant (deploy.recall.tenants)
+            'dataset': 'douban',
             'lang': 'zh',
             'uuid': '',
             'user': '',
@@ -149,10 +242,10 @@ def create_app():
         '''
         try:
             data = json.loads(request.data)
-            (responses, recall_t, rerank_t), core_time = pipelineagent.work(data['segment_list'])
+            (responses, recall_t, rerank_t, stage_t, skipped), core_time = pipelineagent.work(data['segment_list'], dataset=data.get('dataset'))
             succ = True
         except Exception as error:
-            core_time = 0
+            core_time, recall_t, rerank_t, stage_t, skipped = 0, 0, 0, {}, []
             print('ERROR:', error)
             succ = False
 
@@ -163,7 +256,10 @@ def create_app():
                 'core_time_cost': core_time,
                 'recall_core_time': recall_t,
                 'rerank_core_time': rerank_t,
+                'stage_core_time': stage_t,
+                'skipped_stages': skipped,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         if succ:
@@ -173,10 +269,15 @@ def create_app():
         else:
             result['item_list'] = None
         # log
-        push_to_log(result, pipeline_logger)
-        return jsonify(result)
+        with trace_span('logging'):
+            push_to_log(result, pipeline_logger)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
 
     @app.route('/rerank', methods=['POST'])
+    @traced('rerank')
     def rerank_api():
         '''
         {
@@ -231,6 +332,7 @@ def create_app():
                 'core_time_cost_ms': 1000 * core_time,
                 'core_time_cost': core_time,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         if succ:
@@ -248,10 +350,15 @@ def create_app():
         else:
             result['item_list'] = None
         # log
-        push_to_log(result, rerank_logger)
-        return jsonify(result)
+        with trace_span('logging'):
+            push_to_log(result, rerank_logger)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
 
     @app.route('/recall', methods=['POST'])
+    @traced('recall')
     def recall_api():
         '''
         {
@@ -261,6 +368,8 @@ def create_app():
             ],
             # topk is optinal, if topk key doesn't exist, default topk will be used (100)
             'topk': 100,
+            # dataset is optional, the recall tenant (deploy.recall.tenants), default dataset will be used
+            'dataset': 'douban',
             'lang': 'zh',
             'uuid': '',
             'user': '',
@@ -294,7 +403,7 @@ def create_app():
         try:
             data = json.loads(request.data)
             topk = data['topk'] if 'topk' in data else None
-            candidates, core_time = recallagent.work(data['segment_list'], topk=topk)
+            candidates, core_time = recallagent.work(data['segment_list'], topk=topk, dataset=data.get('dataset'))
             succ = True
         except Exception as error:
             core_time = 0
@@ -307,20 +416,26 @@ def create_app():
                 'core_time_cost_ms': 1000 * core_time,
                 'core_time_cost': core_time,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         if succ:
             contexts = [i['str'] for i in data['segment_list']]
-            ground_truths = [i['ground_truth'] for i in data['segment_list']]
+            ground_truths = [i.get('ground_truth', None) for i in data['segment_list']]
             rest = [{'context': c, 'candidates': rs, 'ground_truth': g} for g, c, rs in zip(ground_truths, contexts, candidates)]
             result['item_list'] = rest
         else:
             result['item_list'] = None
         # log
-        #push_to_log(result, recall_logger)
-        return jsonify(result)
+        with trace_span('logging'):
+            push_to_log(result, recall_logger)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
 
     @app.route('/evaluation', methods=['POST'])
+    @traced('evaluation')
     def evaluation_api():
         '''
         {
@@ -369,13 +484,19 @@ def create_app():
                 'core_time_cost_ms': 1000 * core_time,
                 'core_time_cost': core_time,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         result['item_list'] = item_list
-        push_to_log(result, evaluation_logger)
-        return jsonify(result)
+        with trace_span('logging'):
+            push_to_log(result, evaluation_logger)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
 
     @app.route('/generation', methods=['POST'])
+    @traced('generation')
     def generation_api():
         '''
         {
@@ -437,6 +558,7 @@ def create_app():
                 'core_time_cost_ms': 1000 * core_time,
                 'core_time_cost': core_time,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         if succ:
@@ -450,10 +572,15 @@ def create_app():
             result['item_list'] = rest_
         else:
             result['item_list'] = None
-        push_to_log(result, generation_logger)
-        return jsonify(result)
+        with trace_span('logging'):
+            push_to_log(result, generation_logger)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
 
     @app.route('/generation_dialog', methods=['POST'])
+    @traced('generation_dialog')
     def generation_dialog_api():
         '''
         {
@@ -500,6 +627,7 @@ def create_app():
                 'core_time_cost_ms': 1000 * core_time,
                 'core_time_cost': core_time,
                 'ret_code': 'succ' if succ else 'fail',
+                'request_id': TRACER.request_id(),
             }, 
         }
         if succ:
@@ -511,8 +639,12 @@ def create_app():
             result['item_list'] = rest_
         else:
             result['item_list'] = None
-        push_to_log(result, generation_dialog_logger)
-        return jsonify(result)
+        with trace_span('logging'):
+            push_to_log(result, generation_dialog_logger)
+        TRACER.annotate(status=result['header']['ret_code'])
+        with trace_span('json_encoding'):
+            response = jsonify(result)
+        return response
 
     return app
 
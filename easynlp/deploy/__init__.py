@@ -6,3 +6,7 @@ from .recall import *
 from .pipeline import *
 from .pipeline_evaluation import *
 from .utils import *
+from .synthetic import *
+from .hot_swap import *
+from .cache import *
+from .tenants import *
@@ -0,0 +1,84 @@
+from header import *
+from inference_utils.utils import remove_duplicate_punctuation
+from .utils import *
+import threading
+
+'''per-query result cache of the recall and pipeline agents (deploy.result_cache in config/base.yaml):
+1. the key is the normalized query with the topk, the model and checkpoint version and the index version (updatable index);
+2. the entries are evicted by the lru order when the memory (estimated by the pickled size) is over max_mb, and expire after ttl seconds;
+3. the cache belongs to the agent, so the hot swap starts with the empty cache'''
+
+
+def normalize_query(query):
+    '''collapse the whitespace and the repeated punctuation, the utterances of the context are joined by [SEP]'''
+    if type(query) == list:
+        query = ' [SEP] '.join(query)
+    query = ' '.join(query.split())
+    return remove_duplicate_punctuation(query)
+
+
+class QueryResultCache:
+
+    def __init__(self, name, max_mb=256, ttl=600):
+        self.name = name
+        self.max_size = int(max_mb * 2 ** 20)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (value, size, expire time)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hit, self.miss = 0, 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] < time.time():
+                self.pop(key)
+                entry = None
+            if entry is None:
+                self.miss += 1
+            else:
+                self.hit += 1
+                self.entries.move_to_end(key)
+        METRICS.inc('easynlp_result_cache_requests_total', {'cache': self.name, 'result': 'miss' if entry is None else 'hit'})
+        return None if entry is None else entry[0]
+
+    def put(self, key, value):
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.pop(key)
+            self.entries[key] = (value, size, time.time() + self.ttl)
+            self.size += size
+            while self.size > self.max_size:
+                self.pop(next(iter(self.entries)))
+                METRICS.inc('easynlp_result_cache_evictions_total', {'cache': self.name})
+
+    def pop(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def describe(self):
+        return {
+            'entries': len(self.entries),
+            'size_mb': round(self.size / 2 ** 20, 3),
+            'hit': self.hit,
+            'miss': self.miss,
+            'hit_ratio': round(self.hit / max(self.hit + self.miss, 1), 4),
+        }
+
+
+def init_result_cache(args, api_name):
+    '''return None if the cache of the api is not activated'''
+    cache_args = args.get('result_cache', {})
+    if not cache_args.get(api_name, False):
+        return None
+    print(f'[!] {api_name} result cache: {cache_args["max_mb"]} MB, ttl {cache_args["ttl"]}s')
+    return QueryResultCache(api_name, max_mb=cache_args['max_mb'], ttl=cache_args['ttl'])
@@ -0,0 +1,72 @@
+from .pipeline import *
+
+'''check of the latency budget of the pipeline cascade (PipelineAgent, StageCostEstimator) with the stand-in agents,
+no model is loaded:
+1. the warmup (hot swap) and the first cold call of the stage are not counted into its latency estimation;
+2. the stage is skipped while its estimated latency exceeds the budget;
+3. the skipped stage is probed after cascade_probe_interval skips, and comes back once its latency drops
+
+    python -m deploy.cascade_check
+'''
+
+
+class StandInRecallAgent:
+
+    def __init__(self, candidate_num=20):
+        self.candidate_num = candidate_num
+
+    @timethis
+    def work(self, batch, topk=None, dataset=None):
+        return [[{'text': f'candidate {i}'} for i in range(self.candidate_num)] for _ in batch]
+
+
+class StandInStageAgent:
+
+    '''rerank stand-in that sleeps latency seconds'''
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    @timethis
+    def work(self, batch):
+        time.sleep(self.latency)
+        return [list(range(len(item['candidates']))) for item in batch]
+
+
+def main():
+    probe_interval = 5
+    args = {
+        'recall': {'topk': 20, 'budget_ms': 5},
+        'rerank': {},
+        'cascade_warmup_calls': 1,
+        'cascade_probe_interval': probe_interval,
+    }
+    stage = StandInStageAgent(latency=0.5)
+    agent = PipelineAgent(args, recallagent=StandInRecallAgent(), stages=[('slow', {'topk': 10, 'budget_ms': 50}, stage)])
+    estimator = agent.stage_cost['slow']
+    batch = [{'str': 'hello'}]
+
+    def request():
+        return agent.run(batch, 20)[-1]
+
+    # 1. the warmup and the first cold call
+    agent.warmup(batch)
+    assert estimator.cost is None, f'[!] the warmup is counted: {estimator.cost}'
+    assert request() == [] and estimator.cost is None, f'[!] the first call is counted: {estimator.cost}'
+
+    # 2. the slow stage is measured and skipped
+    stage.latency = 0.2
+    assert request() == [] and estimator.cost >= 0.2
+    assert all(request() == ['slow'] for _ in range(probe_interval)), '[!] the slow stage should be skipped'
+
+    # 3. the latency drops, the probe brings the stage back
+    stage.latency = 0.001
+    skipped = [request() for _ in range(probe_interval + 1)]
+    assert skipped[-1] == [], f'[!] the stage does not come back after its latency drops: {skipped}'
+    assert estimator.cost < 0.05, f'[!] the estimation is not updated by the probe: {estimator.cost}'
+    assert all(request() == [] for _ in range(probe_interval)), '[!] the fast stage should not be skipped'
+    print(f'[!] cascade check passed: the stage comes back with the estimated latency {round(estimator.cost * 1000, 2)} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+from header import *
+from contextlib import contextmanager
+from collections import deque
+from .utils import *
+import threading
+import gc
+
+'''zero-downtime hot swap of the deploy agents (the faiss index, corpus and checkpoints are loaded by the agent):
+1. the new agent is built by the background thread beside the live one, after the memory headroom is checked;
+2. the new agent is warmed up by the recent requests of the api;
+3. the reference is swapped atomically, the new requests are served by the new agent,
+   and the old agent is kept for the rollback after its in-flight requests drain;
+4. only the live and the previous agents are kept in memory, the previous one is released before the next reload'''
+
+
+def host_memory():
+    '''available memory of the host and the resident memory of this process (bytes), linux only'''
+    available, rss = None, None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return available, rss
+
+
+def gpu_memory():
+    '''free memory of the current device and the memory allocated by torch (bytes),
+    the free memory is read by pynvml (counts the other processes), torch.cuda.mem_get_info needs torch>=1.10'''
+    if not torch.cuda.is_available():
+        return None, 0
+    device = torch.cuda.current_device()
+    try:
+        nvmlInit()
+        # the index of the nvml device is the physical one, which is mapped by CUDA_VISIBLE_DEVICES
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        index = int(visible.split(',')[device]) if visible else device
+        free = nvmlDeviceGetMemoryInfo(nvmlDeviceGetHandleByIndex(index)).free
+    except Exception:
+        free = torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+    return free, torch.cuda.memory_allocated()
+
+
+def merge_args(args, overrides):
+    '''update the nested dict args (e.g., the recall args of the pipeline) by the overrides'''
+    for key, value in overrides.items():
+        if type(value) == dict and type(args.get(key)) == dict:
+            merge_args(args[key], value)
+        else:
+            args[key] = value
+    return args
+
+
+def to_gb(value):
+    return None if value is None else round(value / 2 ** 30, 3)
+
+
+class ServingVersion:
+
+    def __init__(self, version, agent, args, footprint):
+        self.version = version
+        self.agent = agent
+        self.args = args
+        # memory (bytes) used by loading the agent: {'host': ..., 'gpu': ...}
+        self.footprint = footprint
+        self.inflight = 0
+        self.loaded_at = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'model': self.args.get('model'),
+            'checkpoint_version': self.args.get('version'),
+            'loaded_at': self.loaded_at,
+            'inflight': self.inflight,
+            'host_footprint_gb': to_gb(self.footprint['host']),
+            'gpu_footprint_gb': to_gb(self.footprint['gpu']),
+            'result_cache': self.agent.cache.describe() if getattr(self.agent, 'cache', None) else None,
+            'tenants': self.agent.describe_tenants() if hasattr(self.agent, 'describe_tenants') else None,
+        }
+
+
+class HotSwapAgent:
+
+    '''serve the api by the live agent (work is delegated), and reload or roll back it without the downtime.
+    builder: function that builds the agent from the args, e.g., RecallAgent'''
+
+    def __init__(self, api_name, builder, args):
+        self.api_name = api_name
+        self.builder = builder
+        swap_args = args.get('hot_swap', {})
+        self.warmup_size = swap_args.get('warmup_size', 16)
+        self.drain_timeout = swap_args.get('drain_timeout', 60.)
+        # the new agent is built only if the available memory covers its footprint times the memory_margin
+        self.memory_margin = swap_args.get('memory_margin', 1.2)
+        self.lock = threading.Lock()
+        self.swap_lock = threading.Lock()
+        self.recent = deque(maxlen=self.warmup_size)
+        self.status = {'state': 'idle', 'message': None}
+        self.counter = 0
+        self.previous = None
+        self.current = self.build(args)
+
+    def build(self, args):
+        gc.collect()
+        host_begin, gpu_begin = host_memory()[1], gpu_memory()[1]
+        agent = self.builder(args)
+        gc.collect()
+        host_end, gpu_end = host_memory()[1], gpu_memory()[1]
+        footprint = {
+            'host': max(host_end - host_begin, 0) if host_begin is not None and host_end is not None else None,
+            'gpu': max(gpu_end - gpu_begin, 0),
+        }
+        self.counter += 1
+        return ServingVersion(self.counter, agent, args, footprint)
+
+    @contextmanager
+    def acquire(self):
+        with self.lock:
+            version = self.current
+            version.inflight += 1
+        try:
+            yield version.agent
+        finally:
+            with self.lock:
+                version.inflight -= 1
+
+    def work(self, *args, **kwargs):
+        if len(args) > 0:
+            # the agents may change the batch in place
+            self.recent.append(deepcopy(args[0]))
+        with self.acquire() as agent:
+            return agent.work(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # the other attributes of the live agent, e.g., whole_size and collection
+        current = self.__dict__.get('current')
+        if current is None:
+            raise AttributeError(name)
+        return getattr(current.agent, name)
+
+    def memory_headroom(self):
+        '''the footprint of the live agent is used as the estimation of the new one,
+        the memory of the previous (rollback) agent is counted as available, it is released before the new one is built'''
+        host_available, _ = host_memory()
+        gpu_free, _ = gpu_memory()
+        if self.previous is not None:
+            if host_available is not None and self.previous.footprint['host'] is not None:
+                host_available += self.previous.footprint['host']
+            if gpu_free is not None:
+                gpu_free += self.previous.footprint['gpu']
+        footprint = self.current.footprint
+        host_required = None if footprint['host'] is None else int(footprint['host'] * self.memory_margin)
+        gpu_required = int(footprint['gpu'] * self.memory_margin)
+        ok = True
+        if host_available is not None and host_required is not None:
+            ok = ok and host_available >= host_required
+        if gpu_free is not None:
+            ok = ok and gpu_free >= gpu_required
+        return {
+            'host_available_gb': to_gb(host_available),
+            'host_required_gb': to_gb(host_required),
+            'gpu_free_gb': to_gb(gpu_free),
+            'gpu_required_gb': to_gb(gpu_required),
+            'ok': ok,
+        }
+
+    def reload(self, overrides=None, force=False):
+        '''build the new agent with the live args updated by the overrides (e.g., version, index_type) in the background,
+        return the memory headroom and whether the reload is started'''
+        if not self.swap_lock.acquire(blocking=False):
+            return {'started': False, 'message': f'[!] {self.api_name} is {self.status["state"]}'}
+        headroom = self.memory_headroom()
+        if not headroom['ok'] and not force:
+            self.swap_lock.release()
+            return {'started': False, 'headroom': headroom, 'message': '[!] not enough memory for the new agent, use force to ignore'}
+        args = merge_args(deepcopy(self.current.args), overrides or {})
+        threading.Thread(target=self.run_reload, args=(args,), name=f'{self.api_name}-hot-swap', daemon=True).start()
+        return {'started': True, 'headroom': headroom}
+
+    def run_reload(self, args):
+        try:
+            self.status = {'state': 'loading', 'message': None}
+            # release the old rollback agent first to make room for the new one
+            self.release_previous()
+            version = self.build(args)
+            self.status = {'state': 'warming', 'message': None}
+            # the agent with the warmup (e.g., the pipeline) does not count the warmup into its latency estimation
+            warmup = getattr(version.agent, 'warmup', version.agent.work)
+            for batch in list(self.recent):
+                warmup(deepcopy(batch))
+            self.swap(version)
+            self.status = {'state': 'idle', 'message': f'[!] swap to version {version.version}'}
+            print(f'[!] {self.api_name} is swapped to version {version.version}')
+        except Exception as error:
+            self.status = {'state': 'failed', 'message': str(error)}
+            print(f'[!] {self.api_name} hot swap failed: {error}')
+        finally:
+            self.swap_lock.release()
+
+    def swap(self, version):
+        with self.lock:
+            old, self.current = self.current, version
+        self.status = {'state': 'draining', 'message': None}
+        self.drain(old)
+        self.previous = old
+        METRICS.inc('easynlp_hot_swap_total', {'api': self.api_name})
+
+    def drain(self, version):
+        begin = time.time()
+        while version.inflight > 0 and time.time() - begin < self.drain_timeout:
+            time.sleep(0.01)
+        if version.inflight > 0:
+            print(f'[!] {version.inflight} requests of the {self.api_name} version {version.version} are not drained in {self.drain_timeout}s')
+
+    def rollback(self):
+        if not self.swap_lock.acquire(blocking=False):
+            return {'succ': False, 'message': f'[!] {self.api_name} is {self.status["state"]}'}
+        try:
+            if self.previous is None:
+                return {'succ': False, 'message': '[!] no previous version to roll back'}
+            previous, self.previous = self.previous, None
+            self.swap(previous)
+            self.status = {'state': 'idle', 'message': f'[!] roll back to version {previous.version}'}
+            return {'succ': True, 'version': previous.version}
+        finally:
+            self.swap_lock.release()
+
+    def release_previous(self):
+        if self.previous is None:
+            return
+        self.previous = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def describe(self):
+        return {
+            'status': self.status,
+            'current': self.current.describe(),
+            'previous': self.previous.describe() if self.previous else None,
+            'headroom': self.memory_headroom(),
+        }
@@ -6,35 +6,148 @@ from es.es_utils import *
 from .utils import *
 from .rerank import *
 from .recall import *
+from .cache import *
+from .tenants import *
+
+
+class StageCostEstimator:
+
+    '''moving average time cost (seconds) of one cascade stage:
+    1. the first warmup_calls time costs (the cold cuda calls) are not counted, the stage is never skipped before it is measured;
+    2. the skipped stage is still run (probed) after probe_interval skips, and its estimation is replaced by the new time cost,
+       so the stage comes back once its latency drops'''
+
+    def __init__(self, warmup_calls=1, probe_interval=100, momentum=0.9):
+        self.warmup_calls = warmup_calls
+        self.probe_interval = probe_interval
+        self.momentum = momentum
+        self.cost = None
+        self.calls, self.skips = 0, 0
+
+    def skip(self, elapsed, deadline):
+        '''whether the stage should be skipped by the deadline'''
+        if self.cost is None or elapsed + self.cost <= deadline:
+            self.skips = 0
+            return False
+        if self.skips >= self.probe_interval:
+            # probe the skipped stage
+            return False
+        self.skips += 1
+        return True
+
+    def update(self, cost):
+        self.calls += 1
+        if self.calls <= self.warmup_calls:
+            return
+        if self.cost is None or self.skips > 0:
+            # the first estimation, or the probe of the skipped stage
+            self.cost = cost
+        else:
+            self.cost = self.momentum * self.cost + (1 - self.momentum) * cost
+        self.skips = 0
 
 
 class PipelineAgent:
 
-    def __init__(self, args):
+    '''recall followed by the cascade of the scorers (deploy.pipeline.cascade in config/base.yaml):
+    each stage rescores the candidates kept by the previous stage and keeps its topk of them;
+    budget_ms of the stage is added to the deadline of the request, the stage is skipped (the previous order is kept)
+    if the elapsed time plus its estimated time cost (StageCostEstimator) exceeds the deadline.
+    without the cascade, the rerank model scores all the recalled candidates'''
+
+    def __init__(self, args, recallagent=None, stages=None):
+        '''recallagent and stages ([(name, stage_args, agent)]): the built agents, e.g., the stand-ins of deploy/cascade_check.py'''
         self.args = args
         recall_args, rerank_args = args['recall'], args['rerank']
-        self.recallagent = RecallAgent(recall_args)
-        self.rerankagent = RerankAgent(rerank_args)
+        self.recallagent = recallagent if recallagent is not None else build_recall_agent(recall_args, cache=False)
+        self.cache = init_result_cache(args, 'pipeline')
+        if stages is not None:
+            self.stages = list(stages)
+        else:
+            self.stages = []
+            for idx, stage_args in enumerate(args.get('cascade') or []):
+                name = stage_args.get('name', f'{idx}_{stage_args["model"]}')
+                self.stages.append((name, stage_args, RerankAgent(stage_args)))
+                print(f'[!] cascade stage {name}: keep top-{stage_args.get("topk")}, budget {stage_args.get("budget_ms")} ms')
+        if len(self.stages) == 0:
+            self.stages.append(('rerank', {'topk': None, 'budget_ms': None}, RerankAgent(rerank_args)))
+        self.stage_cost = {
+            name: StageCostEstimator(
+                warmup_calls=args.get('cascade_warmup_calls', 1),
+                probe_interval=args.get('cascade_probe_interval', 100),
+            ) for name, _, _ in self.stages
+        }
+
+    def cache_key(self, query, topk, dataset=None):
+        recall = self.recallagent.route(dataset)
+        recall_args = recall.args
+        models = tuple((name, stage_args.get('model'), stage_args.get('version'), stage_args['topk']) for name, stage_args, _ in self.stages)
+        return (normalize_query(query), topk, recall_args['dataset'], recall_args['model'], recall_args.get('version'), models, getattr(recall.searcher, 'seq', 0))
 
     @timethis
-    def work(self, batch, topk=None):
-        # recall
+    def work(self, batch, topk=None, dataset=None):
+        '''dataset: the recall tenant, the default one if it is None'''
+        topk = topk if topk else self.args['recall']['topk']
+        if self.cache is None:
+            return self.run(batch, topk, dataset=dataset)
+        keys = [self.cache_key(i['str'], topk, dataset=dataset) for i in batch]
+        responses = [self.cache.get(key) for key in keys]
+        misses = [idx for idx, response in enumerate(responses) if response is None]
+        recall_t, rerank_t, stage_t, skipped = 0., 0., OrderedDict(), []
+        if len(misses) > 0:
+            rest, recall_t, rerank_t, stage_t, skipped = self.run([batch[idx] for idx in misses], topk, dataset=dataset)
+            for idx, response in zip(misses, rest):
+                responses[idx] = response
+                # the responses degraded by the latency budget are not cached
+                if len(skipped) == 0:
+                    self.cache.put(keys[idx], response)
+        return responses, recall_t, rerank_t, stage_t, skipped
+
+    def warmup(self, batch, topk=None, dataset=None):
+        '''run all the stages (e.g., the warmup of the hot swap), the time costs are not counted into the estimation'''
         topk = topk if topk else self.args['recall']['topk']
-        candidates, recall_t = self.recallagent.work(batch, topk=topk)
-        
-        # re-packup
+        return self.run(batch, topk, dataset=dataset, warmup=True)
+
+    def run(self, batch, topk, dataset=None, warmup=False):
+        begin = time.time()
+        # recall
+        candidates, recall_t = self.recallagent.work(batch, topk=topk, dataset=dataset)
+        deadline = self.args['recall'].get('budget_ms')
+        deadline = 1e-3 * deadline if deadline else 0.
         contexts = [i['str'] for i in batch]
-        rerank_batch = []
-        for c, r in zip(contexts, candidates):
-            r = [i['text'] for i in r]
-            rerank_batch.append({'context': c, 'candidates': r})
 
-        # rerank
-        scores, rerank_t = self.rerankagent.work(rerank_batch)
+        stage_t, skipped = OrderedDict(), []
+        for name, stage_args, agent in self.stages:
+            if stage_args.get('budget_ms') and not warmup:
+                deadline += 1e-3 * stage_args['budget_ms']
+                if self.stage_cost[name].skip(time.time() - begin, deadline):
+                    # out of the latency budget, keep the order of the previous stage
+                    skipped.append(name)
+                    stage_t[name] = 0.
+                    candidates = [c[:stage_args['topk']] for c in candidates]
+                    METRICS.inc('easynlp_cascade_skipped_total', {'stage': name})
+                    continue
+
+            # re-packup
+            with trace_span('candidate_packing'):
+                rerank_batch = []
+                for c, r in zip(contexts, candidates):
+                    r = [i['text'] for i in r]
+                    rerank_batch.append({'context': c, 'candidates': r})
+
+            # rescore and keep the topk candidates
+            with trace_span(f'cascade_{name}'):
+                scores, t = agent.work(rerank_batch)
+            with trace_span('candidate_packing'):
+                candidates = [
+                    [candidate[i] for i in np.argsort(-np.asarray(score), kind='stable')[:stage_args['topk']]]
+                    for score, candidate in zip(scores, candidates)
+                ]
+            stage_t[name] = t
+            if not warmup:
+                self.stage_cost[name].update(t)
+        rerank_t = sum(stage_t.values())
 
         # packup
-        responses = []
-        for score, candidate in zip(scores, candidates):
-            idx = np.argmax(score)
-            responses.append(candidate[idx]['text'])
-        return responses, recall_t, rerank_t
+        responses = [candidate[0]['text'] for candidate in candidates]
+        return responses, recall_t, rerank_t, stage_t, skipped
@@ -2,9 +2,12 @@ from header import *
 from model import *
 from config import *
 from dataloader import *
-from inference_utils import Searcher
+from inference_utils import Searcher, ColBERTSearcher, UpdatableSearcher, ShardedSearcher, load_sharded_searcher, shard_manifest_path
 from es.es_utils import *
 from .utils import *
+from .synthetic import *
+from .cache import *
+import weakref
 import time
 
 
@@ -27,60 +30,198 @@ def init_recall(args):
         # agent = None
         # print(f'[!] load {len(searcher)} samples for full-rerank mode')
         # size = len(searcher)
-    else:
-        searcher = Searcher(args['index_type'], dimension=args['dimension'], with_source=args['with_source'], nprobe=args['index_nprobe'])
+    elif args['model'] == 'synthetic':
+        # cpu-only stand-ins for the deploy benchmark
+        searcher, agent, size = init_synthetic_recall(args)
+    elif args['model'] in ['colbert', 'colbertv2']:
+        # end-to-end late interaction retrieval with the compressed token-embedding index
+        searcher = ColBERTSearcher(
+            dimension=args['dimension'], 
+            nprobe=args['colbert_nprobe'], 
+            candidate_size=args['colbert_candidate_size']
+        )
         model_name = args['model']
         pretrained_model_name = args['pretrained_model'].replace('/', '_')
-        if args['with_source']:
-            path_source_corpus = f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_source_corpus.ckpt'
-        else: 
-            path_source_corpus = None
         searcher.load(
-            f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt',
+            f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_colbert_index.ckpt',
             f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
-            path_source_corpus=path_source_corpus
         )
+        print(f'[!] load colbert index over')
+        agent = load_shared_encoder(args)
+        size = len(searcher.corpus)
+    else:
+        if args.get('updatable_index', False):
+            searcher = load_updatable_searcher(args)
+        else:
+            searcher = load_searcher(args)
         # searcher.move_to_gpu(device=0)
         print(f'[!] load faiss over')
-        agent = load_model(args) 
-        pretrained_model_name = args['pretrained_model'].replace('/', '_')
-        if args['with_source']:
-            save_path = f'{args["root_dir"]}/ckpt/writer/{args["model"]}/best_{pretrained_model_name}.pt'
-        else:
-            save_path = f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt'
-        agent.load_model(save_path)
-        print(f'[!] load model over')
-        size = searcher.searcher.ntotal
+        agent = load_shared_encoder(args)
+        size = len(searcher) if isinstance(searcher, ShardedSearcher) else searcher.searcher.ntotal
     return searcher, agent, size
 
 
+# the encoders are shared by the agents (tenants, recall and pipeline) that load the same checkpoint with the same backend,
+# and released with the last agent that uses them
+SHARED_ENCODERS = weakref.WeakValueDictionary()
+
+
+def load_shared_encoder(args):
+    '''checkpoint_dataset (optional): load the checkpoint trained on another dataset, e.g., one encoder for several tenants'''
+    encoder_args = deepcopy(args)
+    encoder_args['dataset'] = args.get('checkpoint_dataset') or args['dataset']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    if args['with_source']:
+        save_path = f'{args["root_dir"]}/ckpt/writer/{args["model"]}/best_{pretrained_model_name}.pt'
+    else:
+        save_path = f'{args["root_dir"]}/ckpt/{encoder_args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt'
+    backend = args.get('backend', 'torch')
+    # the modified checkpoint (same path) is loaded again
+    key = (args['model'], os.path.realpath(save_path), os.path.getmtime(save_path), backend)
+    agent = SHARED_ENCODERS.get(key)
+    if agent is not None:
+        print(f'[!] share the loaded encoder of {save_path}')
+        return agent
+    agent = load_model(encoder_args) 
+    agent.load_model(save_path)
+    print(f'[!] load model over')
+    if backend in ['onnx', 'onnx-int8']:
+        # cpu onnx runtime backend, exported by convert_to_onnx.py
+        agent.load_onnx_backend(quantize=backend == 'onnx-int8', num_threads=args.get('onnx_num_threads', 0))
+    SHARED_ENCODERS[key] = agent
+    return agent
+
+
+def load_searcher(args):
+    model_name = args['model']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    path_faiss = f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt'
+    if not os.path.exists(path_faiss) and os.path.exists(shard_manifest_path(args)) and not args['with_source']:
+        # the index shards built by inference.py --sharded_index
+        return load_sharded_searcher(args)
+    searcher = Searcher(args['index_type'], dimension=args['dimension'], with_source=args['with_source'], nprobe=args['index_nprobe'])
+    if args['with_source']:
+        path_source_corpus = f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_source_corpus.ckpt'
+    else: 
+        path_source_corpus = None
+    searcher.load(
+        path_faiss,
+        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
+        path_source_corpus=path_source_corpus
+    )
+    return searcher
+
+
+# the updatable searchers are shared by the recall and pipeline agents, one writer for each wal
+UPDATABLE_SEARCHERS = {}
+
+
+def load_updatable_searcher(args):
+    '''restore the updatable index from its snapshot and wal,
+    or import the faiss index built by response_strategy at the first time'''
+    assert args['with_source'] is False, f'[!] updatable index only supports the q-r matching'
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/{args["model"]}_{pretrained_model_name}_updatable'
+    if path in UPDATABLE_SEARCHERS:
+        return UPDATABLE_SEARCHERS[path]
+    searcher = UpdatableSearcher(
+        args['index_type'], 
+        dimension=args['dimension'], 
+        nprobe=args['index_nprobe'], 
+        path=path,
+        compact_interval=args.get('compact_interval', 300),
+        compact_ratio=args.get('compact_ratio', 0.1),
+        fsync=args.get('wal_fsync', False),
+    )
+    if not searcher.restore():
+        base = load_searcher(args)
+        if isinstance(base, ShardedSearcher):
+            raise Exception(f'[!] updatable index cannot import the index shards, build the whole index by the response work mode')
+        searcher.import_searcher(base)
+        searcher.snapshot()
+    searcher.start_compaction()
+    UPDATABLE_SEARCHERS[path] = searcher
+    return searcher
+
+
 class RecallAgent:
 
-    def __init__(self, args):
+    def __init__(self, args, cache=True):
+        '''cache: False for the recall agent inside the pipeline agent, which caches the final responses'''
         self.searcher, self.agent, self.whole_size = init_recall(args)
         self.args = args
+        # the full mode returns the whole corpus for the batch
+        self.cache = init_result_cache(args, 'recall') if cache and args['model'] != 'full' else None
+
+    def cache_key(self, query, topk):
+        # the seq of the updatable index changes with its corpus
+        return (normalize_query(query), topk, self.args['model'], self.args.get('version'), getattr(self.searcher, 'seq', 0))
+
+    def route(self, dataset=None):
+        if dataset is not None and dataset != self.args['dataset']:
+            raise Exception(f'[!] dataset {dataset} is not served, only {self.args["dataset"]}')
+        return self
 
     @timethis
-    def work(self, batch, topk=None):
+    def work(self, batch, topk=None, dataset=None):
         '''batch: a list of string (query)'''
-        batch = [i['str'] for i in batch]
+        self.route(dataset)
         topk = topk if topk else self.args['topk']
+        if self.cache is None:
+            return self.search(batch, topk)
+        keys = [self.cache_key(i['str'], topk) for i in batch]
+        rest = [self.cache.get(key) for key in keys]
+        misses = [idx for idx, item in enumerate(rest) if item is None]
+        if len(misses) > 0:
+            for idx, item in zip(misses, self.search([batch[idx] for idx in misses], topk)):
+                rest[idx] = item
+                self.cache.put(keys[idx], item)
+        return rest
+
+    def search(self, batch, topk):
+        batch = [i['str'] for i in batch]
+        vectors = None
         if self.args['model'] == 'bm25':
             batch = [' '.join(i) for i in batch]
             rest_ = self.searcher.msearch(batch, topk=topk)
         elif self.args['model'] == 'full':
             rest_ = [self.searcher]
+        elif self.args['model'] in ['colbert', 'colbertv2']:
+            vectors, masks = self.agent.encode_queries(batch)    # [B, S, E], [B, S]
+            rest_ = self.searcher._search(vectors, masks, topk=topk)
+            # only the [CLS] token embeddings are returned
+            vectors = vectors[:, 0, :]
         else:
-            model_start_time = time.time()
             vectors = self.agent.encode_queries(batch)    # [B, E]
-            print("model inference cost time:{}".format(time.time() - model_start_time))
-            retrieval_start_time = time.time()
-            rest_ = self.searcher._search(vectors, topk=topk)
+            with trace_span('faiss_search'):
+                rest_ = self.searcher._search(vectors, topk=topk)
             # rest_, distance = self.searcher._search_dis(vectors, topk=topk)
-            print("retrieval cost time:{}".format(time.time() - retrieval_start_time))
+        with trace_span('candidate_packing'):
+            return self.packup(rest_, vectors)
+
+    def add_candidates(self, texts, inner_bsz=256):
+        '''encode and add the new candidates into the updatable index, return their ids'''
+        self.check_updatable()
+        ids = []
+        for idx in range(0, len(texts), inner_bsz):
+            vectors = self.agent.encode_candidates(texts[idx:idx+inner_bsz])
+            ids.extend(self.searcher.add(vectors, texts[idx:idx+inner_bsz]))
+        return ids
+
+    def delete_candidates(self, ids=None, texts=None):
+        self.check_updatable()
+        return self.searcher.delete(ids=ids, texts=texts)
+
+    def check_updatable(self):
+        if not isinstance(self.searcher, UpdatableSearcher):
+            raise Exception(f'[!] the index is not updatable, set updatable_index in deploy.recall of config/base.yaml')
+
+    def packup(self, rest_, vectors):
+        # the query embeddings are converted once, and each query only carries its own embedding
+        vectors = vectors.tolist() if vectors is not None else [None] * len(rest_)
         rest = []
         # for item, dis in zip(rest_, distance):
-        for item in rest_:
+        for item, vector in zip(rest_, vectors):
             cache = []
             # for i, j in zip(item, dis):
             for i in item:
@@ -94,7 +235,7 @@ class RecallAgent:
                     cache.append({
                         'text': i,
                         'source': {'title': None, 'url': None},
-                        'vectors': vectors.tolist()
+                        'vectors': vector
                         # 'similarity': str(j),
                     })
                 elif type(i) == tuple:
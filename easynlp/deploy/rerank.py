@@ -3,6 +3,7 @@ from model import *
 from config import *
 from dataloader import *
 from .utils import *
+from .synthetic import *
 
 
 class RerankAgent:
@@ -11,11 +12,18 @@ class RerankAgent:
         if args['model'] is None:
             # donot rerank
             pass
+        elif args['model'] == 'synthetic':
+            # cpu-only stand-in for the deploy benchmark
+            self.agent = init_synthetic_rerank(args)
         else:
             self.agent = load_model(args) 
             pretrained_model_name = args['pretrained_model'].replace('/', '_')
             save_path = f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt'
             self.agent.load_model(save_path)
+            if args.get('candidate_cache', False):
+                # look up the precomputed candidate embeddings instead of encoding them for every request
+                path = f'{args["root_dir"]}/data/{args["dataset"]}/{args["model"]}_{pretrained_model_name}'
+                self.agent.load_candidate_cache(f'{path}_candidate_cache.npy', f'{path}_candidate_cache_corpus.ckpt')
         self.args = args
 
     @timethis
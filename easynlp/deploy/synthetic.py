@@ -0,0 +1,131 @@
+from header import *
+from dataloader import *
+from inference_utils import Searcher, remove_duplicate_and_hold_the_order
+from transformers import BertConfig, BertModel
+from .utils import *
+
+'''
+cpu-only stand-ins of the recall and rerank models for the deploy benchmark (benchmark_deploy.py),
+set the model of the recall/rerank agent as `synthetic` (config/synthetic.yaml) to use them:
+1. the tiny bert encoders are randomly initialized, and the char-level vocab is built from the corpus;
+2. the faiss index is built from the random vectors, the corpus is the utterances of data/<dataset>/test.txt
+'''
+
+
+def load_synthetic_corpus(args):
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/test.txt'
+    corpus = []
+    for _, utterances in read_text_data_utterances(path, lang=args['lang']):
+        corpus.extend(utterances)
+    corpus = remove_duplicate_and_hold_the_order(corpus)
+    # repeat the utterances to reach the corpus size
+    corpus = [corpus[i % len(corpus)] for i in range(args['corpus_size'])]
+    return corpus
+
+
+def build_synthetic_vocab(corpus, path):
+    '''char-level vocab of the corpus, the wordpieces of the english words are the characters'''
+    chars = sorted(set(''.join(corpus)) - set(' \t\n\r　'))
+    tokens = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars + [f'##{c}' for c in chars]
+    with open(path, 'w') as f:
+        for token in tokens:
+            f.write(f'{token}\n')
+    return BertTokenizerFast(vocab_file=path, do_lower_case=False)
+
+
+def build_synthetic_encoder(args, vocab):
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=args['hidden_size'],
+        num_hidden_layers=args['num_hidden_layers'],
+        num_attention_heads=args['num_attention_heads'],
+        intermediate_size=args['intermediate_size'],
+        max_position_embeddings=max(args['max_len'], args['res_max_len']) + 2,
+        pad_token_id=vocab.pad_token_id,
+    )
+    model = BertModel(config)
+    model.eval()
+    return model
+
+
+def join_context(context):
+    if type(context) == list:
+        context = ' [SEP] '.join(context)
+    return context
+
+
+class SyntheticBertAgent:
+
+    '''tiny randomly initialized bert, serves the `encode_queries` api of the dual-bert models (recall)
+    and the `rerank` api of the cross-encoder models (rerank)'''
+
+    def __init__(self, args, corpus):
+        self.args = args
+        torch.manual_seed(args['seed'])
+        self.vocab = build_synthetic_vocab(corpus, f'{args["root_dir"]}/data/{args["dataset"]}/synthetic_vocab.txt')
+        self.ctx_encoder = build_synthetic_encoder(args, self.vocab)
+        self.can_encoder = build_synthetic_encoder(args, self.vocab)
+        self.head = nn.Linear(args['hidden_size'], 1)
+        print(f'[!] synthetic bert agent: {args["num_hidden_layers"]} layers, {args["hidden_size"]} hidden size, {len(self.vocab)} tokens')
+
+    @torch.no_grad()
+    def _encode(self, encoder, texts, text_pairs=None, max_len=512):
+        with trace_span('tokenize'):
+            inputs = self.vocab(
+                texts,
+                text_pairs,
+                padding=True,
+                truncation=True,
+                max_length=max_len,
+                return_tensors='pt'
+            )
+        with trace_span('encoder_forward'):
+            return encoder(**inputs).last_hidden_state[:, 0, :]    # [B, E]
+
+    def encode_queries(self, texts):
+        texts = [join_context(i) for i in texts]
+        vectors = self._encode(self.ctx_encoder, texts, max_len=self.args['max_len'])
+        vectors = F.normalize(vectors, dim=-1)
+        return vectors.numpy().astype(np.float32)
+
+    def encode_candidates(self, texts):
+        vectors = self._encode(self.can_encoder, texts, max_len=self.args['res_max_len'])
+        vectors = F.normalize(vectors, dim=-1)
+        return vectors.numpy().astype(np.float32)
+
+    @torch.no_grad()
+    def rerank(self, batches):
+        '''cross-encoder scores of the context-candidate pairs'''
+        pairs, lengths = [], []
+        for batch in batches:
+            context = join_context(batch['context'])
+            pairs.extend([(context, candidate) for candidate in batch['candidates']])
+            lengths.append(len(batch['candidates']))
+        scores = []
+        for idx in range(0, len(pairs), self.args['inner_bsz']):
+            ctx, res = zip(*pairs[idx:idx+self.args['inner_bsz']])
+            reps = self._encode(self.ctx_encoder, list(ctx), list(res), max_len=self.args['max_len'])
+            with trace_span('rerank_forward'):
+                scores.extend(self.head(reps).squeeze(-1).tolist())
+        rest, offset = [], 0
+        for length in lengths:
+            rest.append(scores[offset:offset+length])
+            offset += length
+        return rest
+
+
+def init_synthetic_recall(args):
+    corpus = load_synthetic_corpus(args)
+    agent = SyntheticBertAgent(args, corpus)
+    # random unit vectors of the corpus
+    random_state = np.random.RandomState(args['seed'])
+    matrix = random_state.randn(len(corpus), args['dimension']).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=-1, keepdims=True)
+    searcher = Searcher(args['index_type'], dimension=args['dimension'], nprobe=args['index_nprobe'])
+    searcher._build(matrix, corpus)
+    print(f'[!] build the synthetic faiss index over, {searcher.searcher.ntotal} vectors')
+    return searcher, agent, searcher.searcher.ntotal
+
+
+def init_synthetic_rerank(args):
+    return SyntheticBertAgent(args, load_synthetic_corpus(args))
@@ -0,0 +1,103 @@
+from header import *
+from .utils import *
+from .recall import *
+from .hot_swap import host_memory, to_gb
+from inference_utils import snapshot_files
+
+'''multi-dataset recall serving in one process (deploy.recall.tenants in config/base.yaml):
+1. each tenant (dataset) has its own index, corpus and result cache, the request is routed by its dataset
+   (the dataset of deploy.recall is the default tenant);
+2. the query encoders of the tenants that load the same checkpoint with the same backend are shared (load_shared_encoder);
+3. memory_limit_mb of the tenant is checked with the size of its index files before they are loaded'''
+
+
+def index_files(args):
+    '''the index and corpus files of the recall agent, which are loaded into the memory'''
+    model_name = args['model']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    prefix = f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}'
+    if model_name in ['colbert', 'colbertv2']:
+        return [f'{prefix}_colbert_index.ckpt', f'{prefix}_corpus.ckpt']
+    if args.get('updatable_index', False) and snapshot_files(f'{prefix}_updatable'):
+        return snapshot_files(f'{prefix}_updatable')
+    paths = [f'{prefix}_faiss.ckpt', f'{prefix}_corpus.ckpt']
+    if args['with_source']:
+        paths.append(f'{prefix}_source_corpus.ckpt')
+    return paths
+
+
+def estimate_index_size(args):
+    '''bytes of the index files, None for the indexes that are not the local files (bm25, full and synthetic)'''
+    if args['model'] in ['bm25', 'full', 'synthetic']:
+        return None
+    return sum(os.path.getsize(path) for path in index_files(args) if os.path.exists(path))
+
+
+class MultiTenantRecallAgent:
+
+    def __init__(self, args, cache=True):
+        self.args = args
+        self.default = args['dataset']
+        self.tenants = OrderedDict()
+        # host memory (bytes) used by loading each tenant
+        self.footprint = {}
+        for tenant_args in [args] + args['tenants']:
+            dataset = tenant_args['dataset']
+            if dataset in self.tenants:
+                raise Exception(f'[!] duplicated tenant: {dataset}')
+            self.check_memory_limit(tenant_args)
+            begin = host_memory()[1]
+            self.tenants[dataset] = RecallAgent(tenant_args, cache=cache)
+            end = host_memory()[1]
+            self.footprint[dataset] = max(end - begin, 0) if begin is not None and end is not None else None
+            print(f'[!] recall tenant {dataset} ({tenant_args["model"]}) activate: {self.tenants[dataset].whole_size} candidates')
+        # the result caches belong to the tenants
+        self.cache = None
+
+    def check_memory_limit(self, args):
+        limit = args.get('memory_limit_mb')
+        size = estimate_index_size(args)
+        if limit and size is not None and size > limit * 2 ** 20:
+            raise Exception(f'[!] index of the tenant {args["dataset"]} ({round(size / 2 ** 20, 1)} MB) exceeds its memory_limit_mb {limit}')
+
+    def route(self, dataset=None):
+        dataset = dataset if dataset else self.default
+        if dataset not in self.tenants:
+            raise Exception(f'[!] dataset {dataset} is not served, only {list(self.tenants.keys())}')
+        return self.tenants[dataset]
+
+    def work(self, batch, topk=None, dataset=None):
+        # the time cost is returned by the work of the tenant
+        return self.route(dataset).work(batch, topk=topk)
+
+    def add_candidates(self, texts, inner_bsz=256, dataset=None):
+        return self.route(dataset).add_candidates(texts, inner_bsz=inner_bsz)
+
+    def delete_candidates(self, ids=None, texts=None, dataset=None):
+        return self.route(dataset).delete_candidates(ids=ids, texts=texts)
+
+    def __getattr__(self, name):
+        # the other attributes of the default tenant, e.g., whole_size and searcher
+        tenants = self.__dict__.get('tenants')
+        if not tenants:
+            raise AttributeError(name)
+        return getattr(tenants[self.__dict__['default']], name)
+
+    def describe_tenants(self):
+        return {
+            dataset: {
+                'model': agent.args['model'],
+                'size': agent.whole_size,
+                'index_size_mb': None if estimate_index_size(agent.args) is None else round(estimate_index_size(agent.args) / 2 ** 20, 3),
+                'memory_limit_mb': agent.args.get('memory_limit_mb'),
+                'host_footprint_gb': to_gb(self.footprint[dataset]),
+                'result_cache': agent.cache.describe() if agent.cache else None,
+            } for dataset, agent in self.tenants.items()
+        }
+
+
+def build_recall_agent(args, cache=True):
+    '''the multi-tenant agent if the tenants are configured, otherwise the single dataset agent'''
+    if args.get('tenants'):
+        return MultiTenantRecallAgent(args, cache=cache)
+    return RecallAgent(args, cache=cache)
@@ -1,7 +1,7 @@
 from functools import wraps
-import logging
-from pprint import pformat
 import time
+from flask import request
+from model.utils.tracing import *
 
 def timethis(func):
     '''
@@ -17,24 +17,53 @@ def timethis(func):
     return wrapper
 
 
-def init_logging(args, pipeline=False):
+def traced(api_name):
+    '''
+    Decorator that opens the trace of the flask handler,
+    the request id is read from the X-Request-Id header or generated.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.request(api_name, request.headers.get('X-Request-Id')):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_tracing(args):
+    '''args: base configuration, the sampled traces are saved into log/<dataset>/trace.jsonl'''
+    tracing_args = args['deploy'].get('tracing', {})
+    TRACER.configure(
+        sample_rate=tracing_args.get('sample_rate', 0.),
+        path=f'{args["root_dir"]}/log/{args["deploy"]["dataset"]}/trace.jsonl',
+        cuda_sync=tracing_args.get('cuda_sync', False),
+    )
+
+
+def init_logging(args, api_name, pipeline=False):
+    '''the records are written by the background writer as the compact json lines,
+    sampled by the per-api sample rate and the redact_fields (e.g., vectors) are dropped (deploy.logging in config/base.yaml)'''
     if pipeline:
         name = f'{args["dataset"]}_{args["recall"]["model"]}_{args["rerank"]["model"]}'
-        path = f'{args["root_dir"]}/log/{args["dataset"]}/pipeline/{name}.log'
+        path = f'{args["root_dir"]}/log/{args["dataset"]}/pipeline/{name}.jsonl'
     else:
         name = f'{args["dataset"]}_{args["model"]}'
-        path = f'{args["root_dir"]}/log/{args["dataset"]}/{args["model"]}/{name}.log'
-    formatter = logging.Formatter('%(asctime)s : %(message)s', "%Y-%m-%d %H:%M:%S")
-    fileHandler = logging.FileHandler(path, mode='a')
-    fileHandler.setFormatter(formatter)
-    vlog = logging.getLogger(name)
-    vlog.setLevel(logging.INFO)
-    vlog.addHandler(fileHandler) 
+        path = f'{args["root_dir"]}/log/{args["dataset"]}/{args["model"]}/{name}.jsonl'
+    logging_args = args.get('logging', {})
+    sample_rate = logging_args.get('sample_rate', {}).get(api_name, 1.)
+    vlog = JsonLinesWriter(
+        path,
+        api_name,
+        queue_size=logging_args.get('queue_size', 10000),
+        sample_rate=sample_rate,
+        redact_fields=logging_args.get('redact_fields', []),
+    )
     print(f'[!] init the logging information over, save the information into the log file:')
-    print(f'[!] - {name}: {path}')
+    print(f'[!] - {name}: {path} (sample rate: {sample_rate})')
     return vlog
 
 
 def push_to_log(information, vlog):
-    information = pformat(information)
-    vlog.info(information)
+    '''non-blocking, the information is serialized by the background writer'''
+    vlog.push(information)
@@ -17,6 +17,7 @@ def parser_args():
     parser.add_argument('--dataset', default='douban', type=str)
     parser.add_argument('--pool_size', default=1000, type=int)
     parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--workers', default=8, type=int, help='concurrent msearch requests')
     parser.add_argument('--recall_mode', default='q-q', type=str)
     parser.add_argument('--topk', default=10, type=int)
     parser.add_argument('--full_turn_length', default=5, type=int)
@@ -25,7 +26,9 @@ def parser_args():
 def main_search(args):
     searcher = ESSearcher(
         f'{args["dataset"]}_{args["recall_mode"]}', 
-        q_q=True if args['recall_mode']=='q-q' else False
+        q_q=True if args['recall_mode']=='q-q' else False,
+        chunk_size=args['batch_size'],
+        workers=args['workers'],
     )
 
     # load train dataset
@@ -36,26 +39,18 @@ def main_search(args):
     data = [(utterances[:-1], utterances[-1]) for label, utterances in dataset if label == 1]
     responses = [utterances[-1] for label, utterances in dataset]
     collector = []
-    pbar = tqdm(range(0, len(data), args['batch_size']))
-    for idx in pbar:
-        # random choice the conversation context to search the topic related responses
-        context = [i[0] for i in data[idx:idx+args['batch_size']]]
-        response = [i[1] for i in data[idx:idx+args['batch_size']]]
-        context_str = [' '.join(i[0]) for i in data[idx:idx+args['batch_size']]]
-        rest_ = searcher.msearch(context_str, topk=args['pool_size'])
-
-        rest = []
-        for gt_ctx, gt_res, i in zip(context, response, rest_):
-            i = list(set(i))
-            if gt_res in i:
-                i.remove(gt_res)
-            if len(i) < args['topk']:
-                rest.append(i + random.sample(responses, args['topk']-len(i)))
-            else:
-                rest.append(i[:args['topk']])
-
-        for q, r, nr in zip(context, response, rest):
-            collector.append({'q': q, 'r': r, 'nr': nr})
+    # the results are streamed back in order, the msearch chunks (batch_size) are searched concurrently
+    context_str = [' '.join(i[0]) for i in data]
+    rest_ = searcher.imsearch(context_str, topk=args['pool_size'])
+    for (gt_ctx, gt_res), i in tqdm(zip(data, rest_), total=len(data)):
+        i = list(set(i))
+        if gt_res in i:
+            i.remove(gt_res)
+        if len(i) < args['topk']:
+            nr = i + random.sample(responses, args['topk']-len(i))
+        else:
+            nr = i[:args['topk']]
+        collector.append({'q': gt_ctx, 'r': gt_res, 'nr': nr})
 
     with open(write_path, 'w', encoding='utf-8') as f:
         for data in collector:
@@ -66,11 +61,15 @@ def main_search(args):
 def main_single_search(args):
     q_q_searcher = ESSearcher(
         f'{args["dataset"]}_q-q', 
-        q_q=True
+        q_q=True,
+        chunk_size=args['batch_size'],
+        workers=args['workers'],
     )
     single_searcher = ESSearcher(
         f'{args["dataset"]}_single', 
-        q_q=False
+        q_q=False,
+        chunk_size=args['batch_size'],
+        workers=args['workers'],
     )
 
     # load train dataset
@@ -79,50 +78,33 @@ def main_single_search(args):
     dataset = read_text_data_utterances_full(read_path, lang=args['lang'], turn_length=full_turn_length)
     data = [(utterances[:-1], utterances[-1]) for label, utterances in dataset if label == 1]
     responses = [utterances[-1] for label, utterances in dataset]
-    pbar = tqdm(range(0, len(data), args['batch_size']))
-
     f = open(write_path, 'w', encoding='utf-8')
 
-    for idx in pbar:
-        # random choice the conversation context to search the topic related responses
-        context = [i[0] for i in data[idx:idx+args['batch_size']]]
-        response = [i[1] for i in data[idx:idx+args['batch_size']]]
-        context_str = [' '.join(i[0]) for i in data[idx:idx+args['batch_size']]]
-        rest_q_q, rest_single = [], []
-
-        # q-q search
-        rest_ = q_q_searcher.msearch(context_str, topk=args['pool_size'])
-        for gt_ctx, gt_res, i in zip(context, response, rest_):
-            i = list(set(i))
-            if gt_res in i:
-                i.remove(gt_res)
-            if len(i) < args['topk']:
-                rest_q_q.append(i + random.sample(responses, args['topk']-len(i)))
-            else:
-                rest_q_q.append(i[:args['topk']])
-
-        # single search
-        query = []
-        for item in data[idx:idx+args['batch_size']]:
-            ctx, _ = item
-            if len(ctx) == 1:
-                query.append(ctx[0])
-            else:
-                query.append(random.choice(ctx[:-1]))
-        rest_ = single_searcher.msearch(query, topk=args['pool_size'])
-        for gt_ctx, gt_res, i in zip(context, response, rest_):
-            i = list(set(i))
-            if gt_res in i:
-                i.remove(gt_res)
-            if len(i) < args['topk']:
-                rest_single.append(i + random.sample(responses, args['topk']-len(i)))
-            else:
-                rest_single.append(i[:args['topk']])
-
-        for q, r, nr, nr_ in zip(context, response, rest_q_q, rest_single):
-            data_ = {'q': q, 'r': r, 'q_q_nr': nr, 'single_nr': nr_}
-            string = json.dumps(data_)
-            f.write(f'{string}\n')
+    # single search: random choice one utterance of the conversation context
+    query = []
+    for ctx, _ in data:
+        if len(ctx) == 1:
+            query.append(ctx[0])
+        else:
+            query.append(random.choice(ctx[:-1]))
+    # the results of the q-q and single searches are streamed back in order
+    context_str = [' '.join(i[0]) for i in data]
+    rest_q_q = q_q_searcher.imsearch(context_str, topk=args['pool_size'])
+    rest_single = single_searcher.imsearch(query, topk=args['pool_size'])
+
+    def collect(gt_res, i):
+        i = list(set(i))
+        if gt_res in i:
+            i.remove(gt_res)
+        if len(i) < args['topk']:
+            return i + random.sample(responses, args['topk']-len(i))
+        return i[:args['topk']]
+
+    for (q, r), i, j in tqdm(zip(data, rest_q_q, rest_single), total=len(data)):
+        data_ = {'q': q, 'r': r, 'q_q_nr': collect(r, i), 'single_nr': collect(r, j)}
+        string = json.dumps(data_)
+        f.write(f'{string}\n')
+    f.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,86 @@
+from .es_utils import *
+from .fake_server import start_fake_server
+import argparse
+import tempfile
+
+'''check of the ESBuilder bulk load against the local fake elasticsearch (es/fake_server.py), no cluster is needed:
+1. the resume without the checkpoint raises instead of indexing the duplicated samples;
+2. the bulk load is interrupted after some chunks, and the crash leaves the refresh and the replicas disabled;
+3. the resumed bulk load (the rejected actions are retried) indexes each sample once,
+   and restores the original settings saved in the checkpoint
+
+    python -m es.bulk_check --port 9201 --samples 2000 --reject_ratio 0.05
+'''
+
+
+class BulkInterrupted(Exception):
+    pass
+
+
+class InterruptedESBuilder(ESBuilder):
+
+    '''raise after interrupt_after chunks are indexed, as the crash of the bulk load'''
+
+    def __init__(self, *args, interrupt_after=2, **kwargs):
+        super(InterruptedESBuilder, self).__init__(*args, **kwargs)
+        self.interrupt_after = interrupt_after
+        self.counter = 0
+
+    def bulk_chunk(self, chunk, **kwargs):
+        if self.counter >= self.interrupt_after:
+            raise BulkInterrupted(f'interrupted after {self.counter} chunks')
+        self.counter += 1
+        return super(InterruptedESBuilder, self).bulk_chunk(chunk, **kwargs)
+
+
+def parser_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=9201, type=int)
+    parser.add_argument('--samples', default=2000, type=int)
+    parser.add_argument('--chunk_size', default=200, type=int)
+    parser.add_argument('--reject_ratio', default=0.05, type=float)
+    return parser.parse_args()
+
+
+def main(port=9201, samples=2000, chunk_size=200, reject_ratio=0.05):
+    server = start_fake_server(port=port, reject_ratio=reject_ratio)
+    hosts = [f'localhost:{port}']
+    index_name = 'bulk_check'
+    checkpoint_path = f'{tempfile.mkdtemp()}/{index_name}_bulk_checkpoint.json'
+    data = [f'sentence {i}' for i in range(samples)]
+    try:
+        # 1. resume without the checkpoint
+        builder = ESBuilder(index_name, create_index=True, hosts=hosts)
+        try:
+            builder.insert(data, chunk_size=chunk_size, checkpoint_path=checkpoint_path, resume=True)
+        except Exception as error:
+            print(f'[!] resume without the checkpoint raises: {error}')
+        else:
+            raise AssertionError('[!] the resume without the checkpoint should raise')
+        assert builder.es.count(index=index_name)['count'] == 0
+
+        # 2. interrupted bulk load, the crash skips the restore of the settings
+        builder = InterruptedESBuilder(index_name, create_index=True, hosts=hosts, interrupt_after=2)
+        try:
+            builder.insert(data, threads=1, chunk_size=chunk_size, checkpoint_path=checkpoint_path)
+        except BulkInterrupted as error:
+            print(f'[!] bulk load is {error}')
+        builder.es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+        acked = builder.load_checkpoint(checkpoint_path)['acked']
+        assert 0 < acked < samples, f'[!] unexpected watermark {acked} of the interrupted bulk load'
+
+        # 3. resume from the watermark
+        builder = ESBuilder(index_name, hosts=hosts)
+        builder.insert(data, threads=4, chunk_size=chunk_size, checkpoint_path=checkpoint_path, resume=True)
+        count = builder.es.count(index=index_name)['count']
+        assert count == samples, f'[!] {count} documents are indexed, {samples} are expected'
+        settings = builder.es.indices.get_settings(index=index_name)[index_name]['settings']['index']
+        assert settings['refresh_interval'] == '1s' and str(settings['number_of_replicas']) == '1', f'[!] settings are not restored: {settings}'
+        print(f'[!] bulk check passed: {count} documents, settings {settings}')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    args = vars(parser_args())
+    main(**args)
@@ -1,15 +1,24 @@
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from contextlib import contextmanager
 import ipdb
 import json
+import os
+import time
 from elasticsearch import Elasticsearch, helpers
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout
 
 
 class ESBuilder:
 
-    def __init__(self, index_name, create_index=False, q_q=False):
-        self.es = Elasticsearch(hosts=['localhost:9200'])
+    def __init__(self, index_name, create_index=False, q_q=False, hosts=None):
+        '''hosts: the elasticsearch hosts, e.g., the local fake bulk endpoint for testing'''
+        self.es = Elasticsearch(hosts=hosts or ['localhost:9200'])
         self.index = index_name
         self.q_q = q_q
+        # the settings of the index before the bulk load
+        self.origin = None
 
         if create_index:
             if q_q is False:
@@ -56,108 +65,224 @@ class ESBuilder:
             rest = self.es.indices.create(index=self.index)
             rest = self.es.indices.put_mapping(body=mapping, index=self.index)
 
-    def insert(self, pairs):
-        count = self.es.count(index=self.index)['count']
-        actions = []
-        counter = 0
-        
-        if self.q_q:
-            for i, (q, a) in enumerate(tqdm(pairs)):
-                actions.append({
-                    '_index': self.index,
-                    '_id': i + count,
-                    'context': q,
-                    'response': a,
-                })
-                if len(actions) > 100000:
-                    helpers.bulk(self.es, actions)
-                    actions = []
-            if len(actions) > 0:
-                helpers.bulk(self.es, actions)
+    def actions(self, pairs, base, start=0):
+        '''generate the index actions lazily, the _id of the i-th sample is base + i, the samples before start are skipped'''
+        for i, item in enumerate(pairs):
+            if i < start:
+                continue
+            if self.q_q:
+                q, a = item
+                yield {'_index': self.index, '_id': base + i, 'context': q, 'response': a}
+            else:
+                # q-r or single mode
+                yield {'_index': self.index, '_id': base + i, 'response': item, 'keyword': item}
+
+    def chunks(self, actions, chunk_size):
+        chunk = []
+        for action in actions:
+            chunk.append(action)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def bulk_chunk(self, chunk, max_retries=5, initial_backoff=2, max_backoff=60):
+        '''index one chunk, the rejected (429) actions are retried by streaming_bulk with the exponential backoff,
+        and the whole chunk is retried if the connection fails (indexing by _id is idempotent);
+        return the acknowledged ids and the failed items'''
+        for attempt in range(max_retries + 1):
+            try:
+                ids, errors = [], []
+                for ok, item in helpers.streaming_bulk(
+                    self.es, chunk, 
+                    chunk_size=len(chunk), 
+                    max_retries=max_retries, 
+                    initial_backoff=initial_backoff, 
+                    max_backoff=max_backoff, 
+                    raise_on_error=False, 
+                    yield_ok=True,
+                ):
+                    if ok:
+                        ids.append(int(item['index']['_id']))
+                    else:
+                        errors.append(item)
+                return ids, errors
+            except (ConnectionError, ConnectionTimeout) as error:
+                if attempt == max_retries:
+                    raise
+                backoff = min(max_backoff, initial_backoff * 2 ** attempt)
+                print(f'[!] bulk failed ({error}), retry in {backoff}s')
+                time.sleep(backoff)
+
+    def index_settings(self):
+        '''the refresh interval and the replicas of the index before the bulk load; the values left by the crashed
+        bulk load (the refresh and the replicas are both disabled) are not the original ones, the defaults are used'''
+        settings = self.es.indices.get_settings(index=self.index)[self.index]['settings']['index']
+        origin = {
+            'refresh_interval': str(settings.get('refresh_interval', '1s')),
+            'number_of_replicas': str(settings.get('number_of_replicas', '1')),
+        }
+        if origin['refresh_interval'] == '-1' and origin['number_of_replicas'] == '0':
+            print(f'[!] the settings of {self.index} are left by the interrupted bulk load, restore the defaults after loading')
+            origin = {'refresh_interval': '1s', 'number_of_replicas': '1'}
+        return origin
+
+    @contextmanager
+    def bulk_settings(self, origin):
+        '''disable the refresh and the replicas during the bulk load, and restore the origin settings after it'''
+        self.es.indices.put_settings(index=self.index, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+        try:
+            yield
+        finally:
+            self.es.indices.put_settings(index=self.index, body={'index': origin})
+            self.es.indices.refresh(index=self.index)
+
+    def load_checkpoint(self, checkpoint_path):
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            if checkpoint['index'] == self.index:
+                return checkpoint
+        return None
+
+    def save_checkpoint(self, checkpoint_path, base, acked):
+        '''the watermark and the origin settings of the index, which are restored by the resumed bulk load'''
+        if checkpoint_path is None:
+            return
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'index': self.index, 'base': base, 'acked': acked, 'settings': self.origin}, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    def insert(self, pairs, threads=4, chunk_size=5000, max_retries=5, checkpoint_path=None, resume=False):
+        '''pairs: (q, a) pairs for q-q mode, or the sentences for q-r and single mode; the order of them should be fixed for resuming.
+        the chunks are indexed by the threads, and the samples before the acknowledged watermark
+        (all the samples before it are acknowledged) are saved into checkpoint_path, which are skipped by the resume'''
+        if resume:
+            checkpoint = self.load_checkpoint(checkpoint_path)
+            if checkpoint is None:
+                raise Exception(f'[!] cannot resume the bulk load of {self.index} without its checkpoint {checkpoint_path}')
+            base, acked = checkpoint['base'], checkpoint['acked']
+            # the settings of the live index are changed by the interrupted bulk load
+            self.origin = checkpoint['settings'] if 'settings' in checkpoint else self.index_settings()
+            print(f'[!] resume from the {acked}-th sample (_id {base + acked})')
         else:
-            # q-r or single mode
-            counter = 0
-            for i, a in enumerate(tqdm(pairs)):
-                actions.append({
-                    '_index': self.index,
-                    '_id': i + count,
-                    'response': a,
-                    'keyword': a,
-                })
-                if len(actions) > 100000:
-                    ipdb.set_trace()
-                    helpers.bulk(self.es, actions)
-                    actions = []
-                    counter += len(action)
-                    print(f'[!] save {counter} samples')
-            if len(actions) > 0:
-                helpers.bulk(self.es, actions)
+            base, acked = self.es.count(index=self.index)['count'], 0
+            self.origin = self.index_settings()
+        # save the origin settings before they are changed
+        self.save_checkpoint(checkpoint_path, base, acked)
+        # the acknowledged ids beyond the watermark
+        pending_ids = set()
+        errors = 0
+        with self.bulk_settings(self.origin), ThreadPoolExecutor(max_workers=threads) as executor, tqdm(total=len(pairs) - acked) as pbar:
+            futures = set()
+            for chunk in self.chunks(self.actions(pairs, base, start=acked), chunk_size):
+                # bounded number of the chunks in the memory
+                if len(futures) >= 2 * threads:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    acked, errors = self.collect(done, base, acked, pending_ids, errors, pbar, checkpoint_path)
+                futures.add(executor.submit(self.bulk_chunk, chunk, max_retries=max_retries))
+            acked, errors = self.collect(futures, base, acked, pending_ids, errors, pbar, checkpoint_path)
+        print(f'[!] save {acked} samples ({errors} failed)')
         print(f'[!] database size: {self.es.count(index=self.index)["count"]}')
 
+    def collect(self, futures, base, acked, pending_ids, errors, pbar, checkpoint_path):
+        for future in futures:
+            ids, failed = future.result()
+            pending_ids.update(ids)
+            pbar.update(len(ids) + len(failed))
+            for item in failed[:5]:
+                print(f'[!] bulk error: {item}')
+            errors += len(failed)
+        while base + acked in pending_ids:
+            pending_ids.remove(base + acked)
+            acked += 1
+        self.save_checkpoint(checkpoint_path, base, acked)
+        return acked, errors
+
 
 class ESSearcher:
 
-    def __init__(self, index_name, q_q=False):
-        self.es = Elasticsearch(hosts=['localhost:9200'])
+    '''the client keeps the pooled keep-alive connections (maxsize for each host) which are shared by the threads,
+    the large query list is split into the msearch chunks of chunk_size, and at most workers chunks are in flight'''
+
+    def __init__(self, index_name, q_q=False, hosts=None, maxsize=16, timeout=30, chunk_size=64, workers=8):
+        self.es = Elasticsearch(hosts=hosts or ['localhost:9200'], maxsize=maxsize, timeout=timeout)
         self.index = index_name
         self.q_q = q_q
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.executor = None
 
     def get_size(self):
         return self.es.count(index=self.index)["count"]
 
-    def msearch(self, queries, topk=10, limit=128):
-        # limit the queries length
-        queries = [query[-limit:] for query in queries]
-
-        search_arr = []
+    def build_body(self, queries, topk):
+        '''the header and the query of each search, serialized into the ndjson by the client'''
+        body = []
+        field, collapse = ('context', 'response') if self.q_q else ('response', 'keyword')
         for query in queries:
-            search_arr.append({'index': self.index})
-            if self.q_q:
-                search_arr.append({
-                    'query': {
-                        'match': {
-                            'context': query
-                        }
-                    },
-                    'collapse': {
-                        'field': 'response'    
-                    },
-                    'size': topk,
-                })
-            else:
-                search_arr.append({
-                    'query': {
-                        'match': {
-                            'response': query
-                        }
-                    },
-                    'collapse': {
-                        'field': 'keyword'    
-                    },
-                    'size': topk,
-                })
-
-        # prepare for searching
-        request = ''
-        for each in search_arr:
-            request += f'{json.dumps(each)} \n'
-        rest = self.es.msearch(body=request)
+            body.append({'index': self.index})
+            body.append({
+                'query': {
+                    'match': {
+                        field: query
+                    }
+                },
+                'collapse': {
+                    'field': collapse
+                },
+                'size': topk,
+            })
+        return body
 
+    def parse(self, rest):
         results = []
         for each in rest['responses']:
             p = []
-            try:
+            if 'error' in each:
+                # the failed search of the chunk returns no candidates
+                print(f'[!] msearch error: {each["error"]}')
+            else:
                 for utterance in each['hits']['hits']:
                     if self.q_q:
                         p.append(utterance['fields']['response'][0])
                     else:
                         p.append(utterance['fields']['keyword'][0])
-            except Exception as error:
-                print(error)
-                ipdb.set_trace()
             results.append(p)
         return results
 
+    def msearch_chunk(self, queries, topk):
+        rest = self.es.msearch(body=self.build_body(queries, topk), request_timeout=self.timeout)
+        return self.parse(rest)
+
+    def truncate(self, queries, limit):
+        '''keep the last limit characters of the queries, None keeps the whole queries'''
+        if limit is None:
+            return queries
+        return [query[-limit:] for query in queries]
+
+    def imsearch(self, queries, topk=10, limit=128):
+        '''stream the results of the queries in order, the chunks are searched concurrently'''
+        # limit the queries length
+        queries = self.truncate(queries, limit)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = deque()
+        for idx in range(0, len(queries), self.chunk_size):
+            if len(futures) >= self.workers:
+                yield from futures.popleft().result()
+            futures.append(self.executor.submit(self.msearch_chunk, queries[idx:idx+self.chunk_size], topk))
+        while futures:
+            yield from futures.popleft().result()
+
+    def msearch(self, queries, topk=10, limit=128):
+        if len(queries) <= self.chunk_size:
+            # limit the queries length
+            return self.msearch_chunk(self.truncate(queries, limit), topk)
+        return list(self.imsearch(queries, topk=topk, limit=limit))
+
     def search(self, query, topk=10):
         if self.q_q:
             dsl = {
@@ -0,0 +1,186 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import threading
+import argparse
+import random
+import json
+import time
+
+
+'''local stand-in of the elasticsearch (7.x) rest api for testing ESBuilder and ESSearcher without the cluster:
+1. the documents are kept in the memory, _bulk (index action), _count, _settings, _refresh and the index create/delete are supported;
+2. _msearch and _search score the documents by the overlapped tokens (the whitespace tokens and the characters)
+   of the match field, and collapse the hits by the collapse field;
+3. the keep-alive connections (HTTP/1.1) are served by the threads, latency_ms delays each request,
+   and reject_ratio rejects the bulk actions with 429 for testing the retry
+
+    python -m es.fake_server --port 9201
+'''
+
+
+def tokenize(text):
+    '''the whitespace tokens and the characters (for chinese)'''
+    tokens = text.split()
+    return set(tokens) | set(''.join(tokens))
+
+
+class FakeIndex:
+
+    def __init__(self):
+        self.documents = {}
+        self.settings = {'refresh_interval': '1s', 'number_of_replicas': '1'}
+
+    def search(self, body, size=10):
+        match = body.get('query', {}).get('match', {})
+        if len(match) == 0:
+            return []
+        field, query = list(match.items())[0]
+        query = tokenize(query if type(query) == str else query['query'])
+        collapse = body.get('collapse', {}).get('field')
+        scored = []
+        for _id, source in self.documents.items():
+            score = len(query & tokenize(str(source.get(field, ''))))
+            if score > 0:
+                scored.append((score, _id, source))
+        scored.sort(key=lambda x: -x[0])
+        hits, collapsed = [], set()
+        for score, _id, source in scored:
+            hit = {'_id': _id, '_score': float(score), '_source': source}
+            if collapse:
+                if source.get(collapse) in collapsed:
+                    continue
+                collapsed.add(source.get(collapse))
+                hit['fields'] = {collapse: [source.get(collapse)]}
+            hits.append(hit)
+            if len(hits) >= size:
+                break
+        return hits
+
+
+class FakeElasticsearch:
+
+    def __init__(self, latency_ms=0, reject_ratio=0.):
+        self.indices = {}
+        self.lock = threading.Lock()
+        self.latency_ms = latency_ms
+        self.reject_ratio = reject_ratio
+
+    def bulk(self, lines, default_index=None):
+        items, errors = [], False
+        for header, source in zip(lines[::2], lines[1::2]):
+            action = header['index']
+            index = action.get('_index', default_index)
+            _id = str(action['_id'])
+            if random.random() < self.reject_ratio:
+                errors = True
+                items.append({'index': {'_index': index, '_id': _id, 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}})
+                continue
+            with self.lock:
+                self.indices.setdefault(index, FakeIndex()).documents[_id] = source
+            items.append({'index': {'_index': index, '_id': _id, 'status': 201, 'result': 'created'}})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+    def msearch(self, lines, default_index=None):
+        responses = []
+        for header, body in zip(lines[::2], lines[1::2]):
+            index = self.indices.get(header.get('index', default_index))
+            if index is None:
+                responses.append({'error': {'type': 'index_not_found_exception'}, 'status': 404})
+                continue
+            hits = index.search(body, size=body.get('size', 10))
+            responses.append({'took': 1, 'hits': {'total': {'value': len(hits)}, 'hits': hits}, 'status': 200})
+        return {'took': 1, 'responses': responses}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=None):
+        data = json.dumps(body if body is not None else {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length).decode('utf-8') if length > 0 else ''
+
+    def handle_request(self):
+        server = self.server.es
+        time.sleep(1e-3 * server.latency_ms)
+        path = [i for i in urlparse(self.path).path.split('/') if i]
+        body = self.read_body()
+        lines = [json.loads(line) for line in body.split('\n') if line.strip()]
+        index_name = path[0] if path and not path[0].startswith('_') else None
+        endpoint = path[-1] if path and path[-1].startswith('_') else None
+        index = server.indices.get(index_name)
+
+        if not path:
+            return self.respond(200, {'name': 'fake', 'cluster_name': 'fake', 'version': {'number': '7.13.0'}, 'tagline': 'You Know, for Search'})
+        if endpoint == '_bulk':
+            return self.respond(200, server.bulk(lines, default_index=index_name))
+        if endpoint == '_msearch':
+            return self.respond(200, server.msearch(lines, default_index=index_name))
+        if index_name is None:
+            return self.respond(400, {'error': f'unsupported path {self.path}'})
+        if endpoint is None:
+            if self.command == 'HEAD':
+                return self.respond(200 if index else 404)
+            if self.command == 'DELETE':
+                server.indices.pop(index_name, None)
+                return self.respond(200, {'acknowledged': True})
+            if self.command == 'PUT':
+                server.indices[index_name] = FakeIndex()
+                return self.respond(200, {'acknowledged': True, 'index': index_name})
+        if index is None:
+            return self.respond(404, {'error': {'type': 'index_not_found_exception'}, 'status': 404})
+        if endpoint == '_count':
+            return self.respond(200, {'count': len(index.documents)})
+        if endpoint == '_search':
+            hits = index.search(lines[0] if lines else {}, size=int(self.path.split('size=')[-1].split('&')[0]) if 'size=' in self.path else 10)
+            return self.respond(200, {'took': 1, 'hits': {'total': {'value': len(hits)}, 'hits': hits}})
+        if endpoint == '_settings':
+            if self.command == 'PUT':
+                index.settings.update({k: str(v) for k, v in lines[0].get('index', lines[0]).items()})
+                return self.respond(200, {'acknowledged': True})
+            return self.respond(200, {index_name: {'settings': {'index': index.settings}}})
+        if endpoint in ['_mapping', '_refresh']:
+            return self.respond(200, {'acknowledged': True})
+        return self.respond(400, {'error': f'unsupported path {self.path}'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+
+def start_fake_server(port=9201, latency_ms=0, reject_ratio=0.):
+    '''start the server in the background thread, return the server (server.shutdown() to stop)'''
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeHandler)
+    server.daemon_threads = True
+    server.es = FakeElasticsearch(latency_ms=latency_ms, reject_ratio=reject_ratio)
+    threading.Thread(target=server.serve_forever, name='fake-es', daemon=True).start()
+    print(f'[!] fake elasticsearch is listening on 127.0.0.1:{port}')
+    return server
+
+
+def parser_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=9201, type=int)
+    parser.add_argument('--latency_ms', default=0, type=float)
+    parser.add_argument('--reject_ratio', default=0., type=float)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = vars(parser_args())
+    server = start_fake_server(port=args['port'], latency_ms=args['latency_ms'], reject_ratio=args['reject_ratio'])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -10,6 +10,11 @@ def parser_args():
     parser.add_argument('--dataset', default='douban', type=str)
     parser.add_argument('--recall_mode', default='q-r', type=str, help='q-q/q-r')
     parser.add_argument('--maximum_sentence_num', default=1000000, type=int)
+    parser.add_argument('--hosts', default='localhost:9200', type=str, help='comma separated elasticsearch hosts')
+    parser.add_argument('--bulk_threads', default=4, type=int)
+    parser.add_argument('--bulk_chunk_size', default=5000, type=int)
+    parser.add_argument('--max_retries', default=5, type=int)
+    parser.add_argument('--resume', action='store_true', help='resume from the acknowledged samples of the last bulk load')
     return parser.parse_args()
 
 
@@ -33,7 +38,8 @@ def q_q_dataset(args):
     test_path = f'{args["root_dir"]}/data/{args["dataset"]}/train.txt'
     test_data = load_qa_pair(train_path, lang=args['lang'])
     train_data.extend(test_data)
-    train_data = list(set(train_data))
+    # sorted: the same order of the samples for resuming the bulk load
+    train_data = sorted(set(train_data))
     print(f'[!] collect {len(train_data)} sentences for BM25 retrieval')
     return train_data
 
@@ -48,7 +54,7 @@ def q_r_dataset(args):
     # extend_data = load_extended_sentences(extend_path)
     # data = train_data + extend_data
     # data = list(set(data))
-    data = list(set(train_data))
+    data = sorted(set(train_data))
     # maximum sentences limitation
     # too many candidates in the elasticseach will slow down the searching speed
     if len(data) > 1000000:
@@ -97,9 +103,19 @@ if __name__ == "__main__":
         data = single_dataset(args)
     elif args['recall_mode'] == 'phrase':
         data = phrase_dataset(args)
+    index_name = f'{args["dataset"]}_{args["recall_mode"]}'
     builder = ESBuilder(
-        f'{args["dataset"]}_{args["recall_mode"]}',
-        create_index=True,
+        index_name,
+        # the index is kept for resuming
+        create_index=not args['resume'],
         q_q=True if args['recall_mode'] in ['q-q', 'phrase-copy'] else False,
+        hosts=args['hosts'].split(','),
+    )
+    builder.insert(
+        data, 
+        threads=args['bulk_threads'], 
+        chunk_size=args['bulk_chunk_size'], 
+        max_retries=args['max_retries'],
+        checkpoint_path=f'{args["root_dir"]}/data/{args["dataset"]}/{index_name}_bulk_checkpoint.json',
+        resume=args['resume'],
     )
-    builder.insert(data)
@@ -14,7 +14,7 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.optim as optim
 import torch.nn as nn
 import torch.nn.functional as F
-from collections import Counter
+from collections import Counter, OrderedDict
 from tqdm import tqdm
 import os
 import sys
@@ -47,6 +47,7 @@ import torch.multiprocessing
 import linecache
 import nanopq
 from scipy.stats import pearsonr, spearmanr
+import scipy.sparse as sp
 
 # texsmart
 try:
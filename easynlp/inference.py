@@ -13,6 +13,7 @@ def parser_args():
     parser.add_argument('--gen_dataset_num', type=int, default=500000)
     parser.add_argument('--gen_dataset_ctx_length', type=int, default=5)
     parser.add_argument('--gen_dataset_topk', type=int, default=5)
+    parser.add_argument('--self_play_session_num', type=int, default=1024)
     parser.add_argument('--gray_topk', type=int, default=5)
     parser.add_argument('--gray_start', type=int, default=372)
     parser.add_argument('--cut_size', type=int, default=500000)
@@ -22,6 +23,7 @@ def parser_args():
     parser.add_argument('--overall_size', type=int, default=200)
     parser.add_argument('--data_filter_size', type=int, default=500000)
     parser.add_argument('--partial', type=float, default=1.)
+    parser.add_argument('--sharded_index', action='store_true', help='response/gray: each rank builds its index shard and mines its own contexts')
     return parser.parse_args()
 
 
@@ -45,9 +47,11 @@ def inference(**args):
     else:
         agent.load_model(f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt')
 
-    if work_mode in ['response', 'partial-response', 'bert-ft']:
+    if work_mode in ['response', 'partial-response', 'bert-ft', 'colbert-response']:
         agent.inference(data_iter, size=args['cut_size'])
         pass
+    elif work_mode in ['candidate-cache']:
+        agent.inference_candidate_cache(data_iter, size=args['cut_size'])
     elif work_mode in ['simcse-response']:
         agent.inference_big(data_iter, size=args['cut_size'])
     elif work_mode in ['knnlm']:
@@ -110,7 +114,10 @@ if __name__ == "__main__":
     torch.distributed.barrier()
 
     if args['local_rank'] != 0:
-        if args['work_mode'] in ['self-play', 'gray-simcse-unlikelyhood', 'gray-one2many', 'generate', 'gray-hard', 'gray-simcse']:
+        if args['work_mode'] in ['self-play', 'self-play-engine', 'gray-simcse-unlikelyhood', 'gray-one2many', 'generate', 'gray-hard', 'gray-simcse']:
+            pass
+        elif args['sharded_index'] and args['work_mode'] in ['response', 'gray']:
+            # all the ranks build the index shards or mine the gray samples
             pass
         else:
             exit()
@@ -120,15 +127,24 @@ if __name__ == "__main__":
         writer_with_source_strategy(args)
     elif args['work_mode'] in ['inference-time-cost']:
         inference_time_cost_strategy(args, agent)
+    elif args['work_mode'] in ['self-play-engine']:
+        # all the processes play their own shards
+        self_play_engine_strategy(args, agent)
     elif args['work_mode'] in ['data-filter']:
         data_filter_strategy(args)
     elif args['work_mode'] in ['gray-test']:
         gray_test_strategy(args)
     elif args['work_mode'] in ['bert-aug']:
         da_strategy(args)
+    elif args['work_mode'] in ['response'] and args['sharded_index']:
+        sharded_response_strategy(args)
     elif args['work_mode'] in ['response', 'wz-simcse', 'knnlm', 'dialog-context']:
         response_strategy(args)
         pass
+    elif args['work_mode'] in ['colbert-response']:
+        colbert_response_strategy(args)
+    elif args['work_mode'] in ['candidate-cache']:
+        candidate_cache_strategy(args)
     elif args['work_mode'] in ['bert-ft']:
         # response_strategy(args)
         gray_rag_bert_ft_strategy(args)
@@ -1,4 +1,6 @@
+from .near_duplicate import *
 from .response import *
+from .sharded_index import *
 from .gray_rag_bert_ft import *
 from .partial_response import *
 from .phrases import *
@@ -19,4 +21,8 @@ from .gray_one2many_res import *
 from .gray_one2many_with_source import *
 from .unparallel import *
 from .self_play import *
+from .self_play_engine import *
 from .gray_one2many_ctx import *
+from .colbert_response import *
+from .candidate_cache import *
+from .updatable_index import *
@@ -0,0 +1,31 @@
+from inference import *
+from header import *
+from .utils import *
+
+'''candidate cache strategy:
+Read the candidate embeddings of the poly-encoder and save them into the memory-mapped candidate cache
+'''
+
+def candidate_cache_strategy(args):
+    embds, texts = [], []
+    for i in tqdm(range(args['nums'])):
+        for idx in range(100):
+            path = f'{args["root_dir"]}/data/{args["dataset"]}/inference_{args["model"]}_{i}_{idx}.pt'
+            if not os.path.exists(path):
+                break
+            embd, text = torch.load(path)
+            print(f'[!] load {path}')
+            embds.append(embd)
+            texts.extend(text)
+    embds = np.concatenate(embds)
+    print(f'[!] collect {len(texts)} candidate embeddings')
+
+    model_name = args['model']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    cache = CandidateEmbeddingCache()
+    cache._build(
+        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_candidate_cache.npy',
+        embds, texts
+    )
+    cache.save(f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_candidate_cache_corpus.ckpt')
+    print(f'[!] save candidate cache over')
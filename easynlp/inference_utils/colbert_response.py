@@ -0,0 +1,40 @@
+from inference import *
+from header import *
+from .utils import *
+
+'''colbert response strategy:
+Read the token embeddings of the candidates and save them into the compressed colbert index
+'''
+
+def colbert_response_strategy(args):
+    embds, lengths, texts = [], [], []
+    for i in tqdm(range(args['nums'])):
+        for idx in range(100):
+            path = f'{args["root_dir"]}/data/{args["dataset"]}/inference_{args["model"]}_{i}_{idx}.pt'
+            if not os.path.exists(path):
+                break
+            embd, length, text = torch.load(path)
+            print(f'[!] load {path}')
+            embds.append(embd)
+            lengths.append(length)
+            texts.extend(text)
+    embds = np.concatenate(embds)
+    lengths = np.concatenate(lengths)
+    print(f'[!] collect {len(texts)} candidates with {len(embds)} tokens')
+
+    searcher = ColBERTSearcher(
+        dimension=args['dimension'], 
+        centroid_num=args['colbert_centroid_num'], 
+        nprobe=args['colbert_nprobe'], 
+        candidate_size=args['colbert_candidate_size']
+    )
+    searcher._build(embds, lengths, texts, speedup=True)
+    print(f'[!] train the colbert searcher over')
+
+    model_name = args['model']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    searcher.save(
+        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_colbert_index.ckpt',
+        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
+    )
+    print(f'[!] save colbert index over')
@@ -2,11 +2,13 @@ from inference import *
 from header import *
 from .utils import *
 from es.es_utils import *
+from .sharded_index import *
 
 '''
 gray strategy generates the hard negative samples (gray samples) for each conversation context in the training and testing dataset:
 
-Need the BERTDualInferenceFullContextDataset'''
+Need the BERTDualInferenceFullContextDataset;
+with --sharded_index, all the ranks mine their own contexts over all the index shards, and the rank 0 merges the outputs'''
 
 
 def init_bm25(args):
@@ -14,9 +16,11 @@ def init_bm25(args):
     return bm25_model
 
 def gray_strategy(args):
+    sharded = args.get('sharded_index', False)
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if sharded else (0, 1)
     # collect the gray negative dataset
     embds, contexts, responses = [], [], []
-    for i in tqdm(range(args['nums'])):
+    for i in tqdm(range(rank, args['nums'], world_size)):
         for idx in range(100):
             try:
                 embd, context, response = torch.load(
@@ -41,11 +45,14 @@ def gray_strategy(args):
     # read faiss index
     model_name = args['model']
     pretrained_model_name = args['pretrained_model'].replace('/', '_')
-    searcher = Searcher(args['index_type'], dimension=args['dimension'], nprobe=args['index_nprobe'])
-    searcher.load(
-        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt',
-        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
-    )
+    if sharded:
+        searcher = load_sharded_searcher(args)
+    else:
+        searcher = Searcher(args['index_type'], dimension=args['dimension'], nprobe=args['index_nprobe'])
+        searcher.load(
+            f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt',
+            f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
+        )
     # speed up with gpu
     searcher.move_to_gpu(device=args['local_rank'])
 
@@ -61,6 +68,7 @@ def gray_strategy(args):
         context = contexts[i:i+args['batch_size']]
         response = responses[i:i+args['batch_size']]
         result, distance = searcher._search_dis(batch, topk=args['gray_start']+args['gray_topk'])
+        rests = []
         for c, r, rest, dis in zip(context, response, result, distance):
             rest = [i for i, j in zip(rest, dis) if j < 1e8]
             rest = remove_duplicate_and_hold_the_order(rest)
@@ -69,10 +77,14 @@ def gray_strategy(args):
             # remove the ground-truth
             if r in rest:
                 rest.remove(r)
+            rests.append(rest)
+        # bm25 to supply, the contexts of the batch are searched by the concurrent msearch chunks
+        supply = [idx for idx, rest in enumerate(rests) if len(rest) < args['gray_topk']]
+        supply_rest = bm25_model.msearch([' '.join(context[idx]) for idx in supply], topk=args['gray_start']+args['gray_topk']) if supply else []
+        supply_rest = dict(zip(supply, supply_rest))
+        for idx, (c, r, rest) in enumerate(zip(context, response, rests)):
             if len(rest) < args['gray_topk']:
-                # bm25 to supply
-                rest_ = bm25_model.msearch([' '.join(c)], topk=args['gray_start']+args['gray_topk'])[0]
-                rest.extend(rest_)
+                rest.extend(supply_rest[idx])
                 if len(rest) < args['gray_topk']:
                     lossing += 1
                     # random supply
@@ -84,8 +96,19 @@ def gray_strategy(args):
 
     # write into new file
     path = f'{args["root_dir"]}/data/{args["dataset"]}/train_gray.txt'
-    with open(path, 'w') as f:
+    with open(f'{path}.{rank}' if sharded else path, 'w') as f:
         for item in tqdm(collection):
             string = json.dumps(item)
             f.write(f'{string}\n')
+    if sharded:
+        dist.barrier()
+        if rank == 0:
+            # merge the outputs of the ranks in order
+            with open(path, 'w') as fw:
+                for r in range(world_size):
+                    with open(f'{path}.{r}') as f:
+                        for line in f:
+                            fw.write(line)
+                    os.remove(f'{path}.{r}')
+            print(f'[!] merge the gray samples of {world_size} ranks into {path}')
 
@@ -0,0 +1,214 @@
+from header import *
+from multiprocessing import Pool
+import unicodedata
+import zlib
+
+'''near-duplicate collapsing of the response corpus before indexing:
+1. minhash (jaccard of the character n-grams) or simhash (hamming distance) signatures of the normalized texts,
+   computed by the worker processes, and the candidate pairs are found by the lsh banding;
+2. embedding: the pairs whose cosine similarity of the embeddings >= threshold in the knn graph;
+3. the duplicate pairs are merged by the union-find, and the first text of each cluster is kept as the representative'''
+
+
+MINHASH_PRIME = 4294967291    # the largest prime < 2**32
+
+
+def normalize_for_dedup(text):
+    '''full-width -> half-width, lower case, no whitespace, and the runs of the same character (punctuation, emoticons) are collapsed'''
+    text = unicodedata.normalize('NFKC', text).lower()
+    chars = []
+    for c in text:
+        if c.isspace():
+            continue
+        if len(chars) > 0 and c == chars[-1]:
+            continue
+        chars.append(c)
+    return ''.join(chars)
+
+
+def char_ngrams(text, ngram=3):
+    if len(text) <= ngram:
+        return [text]
+    return [text[i:i+ngram] for i in range(len(text) - ngram + 1)]
+
+
+def shingle_hashes(text, ngram=3):
+    return np.array(sorted(set(zlib.crc32(g.encode('utf-8')) for g in char_ngrams(normalize_for_dedup(text), ngram))), dtype=np.uint64)
+
+
+def minhash_signatures(texts, ngram=3, num_perm=64, seed=0):
+    '''return the [N, num_perm] uint32 minhash signatures, (a*x+b) mod p fits in uint64 because x, a, b < 2**32'''
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.zeros((len(texts), num_perm), dtype=np.uint32)
+    for idx, text in enumerate(texts):
+        x = shingle_hashes(text, ngram)
+        signatures[idx] = ((x[:, None] * a[None, :] + b[None, :]) % MINHASH_PRIME).min(axis=0)
+    return signatures
+
+
+def simhash_signatures(texts, ngram=3):
+    '''return the [N] uint64 simhash fingerprints, the 64-bit hash of the n-gram is made of two crc32'''
+    bits = np.arange(64, dtype=np.uint64)
+    signatures = np.zeros(len(texts), dtype=np.uint64)
+    for idx, text in enumerate(texts):
+        grams = char_ngrams(normalize_for_dedup(text), ngram)
+        h = np.array([(zlib.crc32(g.encode('utf-8')) << 32) | zlib.crc32(g[::-1].encode('utf-8')) for g in grams], dtype=np.uint64)
+        votes = (((h[:, None] >> bits[None, :]) & np.uint64(1)).astype(np.int64) * 2 - 1).sum(axis=0)
+        signatures[idx] = (((votes > 0).astype(np.uint64)) << bits).sum()
+    return signatures
+
+
+def _signature_worker(params):
+    method, texts, ngram, num_perm, seed = params
+    if method == 'minhash':
+        return minhash_signatures(texts, ngram=ngram, num_perm=num_perm, seed=seed)
+    return simhash_signatures(texts, ngram=ngram)
+
+
+class UnionFind:
+
+    def __init__(self, size):
+        self.parent = np.arange(size)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # the smaller index is the root (the representative is the first text of the cluster)
+            self.parent[max(x, y)] = min(x, y)
+
+    def labels(self):
+        return np.array([self.find(i) for i in range(len(self.parent))])
+
+
+class NearDuplicateDetector:
+
+    '''method: minhash (threshold: jaccard, num_perm signatures in bands), simhash (threshold: max hamming distance)
+    or embedding (threshold: cosine of the knn neighbors)'''
+
+    def __init__(self, method='minhash', threshold=0.8, ngram=3, num_perm=64, bands=16, workers=8, chunk_size=10000, knn=10, seed=0):
+        assert method in ['minhash', 'simhash', 'embedding'], f'[!] Unknown near-duplicate method: {method}'
+        assert num_perm % bands == 0
+        self.method = method
+        self.threshold = threshold
+        self.ngram = ngram
+        self.num_perm = num_perm
+        self.bands = bands
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.knn = knn
+        self.seed = seed
+
+    def signatures(self, texts):
+        params = [(self.method, texts[i:i+self.chunk_size], self.ngram, self.num_perm, self.seed) for i in range(0, len(texts), self.chunk_size)]
+        if self.workers > 1 and len(params) > 1:
+            with Pool(self.workers) as pool:
+                chunks = list(tqdm(pool.imap(_signature_worker, params), total=len(params), desc=f'[!] {self.method}'))
+        else:
+            chunks = [_signature_worker(p) for p in tqdm(params, desc=f'[!] {self.method}')]
+        return np.concatenate(chunks)
+
+    def band_buckets(self, keys):
+        '''keys: [N, bands] band keys, yield the groups of the indexes that share one band bucket'''
+        for band in range(keys.shape[1]):
+            _, inverse, counts = np.unique(keys[:, band], return_inverse=True, return_counts=True)
+            order = np.argsort(inverse, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            for bucket in np.where(counts > 1)[0]:
+                yield order[offsets[bucket]:offsets[bucket+1]]
+
+    def merge_buckets(self, signatures, keys, match):
+        '''the candidates in the same bucket are verified with the first member of the bucket'''
+        uf = UnionFind(len(signatures))
+        for group in self.band_buckets(keys):
+            head, rest = group[0], group[1:]
+            for idx in rest[match(signatures[rest], signatures[head])]:
+                uf.union(head, idx)
+        return uf.labels()
+
+    def cluster_minhash(self, texts):
+        signatures = self.signatures(texts)
+        rows = self.num_perm // self.bands
+        bands = signatures.reshape(len(texts), self.bands, rows).astype(np.uint64)
+        # hash the rows of each band into one uint64 key (polynomial hash, the overflow wraps around)
+        keys = np.zeros((len(texts), self.bands), dtype=np.uint64)
+        for row in range(rows):
+            keys = keys * np.uint64(1000003) + bands[:, :, row]
+        return self.merge_buckets(
+            signatures, keys,
+            lambda rest, head: (rest == head[None, :]).mean(axis=-1) >= self.threshold
+        )
+
+    def cluster_simhash(self, texts):
+        signatures = self.signatures(texts)
+        # pigeonhole: the fingerprints within the hamming distance threshold share at least one of the threshold+1 blocks
+        blocks = int(self.threshold) + 1
+        block_bits = 64 // blocks
+        mask = np.uint64((1 << block_bits) - 1)
+        keys = np.stack([(signatures >> np.uint64(i * block_bits)) & mask for i in range(blocks)], axis=1)
+
+        def match(rest, head):
+            xor = rest ^ head
+            distance = np.array([bin(int(x)).count('1') for x in xor])
+            return distance <= self.threshold
+        return self.merge_buckets(signatures, keys, match)
+
+    def cluster_embedding(self, embds):
+        # the normalized copy, the embeddings of the index are not changed
+        embds = np.asarray(embds, dtype=np.float32)
+        embds = np.ascontiguousarray(embds / (np.linalg.norm(embds, axis=-1, keepdims=True) + 1e-8))
+        index = faiss.IndexFlatIP(embds.shape[1])
+        index.add(embds)
+        uf = UnionFind(len(embds))
+        for i in tqdm(range(0, len(embds), self.chunk_size), desc='[!] embedding'):
+            D, I = index.search(embds[i:i+self.chunk_size], self.knn + 1)
+            for row, (scores, neighbors) in enumerate(zip(D, I)):
+                for score, j in zip(scores, neighbors):
+                    if j != -1 and j != i + row and score >= self.threshold:
+                        uf.union(i + row, j)
+        return uf.labels()
+
+    def fit(self, texts, embds=None):
+        '''return the cluster labels [N] (the index of the representative of each text)'''
+        if self.method == 'minhash':
+            return self.cluster_minhash(texts)
+        elif self.method == 'simhash':
+            return self.cluster_simhash(texts)
+        assert embds is not None, f'[!] embedding method needs the embeddings'
+        return self.cluster_embedding(embds)
+
+
+def collapse_near_duplicates(args, embds, texts):
+    '''keep one representative for each cluster, and save the mapping (representative -> duplicates) into
+    data/<dataset>/<model>_<pretrained_model>_dedup_mapping.json; return the kept embeddings and texts'''
+    dedup_args = args['dedup']
+    detector = NearDuplicateDetector(
+        method=dedup_args['method'],
+        threshold=dedup_args['threshold'][dedup_args['method']],
+        ngram=dedup_args.get('ngram', 3),
+        num_perm=dedup_args.get('num_perm', 64),
+        bands=dedup_args.get('bands', 16),
+        workers=dedup_args.get('workers', 8),
+        knn=dedup_args.get('knn', 10),
+    )
+    labels = detector.fit(texts, embds=embds)
+    keep = np.where(labels == np.arange(len(labels)))[0]
+    mapping = {}
+    for idx, label in enumerate(labels.tolist()):
+        if idx != label:
+            mapping.setdefault(texts[label], []).append(texts[idx])
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/{args["model"]}_{pretrained_model_name}_dedup_mapping.json'
+    with open(path, 'w') as f:
+        json.dump(mapping, f, ensure_ascii=False, indent=4)
+    print(f'[!] collapse {len(texts)} responses into {len(keep)} clusters ({dedup_args["method"]}), save the mapping into {path}')
+    return embds[keep], [texts[i] for i in keep]
@@ -3,7 +3,8 @@ from header import *
 from .utils import *
 
 '''response strategy:
-Read the candidate embeddings and save it into the faiss index
+Read the candidate embeddings and save it into the faiss index;
+if dedup.method is set, all the embeddings are loaded and the near-duplicates are collapsed before the index is built
 '''
 
 def response_strategy(args):
@@ -33,7 +34,24 @@ def response_strategy(args):
                 break
         if current_num > 2000000:
             break
-    embds = np.concatenate(embds) 
+    dedup = args.get('dedup', {}).get('method')
+    if dedup:
+        for i in tqdm(range(40)):
+            for idx in range(100):
+                if (i, idx) in already_added:
+                    continue
+                try:
+                    embd, text = torch.load(
+                        f'{args["root_dir"]}/data/{args["dataset"]}/inference_{args["model"]}_{i}_{idx}.pt'
+                    )
+                except:
+                    break
+                embds.append(embd)
+                texts.extend(text)
+                already_added.append((i, idx))
+        embds, texts = collapse_near_duplicates(args, np.concatenate(embds), texts)
+    else:
+        embds = np.concatenate(embds) 
     searcher = Searcher(args['index_type'], dimension=args['dimension'])
     searcher._build(embds, texts, speedup=True)
     # searcher._build(embds, texts, speedup=False)
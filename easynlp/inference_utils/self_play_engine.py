@@ -0,0 +1,202 @@
+from inference import *
+from header import *
+from dataloader.utils import *
+from config import *
+from .utils import *
+
+'''
+parallel multi-session self-play engine to generate the additional data samples for training:
+1. thousands of sessions are advanced in lockstep, one batched context encoding and one faiss call per step;
+2. the utterance embeddings of the hierarchical models (HIERARCHICAL_ENCODERS) are cached per session,
+   only the new utterances of each step are encoded;
+3. each process (one per GPU, launched by torch.distributed.launch) plays its own shard of the start utterances,
+   the finished sessions are streamed into train_gen_{local_rank}.txt and combined into train_gen.txt.
+'''
+
+
+# the hierarchical encoders supported by the utterance embedding cache, and their utterance embeddings:
+# single: ctx_encoder(ids, ids_mask) [E]; multi-view: the first mv_num token embeddings of ctx_encoder(..., hidden=True) [V, E],
+# the context embeddings are fused by get_context_level_rep and normalized, the same as their get_ctx
+HIERARCHICAL_ENCODERS = {
+    'BERTDualHierarchicalTrsEncoder': 'single',
+    'BERTDualHierarchicalTrsGPT2Encoder': 'single',
+    'BERTDualHierarchicalTrsMVEncoder': 'multi-view',
+    'BERTDualHierarchicalTrsMVSAEncoder': 'multi-view',
+    'BERTDualHierarchicalGRUMVEncoder': 'multi-view',
+}
+
+
+class SelfPlayEngine:
+
+    def __init__(self, model, vocab, searcher, session_num=1024, turn_num=5, topk=5, snr_num=20, inner_bsz=512, hier_turn_num=4, hier_utterance_len=16, max_len=512):
+        self.model = model
+        self.vocab = vocab
+        self.searcher = searcher
+        self.session_num = session_num
+        self.turn_num = turn_num
+        self.topk = topk
+        self.snr_num = snr_num
+        self.inner_bsz = inner_bsz
+        self.hier_turn_num = hier_turn_num
+        self.hier_utterance_len = hier_utterance_len
+        self.max_len = max_len
+
+        model_name = type(model).__name__
+        self.view = HIERARCHICAL_ENCODERS.get(model_name)
+        self.hierarchical = self.view is not None
+        if not self.hierarchical and (not hasattr(model, 'get_ctx') or list(inspect.signature(model.get_ctx).parameters) != ['ids', 'attn_mask']):
+            raise Exception(f'[!] {model_name} is not supported by the self-play engine')
+        self.device = next(model.parameters()).device
+        print(f'[!] self-play engine: {session_num} sessions in lockstep; hierarchical context encoding: {self.view}')
+
+    def _pad(self, ids):
+        ids = pad_sequence([torch.LongTensor(i) for i in ids], batch_first=True, padding_value=self.vocab.pad_token_id)
+        ids_mask = generate_mask(ids, pad_token_idx=self.vocab.pad_token_id)
+        return ids.to(self.device), ids_mask.to(self.device)
+
+    @torch.no_grad()
+    def encode_hierarchical(self, sessions):
+        # 1. only encode the new utterances of each session
+        new_ids, owners = [], []
+        for session in sessions:
+            for tokens in session['tokens'][len(session['reps']):]:
+                new_ids.append([self.vocab.cls_token_id] + tokens[-self.hier_utterance_len:] + [self.vocab.sep_token_id])
+                owners.append(session)
+        for idx in range(0, len(new_ids), self.inner_bsz):
+            ids, ids_mask = self._pad(new_ids[idx:idx+self.inner_bsz])
+            if self.view == 'multi-view':
+                reps = self.model.ctx_encoder(ids, ids_mask, hidden=True)[:, :self.model.mv_num, :]    # [B, V, E]
+            else:
+                reps = self.model.ctx_encoder(ids, ids_mask).unsqueeze(1)    # [B, 1, E]
+            for session, rep in zip(owners[idx:idx+self.inner_bsz], reps):
+                session['reps'].append(rep)
+
+        # 2. fuse the cached utterance embeddings into the context embeddings
+        vectors = []
+        for idx in range(0, len(sessions), self.inner_bsz):
+            batch = sessions[idx:idx+self.inner_bsz]
+            # [turn_length*V, E] for each session
+            cid_reps = [torch.cat(session['reps'][-self.hier_turn_num:]) for session in batch]
+            turn_length = [len(session['reps'][-self.hier_turn_num:]) for session in batch]
+            cid_rep = self.model.get_context_level_rep(cid_reps, turn_length)
+            vectors.append(F.normalize(cid_rep, dim=-1))
+        return torch.cat(vectors)
+
+    @torch.no_grad()
+    def encode_flat(self, sessions):
+        vectors = []
+        for idx in range(0, len(sessions), self.inner_bsz):
+            ids = []
+            for session in sessions[idx:idx+self.inner_bsz]:
+                ids_ = []
+                for tokens in session['tokens']:
+                    ids_.extend(tokens + [self.vocab.sep_token_id])
+                ids_.pop()
+                ids.append([self.vocab.cls_token_id] + ids_[-self.max_len+2:] + [self.vocab.sep_token_id])
+            ids, ids_mask = self._pad(ids)
+            vectors.append(self.model.get_ctx(ids, ids_mask))
+        return torch.cat(vectors)
+
+    @torch.no_grad()
+    def step(self, sessions):
+        '''advance all the sessions by one turn, return the alive sessions'''
+        # tokenize the new utterances of all the sessions in one call
+        new_utterances, owners = [], []
+        for session in sessions:
+            for u in session['utterances'][len(session['tokens']):]:
+                new_utterances.append(u)
+                owners.append(session)
+        tokens = self.vocab.batch_encode_plus(new_utterances, add_special_tokens=False)['input_ids']
+        for session, t in zip(owners, tokens):
+            session['tokens'].append(t)
+
+        if self.hierarchical:
+            vectors = self.encode_hierarchical(sessions)
+        else:
+            vectors = self.encode_flat(sessions)
+        candidates = self.searcher._search(vectors.cpu().numpy().astype(np.float32), topk=self.topk)
+
+        alive = []
+        for session, candidate in zip(sessions, candidates):
+            history = set(session['utterances'])
+            # remove the duplicate utterances that appears in the conversation history
+            candidate = remove_duplicate_and_hold_the_order([remove_duplicate_punctuation(i) for i in candidate])
+            candidate = [i for i in candidate if i not in history]
+            if len(candidate) == 0:
+                continue
+            session['utterances'].append(candidate[0])
+            session['snr'] = candidate[1:self.snr_num+1]
+            alive.append(session)
+        return alive
+
+    def run(self, utterances, path, gen_num):
+        self.model.eval()
+        counter = 0
+        with open(path, 'w') as f, tqdm(total=gen_num) as pbar:
+            for idx in range(0, len(utterances), self.session_num):
+                sessions = [
+                    {'utterances': [remove_duplicate_punctuation(u)], 'tokens': [], 'reps': [], 'snr': []}
+                    for u in utterances[idx:idx+self.session_num]
+                ]
+                for _ in range(self.turn_num):
+                    sessions = self.step(sessions)
+                    if len(sessions) == 0:
+                        break
+                # stream the finished sessions into the disk
+                sessions = sessions[:gen_num-counter]
+                for session in sessions:
+                    us = session['utterances']
+                    string = json.dumps({'q': us[:-1], 'r': us[-1], 'snr': session['snr']})
+                    f.write(f'{string}\n')
+                f.flush()
+                counter += len(sessions)
+                pbar.update(len(sessions))
+                pbar.set_description(f'[!] collect {counter} self-play samples')
+                if counter >= gen_num:
+                    break
+        return counter
+
+
+def self_play_engine_strategy(args, agent):
+    # set the seed
+    random.seed(args['seed'])
+
+    # each process plays its own shard of the start utterances
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/train.txt'
+    utterances = load_utterances(args, path)
+    random.shuffle(utterances)
+
+    # read faiss index
+    model_name = args['model']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    searcher = Searcher(args['index_type'], dimension=args['dimension'], nprobe=args['index_nprobe'])
+    searcher.load(
+        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt',
+        f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
+    )
+    if torch.cuda.is_available():
+        # speed up with gpu
+        searcher.move_to_gpu(device=args['local_rank'])
+    print(f'[!] read the faiss index over, begin to self-play')
+
+    engine = SelfPlayEngine(
+        agent.model.module,
+        agent.vocab,
+        searcher,
+        session_num=args['self_play_session_num'],
+        turn_num=args['gen_dataset_ctx_length'],
+        topk=args['gen_dataset_topk'],
+    )
+    path = f'{args["root_dir"]}/data/{args["dataset"]}/train_gen_{args["local_rank"]}.txt'
+    num = engine.run(utterances, path, args['gen_dataset_num'])
+    print(f'[!] self-play generate {num} samples, save into {path}')
+
+    torch.distributed.barrier()
+    if args['local_rank'] == 0:
+        path = f'{args["root_dir"]}/data/{args["dataset"]}/train_gen.txt'
+        with open(path, 'w') as fw:
+            for i in range(dist.get_world_size()):
+                with open(f'{args["root_dir"]}/data/{args["dataset"]}/train_gen_{i}.txt') as f:
+                    for line in f:
+                        fw.write(line)
+        print(f'[!] combine the self-play samples of {dist.get_world_size()} processes into {path}')
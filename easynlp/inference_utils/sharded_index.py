@@ -0,0 +1,124 @@
+from inference import *
+from header import *
+from .utils import *
+
+'''sharded response strategy (inference.py --sharded_index):
+each rank builds and saves the faiss index shard of the candidate embeddings it produced,
+and the rank 0 only writes the shard manifest (data/<dataset>/<model>_<pretrained_model>_shards.json);
+the ShardedSearcher loads all the shards of the manifest, searches each of them and merges the topk by the distance.
+the near-duplicate collapsing (dedup) needs the whole corpus, so it is not applied to the shards
+'''
+
+
+def shard_paths(args, rank):
+    model_name = args['model']
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    prefix = f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}'
+    return f'{prefix}_faiss_shard{rank}.ckpt', f'{prefix}_corpus_shard{rank}.ckpt'
+
+
+def shard_manifest_path(args):
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    return f'{args["root_dir"]}/data/{args["dataset"]}/{args["model"]}_{pretrained_model_name}_shards.json'
+
+
+class ShardedSearcher:
+
+    '''the q-r matching searcher over the index shards, the ids of the shards are offset into one global corpus'''
+
+    def __init__(self, index_type, dimension=768, nprobe=1):
+        self.index_type = index_type
+        self.dimension = dimension
+        self.nprobe = nprobe
+        self.shards = []
+        self.offsets = []
+        self.corpus = []
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def load(self, path_manifest):
+        with open(path_manifest) as f:
+            manifest = json.load(f)
+        for shard in manifest['shards']:
+            searcher = Searcher(self.index_type, dimension=self.dimension, nprobe=self.nprobe)
+            searcher.load(shard['faiss'], shard['corpus'])
+            self.offsets.append(len(self.corpus))
+            self.corpus.extend(searcher.corpus)
+            self.shards.append(searcher)
+        print(f'[!] load {len(self.shards)} index shards with {len(self.corpus)} utterances from {path_manifest}')
+
+    def _search_dis(self, vector, topk=20):
+        '''search each shard and merge the topk candidates with the smallest distances'''
+        D, I = [], []
+        for offset, shard in zip(self.offsets, self.shards):
+            shard.searcher.nprobe = self.nprobe
+            d, i = shard.searcher.search(vector, topk)
+            D.append(d)
+            I.append(np.where(i == -1, -1, i + offset))
+        D, I = np.concatenate(D, axis=1), np.concatenate(I, axis=1)
+        order = np.argsort(D, axis=1, kind='stable')[:, :topk]
+        D, I = np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+        rest = [[self.corpus[i] for i in N if i != -1] for N in I]
+        distance = [[d for d, i in zip(M, N) if i != -1] for M, N in zip(D, I)]
+        return rest, distance
+
+    def _search(self, vector, topk=20):
+        return self._search_dis(vector, topk=topk)[0]
+
+    def move_to_gpu(self, device=0):
+        for shard in self.shards:
+            shard.move_to_gpu(device=device)
+
+    def move_to_cpu(self):
+        for shard in self.shards:
+            shard.move_to_cpu()
+
+
+def load_sharded_searcher(args):
+    searcher = ShardedSearcher(args['index_type'], dimension=args['dimension'], nprobe=args['index_nprobe'])
+    searcher.load(shard_manifest_path(args))
+    return searcher
+
+
+def sharded_response_strategy(args):
+    '''run by all the ranks, the rank r builds the shard of the inference files of the ranks r, r+world_size, ...'''
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    embds, texts = [], []
+    for i in range(rank, 32, world_size):
+        for idx in range(100):
+            path = f'{args["root_dir"]}/data/{args["dataset"]}/inference_{args["model"]}_{i}_{idx}.pt'
+            if not os.path.exists(path):
+                break
+            embd, text = torch.load(path)
+            print(f'[!] load {path}')
+            embds.append(embd)
+            texts.extend(text)
+    if args.get('dedup', {}).get('method'):
+        print(f'[!] dedup is ignored by the sharded index, which needs the whole corpus')
+
+    path_faiss, path_corpus = shard_paths(args, rank)
+    shard = {'rank': rank, 'faiss': path_faiss, 'corpus': path_corpus, 'size': len(texts)}
+    if len(texts) > 0:
+        searcher = Searcher(args['index_type'], dimension=args['dimension'])
+        # train the shard on the gpu of this rank
+        searcher.move_to_gpu(device=args['local_rank'])
+        searcher._build(np.concatenate(embds), texts, speedup=False)
+        searcher.move_to_cpu()
+        searcher.save(path_faiss, path_corpus)
+        print(f'[!] rank {rank} save the index shard of {len(texts)} samples')
+
+    # the rank 0 writes the manifest of the shards
+    shards = [None for _ in range(world_size)]
+    dist.all_gather_object(shards, shard)
+    if rank == 0:
+        shards = [s for s in shards if s['size'] > 0]
+        with open(shard_manifest_path(args), 'w') as f:
+            json.dump({
+                'index_type': args['index_type'],
+                'dimension': args['dimension'],
+                'size': sum(s['size'] for s in shards),
+                'shards': shards,
+            }, f, ensure_ascii=False, indent=4)
+        print(f'[!] save the manifest of {len(shards)} index shards into {shard_manifest_path(args)}')
+    dist.barrier()
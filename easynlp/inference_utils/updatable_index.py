@@ -0,0 +1,364 @@
+from header import *
+from contextlib import contextmanager
+import threading
+import shutil
+
+'''updatable faiss index for the online corpus changes:
+1. the vectors are stored in the IndexIDMap2 with the stable int64 ids, the texts are stored in the id -> text dict;
+2. add and delete are appended into the write-ahead log (wal) before they are applied, and replayed on the restore;
+3. delete only marks the ids as the tombstones, which are filtered in _search;
+4. the compaction removes the tombstones from the index, writes the snapshot and truncates the wal,
+   and runs periodically in the background thread;
+5. each snapshot (index.faiss, meta.ckpt) is written into its own versioned folder (snapshot_000001, ...), and the
+   manifest file CURRENT is switched to it by one rename, so the index and the meta of the restore are always consistent;
+6. the searches share the read lock and run in parallel, the updates hold the write lock, and the snapshot writes the live index
+   under the read lock (the updates wait, the searches do not)'''
+
+
+class ReadWriteLock:
+
+    '''the readers share the lock and the writer holds it exclusively, the write lock is reentrant for its owner thread;
+    the waiting writer blocks the new readers, so the updates are not starved by the continuous searches'''
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers, self.waiting_writers = 0, 0
+        self.writer, self.depth = None, 0
+
+    @contextmanager
+    def read(self):
+        owner = threading.get_ident() == self.writer
+        if not owner:
+            with self.condition:
+                while self.writer is not None or self.waiting_writers > 0:
+                    self.condition.wait()
+                self.readers += 1
+        try:
+            yield
+        finally:
+            if not owner:
+                with self.condition:
+                    self.readers -= 1
+                    if self.readers == 0:
+                        self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        ident = threading.get_ident()
+        with self.condition:
+            if self.writer == ident:
+                self.depth += 1
+            else:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers > 0:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer, self.depth = ident, 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+def current_snapshot(path):
+    '''the folder of the snapshot that the manifest points to, None if there is no snapshot'''
+    try:
+        with open(f'{path}/CURRENT') as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return f'{path}/{name}' if name else None
+
+
+def snapshot_files(path):
+    '''the index, meta and wal files of the updatable index folder, None if there is no snapshot'''
+    snapshot = current_snapshot(path)
+    if snapshot is None:
+        return None
+    return [f'{snapshot}/index.faiss', f'{snapshot}/meta.ckpt', f'{path}/wal.pkl']
+
+
+class UpdatableSearcher:
+
+    def __init__(self, index_type='Flat', dimension=768, nprobe=1, path=None, compact_interval=300, compact_ratio=0.1, fsync=False):
+        '''path: folder of the snapshots (CURRENT, snapshot_*/index.faiss, snapshot_*/meta.ckpt) and the wal (wal.pkl)'''
+        self.index_type = index_type
+        self.dimension = dimension
+        self.nprobe = nprobe
+        self.path = path
+        self.compact_interval = compact_interval
+        # compact if the tombstones are more than compact_ratio of the index
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self.searcher = faiss.IndexIDMap2(faiss.index_factory(dimension, index_type, faiss.METRIC_L2))
+        self.texts = {}
+        self.text_ids = {}
+        self.tombstones = set()
+        self.next_id, self.seq = 0, 0
+        # seq of the last snapshot
+        self.snapshot_seq = 0
+        self.snapshot_version = 0
+        self.lock = ReadWriteLock()
+        # only one snapshot is written at a time
+        self.snapshot_lock = threading.Lock()
+        self.wal = None
+        self.compaction_thread = None
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def set_nprobe(self):
+        '''the nprobe of the IVF index inside the IndexIDMap2'''
+        try:
+            faiss.ParameterSpace().set_index_parameter(self.searcher, 'nprobe', self.nprobe)
+        except RuntimeError:
+            pass
+
+    @property
+    def corpus(self):
+        return [self.texts[i] for i in sorted(self.texts) if i not in self.tombstones]
+
+    def __len__(self):
+        return len(self.texts) - len(self.tombstones)
+
+    def _build(self, matrix, corpus, speedup=False):
+        '''train the index (IVF) and add the initial corpus, the ids are 0...N-1'''
+        with self.lock.write():
+            if not self.searcher.is_trained:
+                self.searcher.train(matrix)
+                self.set_nprobe()
+            self.add(matrix, corpus)
+        print(f'[!] build updatable collection with {self.searcher.ntotal} samples')
+
+    def import_searcher(self, searcher, chunk_size=100000):
+        '''import the vectors and the texts of the Searcher (q-r matching), the index should support the reconstruct'''
+        assert searcher.init_reconstruct(), f'[!] {searcher.index_type} index cannot reconstruct the vectors'
+        self.searcher = faiss.IndexIDMap2(faiss.index_factory(self.dimension, self.index_type, faiss.METRIC_L2))
+        for idx in tqdm(range(0, len(searcher.corpus), chunk_size)):
+            ids = range(idx, min(idx + chunk_size, len(searcher.corpus)))
+            matrix = searcher.reconstruct(list(ids))
+            if not self.searcher.is_trained:
+                self.searcher.train(matrix)
+                self.set_nprobe()
+            self.apply_add(np.asarray(ids, dtype=np.int64), matrix, searcher.corpus[idx:idx+chunk_size])
+        self.next_id = len(searcher.corpus)
+        print(f'[!] import {len(self)} samples from the {searcher.index_type} searcher')
+
+    # ========== write-ahead log ========== #
+    def open_wal(self):
+        if self.wal is None and self.path:
+            self.wal = open(f'{self.path}/wal.pkl', 'ab')
+
+    def log(self, record):
+        if self.path is None:
+            return
+        self.open_wal()
+        self.seq += 1
+        record['seq'] = self.seq
+        pickle.dump(record, self.wal, protocol=pickle.HIGHEST_PROTOCOL)
+        self.wal.flush()
+        if self.fsync:
+            os.fsync(self.wal.fileno())
+
+    def replay(self):
+        path = f'{self.path}/wal.pkl'
+        if not os.path.exists(path):
+            return 0
+        counter = 0
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError):
+                    # the last record is broken by the crash during the write
+                    print(f'[!] ignore the broken tail of the wal {path}')
+                    break
+                if record['seq'] <= self.seq:
+                    continue
+                if record['op'] == 'add':
+                    self.apply_add(record['ids'], record['vectors'], record['texts'])
+                    self.next_id = max(self.next_id, int(record['ids'].max()) + 1)
+                else:
+                    self.apply_delete(record['ids'])
+                self.seq = record['seq']
+                counter += 1
+        return counter
+
+    # ========== updates ========== #
+    def apply_add(self, ids, vectors, texts):
+        self.searcher.add_with_ids(vectors, ids)
+        for i, text in zip(ids.tolist(), texts):
+            self.texts[i] = text
+            self.text_ids.setdefault(text, set()).add(i)
+
+    def apply_delete(self, ids):
+        for i in ids:
+            if i in self.texts:
+                self.tombstones.add(i)
+
+    def add(self, vectors, texts):
+        '''return the ids of the new texts'''
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        assert len(vectors) == len(texts)
+        with self.lock.write():
+            ids = np.arange(self.next_id, self.next_id + len(texts), dtype=np.int64)
+            self.log({'op': 'add', 'ids': ids, 'vectors': vectors, 'texts': list(texts)})
+            self.apply_add(ids, vectors, texts)
+            self.next_id += len(texts)
+        return ids.tolist()
+
+    def delete(self, ids=None, texts=None):
+        '''delete by the ids or by the texts, return the deleted ids'''
+        with self.lock.write():
+            ids = set(ids or [])
+            for text in texts or []:
+                ids |= self.text_ids.get(text, set())
+            ids = [i for i in ids if i in self.texts and i not in self.tombstones]
+            if len(ids) > 0:
+                self.log({'op': 'delete', 'ids': ids})
+                self.apply_delete(ids)
+        return ids
+
+    # ========== search ========== #
+    def _search_ids(self, vector, topk=20):
+        '''the deleted ids are filtered, more candidates are searched to fill the topk'''
+        # the searches share the read lock, faiss search does not change the index
+        with self.lock.read():
+            k = min(topk + len(self.tombstones), max(self.searcher.ntotal, 1))
+            D, I = self.searcher.search(np.ascontiguousarray(vector, dtype=np.float32), k)
+            ids = [[int(i) for i in N if i != -1 and i not in self.tombstones][:topk] for N in I]
+            rest = [[self.texts[i] for i in N] for N in ids]
+        return ids, rest
+
+    def _search(self, vector, topk=20):
+        return self._search_ids(vector, topk=topk)[1]
+
+    # ========== compaction and snapshot ========== #
+    def compact(self):
+        '''remove the tombstones from the index and write the snapshot'''
+        with self.lock.write():
+            if len(self.tombstones) > 0:
+                ids = np.asarray(sorted(self.tombstones), dtype=np.int64)
+                self.searcher.remove_ids(faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids)))
+                for i in ids.tolist():
+                    text = self.texts.pop(i)
+                    self.text_ids[text].discard(i)
+                    if len(self.text_ids[text]) == 0:
+                        del self.text_ids[text]
+                print(f'[!] compact {len(ids)} deleted samples, {self.searcher.ntotal} samples remain')
+                self.tombstones = set()
+        if self.path:
+            self.snapshot()
+
+    def snapshot(self):
+        '''write the live index and the meta into the new snapshot folder under the read lock (the updates wait, the searches
+        do not), then switch the manifest to it and drop the wal records before the offset of the snapshot'''
+        with self.snapshot_lock:
+            version = self.snapshot_version + 1
+            name = f'snapshot_{version:06d}'
+            folder = f'{self.path}/{name}'
+            if os.path.exists(folder):
+                # the incomplete folder of the crashed snapshot
+                shutil.rmtree(folder)
+            os.makedirs(folder)
+            with self.lock.read():
+                faiss.write_index(self.searcher, f'{folder}/index.faiss')
+                with open(f'{folder}/meta.ckpt', 'wb') as f:
+                    joblib.dump({
+                        'texts': self.texts,
+                        'tombstones': self.tombstones,
+                        'next_id': self.next_id,
+                        'seq': self.seq,
+                        'index_type': self.index_type,
+                    }, f)
+                seq, size = self.seq, len(self)
+                # the records after the offset are appended after the snapshot
+                offset = os.path.getsize(f'{self.path}/wal.pkl') if os.path.exists(f'{self.path}/wal.pkl') else 0
+
+            with self.lock.write():
+                with open(f'{self.path}/CURRENT.tmp', 'w') as f:
+                    f.write(name)
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(f'{self.path}/CURRENT.tmp', f'{self.path}/CURRENT')
+                self.snapshot_version = version
+                self.truncate_wal(offset)
+                self.snapshot_seq = seq
+            self.remove_stale_snapshots(name)
+            print(f'[!] save the snapshot of {size} samples (seq {seq}) into {folder}')
+
+    def truncate_wal(self, offset):
+        '''keep the wal records after the offset (the records are appended after the snapshot)'''
+        path = f'{self.path}/wal.pkl'
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+        tail = b''
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(tail)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+    def remove_stale_snapshots(self, current):
+        for name in os.listdir(self.path):
+            if name.startswith('snapshot_') and name != current:
+                shutil.rmtree(f'{self.path}/{name}', ignore_errors=True)
+
+    def restore(self):
+        '''load the snapshot of the manifest and replay the wal, return False if there is no snapshot'''
+        snapshot = current_snapshot(self.path)
+        if snapshot is None:
+            return False
+        with self.lock.write():
+            self.searcher = faiss.read_index(f'{snapshot}/index.faiss')
+            self.set_nprobe()
+            with open(f'{snapshot}/meta.ckpt', 'rb') as f:
+                meta = joblib.load(f)
+            self.texts, self.tombstones = meta['texts'], meta['tombstones']
+            self.next_id, self.seq = meta['next_id'], meta['seq']
+            self.snapshot_seq = self.seq
+            self.snapshot_version = int(os.path.basename(snapshot).split('_')[-1])
+            self.text_ids = {}
+            for i, text in self.texts.items():
+                self.text_ids.setdefault(text, set()).add(i)
+            counter = self.replay()
+        print(f'[!] restore {len(self)} samples from {snapshot} (replay {counter} wal records)')
+        return True
+
+    def start_compaction(self):
+        '''compact periodically if the tombstones are more than compact_ratio of the index,
+        otherwise write the snapshot if there are the wal records'''
+        def run():
+            while True:
+                time.sleep(self.compact_interval)
+                try:
+                    if len(self.tombstones) > self.compact_ratio * max(len(self.texts), 1):
+                        self.compact()
+                    elif self.path and self.seq > self.snapshot_seq:
+                        self.snapshot()
+                except Exception as error:
+                    print(f'[!] compaction failed: {error}')
+        if self.compaction_thread is None:
+            self.compaction_thread = threading.Thread(target=run, name='index-compaction', daemon=True)
+            self.compaction_thread.start()
+
+    def describe(self):
+        return {
+            'size': len(self),
+            'index_size': self.searcher.ntotal,
+            'tombstones': len(self.tombstones),
+            'next_id': self.next_id,
+            'seq': self.seq,
+        }
@@ -78,6 +78,37 @@ class Searcher:
             rest = [[self.corpus[i] for i in N] for N in I]
         return rest
 
+    def _search_ids(self, vector, topk=20):
+        '''return the ids and the texts of the topk candidates (q-r matching),
+        the ids could be used to fetch the stored vectors by the reconstruct'''
+        self.searcher.nprobe = self.nprobe
+        D, I = self.searcher.search(vector, topk)
+        ids = [[i for i in N if i != -1] for N in I]
+        rest = [[self.corpus[i] for i in N] for N in ids]
+        return ids, rest
+
+    def init_reconstruct(self):
+        '''the IVF index needs the direct map to reconstruct the vectors by ids, the flat index supports it natively;
+        the reconstructed vectors are exact for the Flat/IVF-Flat index and approximate for the PQ index'''
+        if self.binary:
+            return False
+        try:
+            faiss.extract_index_ivf(self.searcher).make_direct_map()
+        except RuntimeError:
+            pass
+        try:
+            self.searcher.reconstruct(0)
+        except RuntimeError:
+            return False
+        return True
+
+    def reconstruct(self, ids):
+        '''return the stored vectors [N, E] of the given ids'''
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.zeros((0, self.searcher.d), dtype=np.float32)
+        return self.searcher.reconstruct_batch(ids)
+
     def save(self, path_faiss, path_corpus, path_source_corpus=None):
         if self.binary and self.index_type != 'LSH':
             faiss.write_index_binary(self.searcher, path_faiss)
@@ -118,6 +149,143 @@ class Searcher:
         print(f'[!] move index from GPU to CPU over')
 
 
+class ColBERTSearcher:
+
+    '''End-to-end retrieval for the late interaction models (colbert/colbertv2):
+    1. the token embeddings of the candidates are compressed into the centroid id and the int8 residual;
+    2. candidate generation: each query token probes its nprobe nearest centroids, the candidates
+       that own the tokens of these centroids are collected and ranked by the centroid scores;
+    3. the top candidate_size candidates are decompressed and scored by the padding-aware MaxSim.'''
+
+    def __init__(self, dimension=768, centroid_num=16384, nprobe=8, candidate_size=1024):
+        self.dimension = dimension
+        self.centroid_num = centroid_num
+        self.nprobe = nprobe
+        self.candidate_size = candidate_size
+        self.corpus = []
+
+    def _build(self, embds, lengths, corpus, speedup=False, chunk_size=1000000):
+        '''embds: [T, E] flattened token embeddings; lengths: [N] token number of each candidate'''
+        self.corpus = corpus
+        embds = embds.astype(np.float32)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        assert len(lengths) == len(corpus) and lengths.sum() == len(embds)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        # 1. train the centroids on the sampled token embeddings
+        self.centroid_num = min(self.centroid_num, len(embds))
+        sample_size = min(len(embds), 256 * self.centroid_num)
+        sample = embds[np.random.choice(len(embds), sample_size, replace=False)]
+        kmeans = faiss.Kmeans(self.dimension, self.centroid_num, niter=20, spherical=True, gpu=speedup)
+        kmeans.train(sample)
+        self.centroids = kmeans.centroids.astype(np.float32)
+        self._init_centroid_index()
+
+        # 2. compress the token embeddings: centroid id and int8 residual
+        self.codes = np.zeros(len(embds), dtype=np.int32)
+        for i in tqdm(range(0, len(embds), chunk_size)):
+            _, I = self.centroid_index.search(embds[i:i+chunk_size], 1)
+            self.codes[i:i+chunk_size] = I[:, 0]
+        self.scale = np.zeros(self.dimension, dtype=np.float32)
+        for i in range(0, len(embds), chunk_size):
+            residual = embds[i:i+chunk_size] - self.centroids[self.codes[i:i+chunk_size]]
+            self.scale = np.maximum(self.scale, np.abs(residual).max(axis=0))
+        self.scale = np.maximum(self.scale / 127., 1e-8)
+        self.residuals = np.zeros((len(embds), self.dimension), dtype=np.int8)
+        for i in range(0, len(embds), chunk_size):
+            residual = embds[i:i+chunk_size] - self.centroids[self.codes[i:i+chunk_size]]
+            self.residuals[i:i+chunk_size] = np.clip(np.rint(residual / self.scale), -127, 127)
+
+        # 3. inverted lists: centroid -> unique candidate ids
+        doc_ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        pairs = np.unique(self.codes.astype(np.int64) * len(lengths) + doc_ids)
+        codes, self.ivf_docs = pairs // len(lengths), (pairs % len(lengths)).astype(np.int32)
+        self.ivf_offsets = np.searchsorted(codes, np.arange(self.centroid_num+1))
+        print(f'[!] build colbert collection with {len(self.corpus)} samples and {len(embds)} tokens')
+
+    def _init_centroid_index(self):
+        self.centroid_index = faiss.IndexFlatIP(self.dimension)
+        self.centroid_index.add(self.centroids)
+
+    def decompress(self, doc_ids):
+        '''return the padded token embeddings [N, S, E] and the masks [N, S] of the candidates'''
+        begin, end = self.offsets[doc_ids], self.offsets[doc_ids+1]
+        lengths = end - begin
+        token_idx = np.repeat(begin - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        embds = self.centroids[self.codes[token_idx]] + self.residuals[token_idx] * self.scale
+        embds /= np.linalg.norm(embds, axis=-1, keepdims=True) + 1e-8
+        mask = np.arange(lengths.max())[None, :] < lengths[:, None]
+        rep = np.zeros((len(doc_ids), lengths.max(), self.dimension), dtype=np.float32)
+        rep[mask] = embds
+        return torch.from_numpy(rep), torch.from_numpy(mask.astype(np.int64))
+
+    def generate_candidates(self, q_rep, scores, centroids):
+        '''q_rep: [S_q, E]; scores, centroids: [S_q, nprobe];
+        the approximate score of a candidate is the sum of the max centroid scores over query tokens'''
+        begin, end = self.ivf_offsets[centroids.reshape(-1)], self.ivf_offsets[centroids.reshape(-1)+1]
+        lengths = end - begin
+        if lengths.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        idx = np.repeat(begin - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        docs = self.ivf_docs[idx]
+        tokens = np.repeat(np.repeat(np.arange(len(q_rep)), centroids.shape[1]), lengths)
+        values = np.repeat(scores.reshape(-1), lengths)
+        docs, local_docs = np.unique(docs, return_inverse=True)
+        approx = np.full((len(q_rep), len(docs)), 0., dtype=np.float32)
+        np.maximum.at(approx, (tokens, local_docs), values)
+        approx = approx.sum(axis=0)
+        if len(docs) > self.candidate_size:
+            index = np.argpartition(-approx, self.candidate_size)[:self.candidate_size]
+            docs = docs[index]
+        return docs.astype(np.int64)
+
+    def _search(self, vectors, masks, topk=20, inner_bsz=256):
+        '''vectors: [B, S, E] query token embeddings; masks: [B, S]'''
+        rest = []
+        for vector, mask in zip(vectors, masks):
+            q_rep = vector[mask.astype(bool)].astype(np.float32)    # [S_q, E]
+            D, I = self.centroid_index.search(q_rep, self.nprobe)
+            docs = self.generate_candidates(q_rep, D, I)
+            cid_rep = torch.from_numpy(q_rep).unsqueeze(0)
+            cid_mask = torch.ones(1, len(q_rep), dtype=torch.long)
+            scores = []
+            for i in range(0, len(docs), inner_bsz):
+                rid_rep, rid_mask = self.decompress(docs[i:i+inner_bsz])
+                scores.append(colbert_maxsim(cid_rep, rid_rep, cid_mask, rid_mask).squeeze(0))
+            if len(scores) == 0:
+                rest.append([])
+                continue
+            scores = torch.cat(scores)
+            index = scores.topk(min(topk, len(scores)))[1].tolist()
+            rest.append([self.corpus[docs[i]] for i in index])
+        return rest
+
+    def save(self, path_index, path_corpus):
+        with open(path_index, 'wb') as f:
+            joblib.dump({
+                'centroids': self.centroids,
+                'codes': self.codes,
+                'residuals': self.residuals,
+                'scale': self.scale,
+                'offsets': self.offsets,
+                'ivf_offsets': self.ivf_offsets,
+                'ivf_docs': self.ivf_docs,
+            }, f)
+        with open(path_corpus, 'wb') as f:
+            joblib.dump(self.corpus, f)
+
+    def load(self, path_index, path_corpus):
+        with open(path_index, 'rb') as f:
+            index = joblib.load(f)
+        for key, value in index.items():
+            setattr(self, key, value)
+        self.centroid_num = len(self.centroids)
+        self._init_centroid_index()
+        with open(path_corpus, 'rb') as f:
+            self.corpus = joblib.load(f)
+        print(f'[!] load {len(self.corpus)} utterances and {len(self.codes)} tokens from {path_index} and {path_corpus}')
+
+
 def init_recall(args):
     searcher = Searcher(args['index_type'], dimension=args['dimension'], with_source=args['with_source'], nprobe=args['index_nprobe'])
     model_name = args['model']
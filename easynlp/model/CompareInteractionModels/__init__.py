@@ -2,6 +2,7 @@ from .bert_ft_compare import *
 from .dual_bert_scm_mutual import *
 from .bert_ft_scm import *
 from .bert_ft_compare_multi import *
+from .compare_engine import *
 from .agent import *
 from .dual_bert_compare import *
 from .dual_bert_comp import *
@@ -26,6 +26,13 @@ class CompareInteractionAgent(RetrievalBaseAgent):
         if args['mode'] in ['train', 'inference']:
             self.set_optimizer_scheduler_ddp()
 
+        # batched and memoized pairwise comparison, shared by all the compare-based rerank methods
+        self.compare_engine = PairwiseComparisonEngine(
+            self,
+            inner_bsz=self.args.get('compare_inner_bsz', 128),
+            memory_size=self.args.get('compare_memory_size', 200000),
+        )
+
         if args['model'] in ['dual-bert-scm', 'dual-bert-scm-hn', 'dual-bert-scm-hn-mch', 'dual-bert-scm-hn-with-easy', 'dual-bert-scm-hn-dist', 'dual-bert-scm-hn-dm', 'dual-bert-scm-hn-topk', 'dual-bert-scm-compare', 'dual-bert-scm-sdl', 'dual-bert-scm-hn-pos', 'dual-bert-scm-hn-g', 'dual-bert-scm-hn-dm', 'dual-bert-scm-mutual']:
             if self.args['is_step_for_training']:
                 self.train_model = self.train_model_step
@@ -333,50 +340,19 @@ class CompareInteractionAgent(RetrievalBaseAgent):
     @torch.no_grad()
     def compare_one_turn(self, cids, rids, tickets, margin=0.0, soft=False):
         '''Each item pair in the tickets (i, j), the i has the bigger scores than j'''
-        ids, tids, speaker_ids, recoder = [], [], [], []
-        cpids = []
-        for i, j in tickets:
-            cids_, rids1, rids2 = deepcopy(cids), deepcopy(rids[i]), deepcopy(rids[j])
-            truncate_pair_two_candidates(cids_, rids1, rids2, self.args['max_len'])
-            ids_ = [self.cls] + cids_ + [self.sep] + rids1 + [self.sep] + rids2 + [self.sep]
-            cpids_ = [0] * (len(cids_) + 2) + [1] * (len(rids1) + 1)  + [2] * (len(rids2) + 1)
-            tids_ = [0] * (len(cids_) + 2) + [1] * (len(rids1) + 1) + [1] * (len(rids2) + 1)
-            ids.append(ids_)
-            cpids.append(cpids_)
-            tids.append(tids_)
-            recoder.append((i, j))
-        ids = [torch.LongTensor(i) for i in ids]
-        cpids = [torch.LongTensor(i) for i in cpids]
-        tids = [torch.LongTensor(i) for i in tids]
-        ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-        cpids = pad_sequence(cpids, batch_first=True, padding_value=self.pad)
-        tids = pad_sequence(tids, batch_first=True, padding_value=self.pad)
-        mask = generate_mask(ids)
-        ids, tids, cpids, mask = to_cuda(ids, tids, cpids, mask)
-        # ===== make compare ===== # 
-        batch_packup = {
-            'ids': ids,
-            'tids': tids,
-            'cpids': cpids,
-            'mask': mask,
-        }
-        if self.args['mode'] == 'train':
-            comp_scores = self.model.module.predict(batch_packup)    # [B, 3]
-        else:
-            comp_scores = self.model.predict(batch_packup)    # [B, 3]
-        comp_scores = comp_scores.tolist()
-        
+        comp_scores = self.compare_engine.compare([(cids, rids, tickets)])[0]
+        recoder = list(tickets)
         if soft:
             return comp_scores, recoder
+        return self.judge_comparisons(comp_scores, recoder, margin=margin)
 
-        # binary classification
+    def judge_comparisons(self, comp_scores, recoder, margin=0.0):
+        # binary classification, the ambiguous pairs are dropped
         comp_label, n_recoder = [], []
         for s, (i, j) in zip(comp_scores, recoder):
-            if s[1] >= margin + s[0]:
-                comp_label.append(True)
-                n_recoder.append((i, j))
-            elif s[1] < s[0] - margin:
-                comp_label.append(False)
+            l = self.compare_engine.judge(s, margin=margin)
+            if l is not None:
+                comp_label.append(l)
                 n_recoder.append((i, j))
         return comp_label, n_recoder
 
@@ -463,26 +439,37 @@ class CompareInteractionAgent(RetrievalBaseAgent):
             scores = self.generate_scores_propagate_with_edge_weight(chain)
         return scores
 
-    @torch.no_grad()
-    def fully_compare(self, batch):
-        self.model.eval() 
-        pos_margin = self.args['positive_margin']
+    def _prepare_compare_inputs(self, batch):
         items = self.convert_text_to_ids(batch['context'] + batch['responses'])
-        cids_ = items[:len(batch['context'])]
+        length = len(batch['context'])
         cids = []
-        for u in cids_:
+        for u in items[:length]:
             cids.extend(u + [self.eos])
         cids.pop()
-        rids = items[len(batch['context']):]
-        tickets = []
-        for i in range(len(rids)):
-            for j in range(len(rids)):
-                if i != j:
-                    tickets.append((i, j))
-        soft = False
-        # label, recoder = self.compare_one_turn(cids, sids, rids, tickets, margin=pos_margin, soft=soft)
-        label, recoder = self.compare_one_turn(cids, rids, tickets, margin=pos_margin, soft=soft)
-        if soft is False:
+        rids = items[length:]
+        return cids, rids
+
+    @torch.no_grad()
+    def fully_compare(self, batch):
+        return self.fully_compare_batch([batch])[0]
+
+    @torch.no_grad()
+    def fully_compare_batch(self, batches):
+        '''compare all the candidate pairs of the multiple requests in the same cross-encoder calls;
+        the ranking method is set by the `compare_rank_method`: counter, pagerank or topo'''
+        self.model.eval() 
+        pos_margin = self.args['positive_margin']
+        rank_method = self.args.get('compare_rank_method', 'counter')
+        requests = []
+        for batch in batches:
+            cids, rids = self._prepare_compare_inputs(batch)
+            tickets = [(i, j) for i in range(len(rids)) for j in range(len(rids)) if i != j]
+            requests.append((cids, rids, tickets))
+        comp_scores = self.compare_engine.compare(requests)
+
+        rest = []
+        for (_, rids, tickets), s in zip(requests, comp_scores):
+            label, recoder = self.judge_comparisons(s, tickets, margin=pos_margin)
             chain = {i: [] for i in range(len(rids))}
             # key is bigger than values
             for l, (i, j) in zip(label, recoder):
@@ -490,31 +477,14 @@ class CompareInteractionAgent(RetrievalBaseAgent):
                     chain[i].append(j)
                 else:
                     chain[j].append(i)
-            # topological sort scorer
-            # scores, valid = self.generate_scores(chain)
-            # scores = self.generate_scores(chain)
-            # return scores
-            # if valid:
-            #     return scores
-            # else:
-            #     return None
-            # pagerank scorer
-            # scores = self.generate_scores_pagerank(chain)
-            scores = self.generate_scores_counter(chain)
-        else:
-            chain = {i: [] for i in range(len(rids))}
-            for s, (i, j) in zip(label, recoder):
-                chain[i].append(s[1])
-                chain[j].append(s[0])
-            scores = [np.mean(chain[i]) for i in range(len(chain))] 
-            # propagation scorer
-            # chain = torch.zeros(len(rids), len(rids))
-            # for l, (i, j) in zip(label, recoder):
-            #     # advantage from i to j
-            #     chain[i, j] = l
-            #     chain[j, i] = 1-l
-            # scores = self.generate_scores_propagate_with_edge_weight(chain)
-        return scores
+            if rank_method == 'pagerank':
+                scores = self.generate_scores_pagerank(chain).tolist()
+            elif rank_method == 'topo':
+                scores = self.generate_scores(chain)
+            else:
+                scores = self.generate_scores_counter(chain)
+            rest.append(scores)
+        return rest
 
     @torch.no_grad()
     def compare_evaluation(self, test_iter):
@@ -549,77 +519,107 @@ class CompareInteractionAgent(RetrievalBaseAgent):
         }
         output the updated scores for the batch, the order of the responses should not be changed, only the scores are changed.
         '''
+        return self.compare_reorder_batch([batch])[0]
+
+    @torch.no_grad()
+    def compare_reorder_batch(self, batches):
+        '''run the compare rounds of the multiple requests in lockstep, the tickets of all the requests
+        in one round are packed into the same cross-encoder calls by the compare engine;
+        if `compare_time_budget` (seconds) is set, the rest rounds are skipped once the budget is used up'''
         self.model.eval() 
         compare_turn_num = self.args['compare_turn_num']
         pos_margin = self.args['positive_margin']
-        scores = batch['scores']
-        length = len(batch['context'])
-        items = self.convert_text_to_ids(batch['context'] + batch['responses'])
-        cids_, rids = items[:length], items[length:]
-        cids, sids, cache = [], [], 0
-        for u in cids_:
-            cids.extend(u + [self.eos])
-            sids.extend([cache] * (len(u) + 1))
-            cache = 1 if cache == 0 else 0
-        sids.pop()
-        cids.pop()
+        time_budget = self.args.get('compare_time_budget', None)
+        bt = time.time()
 
-        # sort the rids (decrease order)
-        order = np.argsort(scores)[::-1].tolist()
-        backup_map = {o:i for i, o in enumerate(order)}    # old:new
-        rids = [rids[i] for i in order]
-        scores = [scores[i] for i in order]
+        states = []
+        for batch in batches:
+            cids, rids = self._prepare_compare_inputs(batch)
+            scores = batch['scores']
+            # sort the rids (decrease order)
+            order = np.argsort(scores)[::-1].tolist()
+            states.append({
+                'cids': cids,
+                'rids': [rids[i] for i in order],
+                'scores': [scores[i] for i in order],
+                'backup_map': {o:i for i, o in enumerate(order)},    # old:new
+                'before_dict': {i:i-1 for i in range(len(rids))},
+                'done': False,
+            })
 
-        # tickets to the comparsion function
-        before_dict = {i:i-1 for i in range(len(rids))}
         for idx in range(compare_turn_num):
-            tickets = []
-            if idx == 0:
-                for i in range(len(rids)):
-                    if before_dict[i] != -1:
-                        tickets.append((before_dict[i], i))
-            else:
-                # find conflict
-                counter = [[] for _ in range(len(rids))]
-                for i in range(len(rids)):
-                    b = before_dict[i]
-                    if b != -1:
-                        counter[b].append(i)
-                # collect confliction tickets
-                for pair in counter:
-                    if len(pair) == 2:
-                        i, j = pair
-                        if scores[i] < scores[j]:
-                            tickets.append((j, i))
-                        else:
-                            tickets.append((i, j))
-                    elif len(pair) > 2:
-                        raise Exception()
-            # abort
-            if len(tickets) == 0:
+            if time_budget is not None and time.time() - bt > time_budget:
+                break
+            requests, active = [], []
+            for state in states:
+                if state['done']:
+                    continue
+                tickets = self._collect_reorder_tickets(state, idx)
+                # abort
+                if len(tickets) == 0:
+                    state['done'] = True
+                    continue
+                requests.append((state['cids'], state['rids'], tickets))
+                active.append(state)
+            if len(requests) == 0:
                 break
 
-            label, recoder = self.compare_one_turn(cids, sids, rids, tickets, margin=pos_margin)
-            d = {j:i for l, (i, j) in zip(label, recoder) if l is False}
-            d = sorted(list(d.items()), key=lambda x:x[0])    # left to right
-            for j, i in d:
-                # put the j before i (plus the scores)
-                s_j, s_i = scores[j], scores[i]
-                # get before score
-                if before_dict[i] == -1:
-                    s_i_before = scores[i] + 2.
-                else:
-                    s_i_before = scores[before_dict[i]]
-                delta = s_i_before - s_i
-                delta_s = random.uniform(0, delta)
-                scores[j] = s_i + delta_s    # bigger than s_i but lower than s_i_before
-                # change the before dict
-                before_dict[j] = before_dict[i]
-                before_dict[i] = j
+            comp_scores = self.compare_engine.compare(requests)
+            for state, (_, _, tickets), s in zip(active, requests, comp_scores):
+                label, recoder = self.judge_comparisons(s, tickets, margin=pos_margin)
+                self._update_reorder_scores(state, label, recoder)
 
         # backup the scores
-        scores = [scores[backup_map[i]] for i in range(len(order))]
-        return scores
+        rest = []
+        for state in states:
+            scores, backup_map = state['scores'], state['backup_map']
+            rest.append([scores[backup_map[i]] for i in range(len(scores))])
+        return rest
+
+    def _collect_reorder_tickets(self, state, idx):
+        rids, scores, before_dict = state['rids'], state['scores'], state['before_dict']
+        tickets = []
+        if idx == 0:
+            for i in range(len(rids)):
+                if before_dict[i] != -1:
+                    tickets.append((before_dict[i], i))
+        else:
+            # find conflict
+            counter = [[] for _ in range(len(rids))]
+            for i in range(len(rids)):
+                b = before_dict[i]
+                if b != -1:
+                    counter[b].append(i)
+            # collect confliction tickets
+            for pair in counter:
+                if len(pair) == 2:
+                    i, j = pair
+                    if scores[i] < scores[j]:
+                        tickets.append((j, i))
+                    else:
+                        tickets.append((i, j))
+                elif len(pair) > 2:
+                    raise Exception()
+        return tickets
+
+    def _update_reorder_scores(self, state, label, recoder):
+        scores, before_dict = state['scores'], state['before_dict']
+        d = {j:i for l, (i, j) in zip(label, recoder) if l is False}
+        d = sorted(list(d.items()), key=lambda x:x[0])    # left to right
+        for j, i in d:
+            # put the j before i (plus the scores)
+            s_j, s_i = scores[j], scores[i]
+            # get before score
+            if before_dict[i] == -1:
+                s_i_before = scores[i] + 2.
+            else:
+                s_i_before = scores[before_dict[i]]
+            delta = s_i_before - s_i
+            delta_s = random.uniform(0, delta)
+            scores[j] = s_i + delta_s    # bigger than s_i but lower than s_i_before
+            # change the before dict
+            before_dict[j] = before_dict[i]
+            before_dict[i] = j
 
     def convert_text_to_ids(self, texts):
         items = self.vocab.batch_encode_plus(texts, add_special_tokens=False)['input_ids']
@@ -1034,12 +1034,11 @@ class CompareInteractionAgent(RetrievalBaseAgent):
     @torch.no_grad()
     def rerank(self, batches, inner_bsz=2048):
         self.model.eval()
-        scores = []
-        for batch in tqdm(batches):
+        for batch in batches:
             assert len(batch['candidates']) <= 50
             batch['responses'] = batch['candidates']
-            s = self.fully_compare(batch)
-            scores.append(s)
+        # the candidate pairs of all the batches are compared together
+        scores = self.fully_compare_batch(batches)
         return scores
     
     @torch.no_grad()
@@ -0,0 +1,107 @@
+from model.utils import *
+from dataloader.util_func import *
+
+
+class PairwiseComparisonEngine:
+
+    '''Batched and memoized pairwise comparison for the CompareInteraction agent:
+    the tickets (i, j) of all the concurrent requests are packed into the same cross-encoder calls
+    (sorted by the length to reduce the padding), and the comparison scores are memoized by
+    (context, candidate_i, candidate_j) with the LRU eviction.
+
+    The comparison score of (i, j) is the raw output of the model.predict:
+        1. float: the probability that candidate i is better than candidate j;
+        2. list: the [negative, positive, ...] classification scores of candidate i over candidate j'''
+
+    def __init__(self, agent, inner_bsz=128, memory_size=200000):
+        self.agent = agent
+        self.inner_bsz = inner_bsz
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.hit, self.miss = 0, 0
+
+    def _key(self, cids, rids1, rids2):
+        return (tuple(cids), tuple(rids1), tuple(rids2))
+
+    def _remember(self, key, score):
+        self.memory[key] = score
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    @torch.no_grad()
+    def _predict(self, pairs):
+        '''pairs: a list of (cids, rids1, rids2); return the comparison scores'''
+        items = [self.agent._packup(cids, rids1, rids2) for cids, rids1, rids2 in pairs]
+        order = sorted(range(len(items)), key=lambda i: len(items[i][0]))
+        if self.agent.args['mode'] == 'train':
+            model = self.agent.model.module
+        else:
+            model = self.agent.model
+        scores = [None] * len(items)
+        for idx in range(0, len(order), self.inner_bsz):
+            index = order[idx:idx+self.inner_bsz]
+            ids = pad_sequence([items[i][0] for i in index], batch_first=True, padding_value=self.agent.pad)
+            tids = pad_sequence([items[i][1] for i in index], batch_first=True, padding_value=self.agent.pad)
+            cpids = pad_sequence([items[i][2] for i in index], batch_first=True, padding_value=self.agent.pad)
+            mask = generate_mask(ids)
+            ids, tids, cpids, mask = to_cuda(ids, tids, cpids, mask)
+            batch = {
+                'ids': ids,
+                'tids': tids,
+                'cpids': cpids,
+                'pids': cpids,
+                'mask': mask,
+            }
+            rest = model.predict(batch).tolist()
+            for i, s in zip(index, rest):
+                scores[i] = s
+        return scores
+
+    def compare(self, requests):
+        '''requests: a list of (cids, rids, tickets);
+        return the comparison scores of the tickets for each request'''
+        keys, results, pending = [], {}, OrderedDict()
+        for cids, rids, tickets in requests:
+            sub = []
+            for i, j in tickets:
+                key = self._key(cids, rids[i], rids[j])
+                sub.append(key)
+                if key in results or key in pending:
+                    continue
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    results[key] = self.memory[key]
+                else:
+                    pending[key] = (cids, rids[i], rids[j])
+            keys.append(sub)
+        if len(pending) > 0:
+            scores = self._predict(list(pending.values()))
+            for key, s in zip(pending.keys(), scores):
+                results[key] = s
+                self._remember(key, s)
+        total = sum([len(sub) for sub in keys])
+        self.miss += len(pending)
+        self.hit += total - len(pending)
+        return [[results[key] for key in sub] for sub in keys]
+
+    def judge(self, score, margin=0.0):
+        '''True: candidate i wins; False: candidate j wins; None: ambiguous'''
+        if type(score) == list:
+            s_neg, s_pos = score[0], score[1]
+        else:
+            s_neg, s_pos = 1 - score, score
+        if s_pos >= s_neg + margin:
+            return True
+        elif s_pos < s_neg - margin:
+            return False
+        return None
+
+    def stat(self):
+        total = self.hit + self.miss
+        return {
+            'hit': self.hit,
+            'miss': self.miss,
+            'hit_ratio': round(self.hit / total, 4) if total > 0 else 0.,
+            'memory_size': len(self.memory),
+        }
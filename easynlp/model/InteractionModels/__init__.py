@@ -1,4 +1,5 @@
 from .bert_ft import *
+from .bert_ft_early_exit import *
 from .bert_ft_mutual import *
 from .bart_ft import *
 from .bert_ft_hier import *
@@ -7,7 +7,7 @@ class InteractionAgent(RetrievalBaseAgent):
         self.args = args
         self.vocab, self.model = vocab, model
 
-        if self.args['model'] in ['bert-fp-original', 'bert-ft']:
+        if self.args['model'] in ['bert-fp-original', 'bert-ft', 'bert-ft-early-exit']:
             self.vocab.add_tokens(['[EOS]'])
             self.eos = self.vocab.convert_tokens_to_ids('[EOS]')
         self.cls = self.vocab.convert_tokens_to_ids('[CLS]')
@@ -31,19 +31,32 @@ class InteractionAgent(RetrievalBaseAgent):
             self.train_model = self.train_ibns_model
         elif self.args['model'] in ['bert-ft-hier']:
             self.train_model = self.train_model_hier
+        if self.args['model'] in ['bert-ft-early-exit']:
+            self.test_model = self.test_model_early_exit
 
         if self.args['is_step_for_training']:
             self.train_model = self.train_model_step
 
         self.criterion = nn.CrossEntropyLoss()
         self.show_parameters(self.args)
+
+    def early_exit_loss(self, outputs, label):
+        '''outputs: logits of the exits and the last layer; the exit losses are weighted by early_exit_loss_weight'''
+        loss = self.criterion(outputs[-1], label)
+        for logits in outputs[:-1]:
+            loss += self.args['early_exit_loss_weight'] * self.criterion(logits, label)
+        return loss
         
     def train_model_step(self, batch, recoder=None, current_step=0, pbar=None):
         self.model.train()
         self.optimizer.zero_grad()
         with autocast():
             output = self.model(batch)
-            loss = self.criterion(output, batch['label'])
+            if self.args['model'] in ['bert-ft-early-exit']:
+                loss = self.early_exit_loss(output, batch['label'])
+                output = output[-1]
+            else:
+                loss = self.criterion(output, batch['label'])
             acc = (output.max(dim=-1)[1] == batch['label']).to(torch.float).mean().item()
         self.scaler.scale(loss).backward()
         self.scaler.unscale_(self.optimizer)
@@ -72,6 +85,11 @@ class InteractionAgent(RetrievalBaseAgent):
                 elif self.args['model'] in ['bert-ft-compare-plus']:
                     label = batch['label']
                     loss = self.model(batch)
+                elif self.args['model'] in ['bert-ft-early-exit']:
+                    outputs = self.model(batch)
+                    label = batch['label']
+                    loss = self.early_exit_loss(outputs, label)
+                    output = outputs[-1]
                 else:
                     # bert-ft
                     output = self.model(batch)    # [B]
@@ -131,20 +149,22 @@ class InteractionAgent(RetrievalBaseAgent):
     def test_model(self, test_iter, print_output=False, rerank_agent=None, core_time=False):
         self.model.eval()
         pbar = tqdm(test_iter)
-        total_mrr, total_prec_at_one, total_map = 0, 0, 0
-        total_examples, total_correct = 0, 0
-        k_list = [1, 2, 5, 10]
+        # the metrics are accumulated on device and computed once at the end
+        metric = RerankMetric(multi_positive=self.args['dataset'] in ["douban", "restoration-200k"])
         core_time_rest = 0
         for idx, batch in enumerate(pbar):
             label = batch['label']
             if core_time:
                 bt = time.time()
-            scores = F.softmax(self.model(batch), dim=-1)[:, 1].cpu().tolist()
+            scores = F.softmax(self.model(batch), dim=-1)[:, 1]
             if core_time:
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
                 et = time.time()
                 core_time_rest += et - bt
 
             if rerank_agent:
+                scores = scores.cpu().tolist()
                 scores_ = []
                 counter = 0
                 for i in tqdm(range(0, len(scores), 100)):
@@ -165,49 +185,62 @@ class InteractionAgent(RetrievalBaseAgent):
             
             # print output
             if print_output:
+                scores = scores.tolist() if torch.is_tensor(scores) else scores
                 for ids, score in zip(batch['ids'], scores):
                     text = self.convert_to_text(ids, lang=self.args['lang'])
                     score = round(score, 4)
                     self.log_save_file.write(f'[Score {score}] {text}\n')
                 self.log_save_file.write('\n')
             
-            rank_by_pred, pos_index, stack_scores = \
-          calculate_candidates_ranking(
-                np.array(scores), 
-                np.array(label.cpu().tolist()),
-                10)
-            num_correct = logits_recall_at_k(pos_index, k_list)
-            if self.args['dataset'] in ["douban", "restoration-200k"]:
-                total_prec_at_one += precision_at_one(rank_by_pred)
-                total_map += mean_average_precision(pos_index)
-                for pred in rank_by_pred:
-                    if sum(pred) == 0:
-                        total_examples -= 1
-            total_mrr += logits_mrr(pos_index)
-            total_correct = np.add(total_correct, num_correct)
-            total_examples += math.ceil(label.size()[0] / 10)
-        avg_mrr = float(total_mrr / total_examples)
-        avg_prec_at_one = float(total_prec_at_one / total_examples)
-        avg_map = float(total_map / total_examples)
+            metric.add(scores, label)
+
+        outputs = metric.compute()
         if core_time:
-            return {
-                f'R10@{k_list[0]}': round(((total_correct[0]/total_examples)*100), 2),        
-                f'R10@{k_list[1]}': round(((total_correct[1]/total_examples)*100), 2),        
-                f'R10@{k_list[2]}': round(((total_correct[2]/total_examples)*100), 2),        
-                'MRR': round(100*avg_mrr, 2),
-                'P@1': round(100*avg_prec_at_one, 2),
-                'MAP': round(100*avg_map, 2),
-                'core_time': core_time_rest,
-            }
-        else:
-            return {
-                f'R10@{k_list[0]}': round(((total_correct[0]/total_examples)*100), 2),        
-                f'R10@{k_list[1]}': round(((total_correct[1]/total_examples)*100), 2),        
-                f'R10@{k_list[2]}': round(((total_correct[2]/total_examples)*100), 2),        
-                'MRR': round(100*avg_mrr, 2),
-                'P@1': round(100*avg_prec_at_one, 2),
-                'MAP': round(100*avg_map, 2),
-            }
+            outputs['core_time'] = core_time_rest
+        return outputs
+
+    @torch.no_grad()
+    def test_model_early_exit(self, test_iter, print_output=False, rerank_agent=None, core_time=False):
+        '''R10@k of the full model (all the layers), and R10@k, average exit layer and speedup of each
+        (neg_threshold, pos_threshold) in early_exit_test_thresholds (only in test mode)'''
+        self.model.eval()
+        multi_positive = self.args['dataset'] in ["douban", "restoration-200k"]
+        thresholds = [(None, None)]
+        if self.args['mode'] == 'test':
+            thresholds += [tuple(t) for t in self.args['early_exit_test_thresholds']]
+        num_layers = self.model.model.config.num_hidden_layers
+        outputs, full_time = {}, None
+        for neg_threshold, pos_threshold in thresholds:
+            metric = RerankMetric(multi_positive=multi_positive)
+            exit_layers, cost_time = [], 0
+            for batch in tqdm(test_iter):
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                bt = time.time()
+                if neg_threshold is None:
+                    scores = F.softmax(self.model(batch)[-1], dim=-1)[:, 1]
+                    exit_layer = torch.full_like(scores, num_layers)
+                else:
+                    scores, exit_layer = self.model.predict_early_exit(batch, neg_threshold, pos_threshold)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                cost_time += time.time() - bt
+                metric.add(scores, batch['label'])
+                exit_layers.append(exit_layer.float())
+            rest = metric.compute()
+            avg_exit_layer = torch.cat(exit_layers).mean().item()
+            if neg_threshold is None:
+                full_time = cost_time
+                outputs.update(rest)
+                outputs['Full-Time'] = f'{round(1000 * cost_time / len(test_iter), 2)} ms'
+                continue
+            name = f'EarlyExit[{neg_threshold},{pos_threshold}]'
+            for key, value in rest.items():
+                outputs[f'{name}-{key}'] = value
+            outputs[f'{name}-AvgExitLayer'] = round(avg_exit_layer, 2)
+            outputs[f'{name}-Time'] = f'{round(1000 * cost_time / len(test_iter), 2)} ms'
+            outputs[f'{name}-Speedup'] = round(full_time / max(cost_time, 1e-6), 2)
+        return outputs
 
     @torch.no_grad()
     def rerank_and_return(self, batches, rank_num=64, keep_num=5, score_threshold=0.2, score_threshold_positive=0.7):
@@ -325,7 +358,13 @@ class InteractionAgent(RetrievalBaseAgent):
                 candidates = batch['candidates'][idx:idx+inner_bsz]
                 ids, tids, mask = self.totensor_interaction(batch['context'], candidates)
                 batch['ids'], batch['tids'], batch['mask'] = ids, tids, mask
-                subscores.extend(F.softmax(self.model(batch), dim=-1)[:, 1].tolist())
+                with trace_span('rerank_forward'):
+                    if self.args['model'] in ['bert-ft-early-exit']:
+                        logits, _ = self.model.predict_early_exit(batch)
+                    else:
+                        logits = F.softmax(self.model(batch), dim=-1)[:, 1]
+                with trace_span('device_to_host'):
+                    subscores.extend(logits.tolist())
             scores.append(subscores)
         return scores
     
@@ -0,0 +1,76 @@
+from model.utils import *
+
+class BERTEarlyExitRetrieval(nn.Module):
+
+    '''bert-ft with the light classifiers after the intermediate layers (early_exit_layers):
+    during rerank, the pairs whose positive probability is already below the neg_threshold or above the pos_threshold
+    stop at the exit, only the ambiguous pairs go deeper into the following layers'''
+
+    def __init__(self, **args):
+        super(BERTEarlyExitRetrieval, self).__init__()
+        model = args['pretrained_model']
+        # bert-fp pre-trained model need to resize the token embedding
+        self.model = BertForSequenceClassification.from_pretrained(model, num_labels=2)
+        self.model.resize_token_embeddings(self.model.config.vocab_size+1)
+        self.vocab = AutoTokenizer.from_pretrained(model)
+        self.exit_layers = args['early_exit_layers']
+        hidden_size = self.model.config.hidden_size
+        self.exit_heads = nn.ModuleList([
+            nn.Sequential(
+                nn.Dropout(p=0.1),
+                nn.Linear(hidden_size, 2)
+            ) for _ in self.exit_layers
+        ])
+        self.neg_threshold = args['early_exit_neg_threshold']
+        self.pos_threshold = args['early_exit_pos_threshold']
+        self.args = args
+
+        total = sum([param.nelement() for param in self.parameters()])
+        print('[!] Model Size: %2fM' % (total/1e6))
+
+    def forward(self, batch):
+        '''return the logits of the exits and the last layer: a list of [B, 2]'''
+        output = self.model(
+            input_ids=batch['ids'],
+            attention_mask=batch['mask'],
+            token_type_ids=batch['tids'],
+            output_hidden_states=True,
+        )
+        # hidden_states[0] is the output of the embeddings
+        hidden_states = output['hidden_states']
+        logits = [head(hidden_states[layer][:, 0, :]) for layer, head in zip(self.exit_layers, self.exit_heads)]
+        logits.append(output['logits'])
+        return logits
+
+    @torch.no_grad()
+    def predict_early_exit(self, batch, neg_threshold=None, pos_threshold=None):
+        '''return the positive probabilities [B] and the number of the layers that each pair runs [B]'''
+        neg_threshold = self.neg_threshold if neg_threshold is None else neg_threshold
+        pos_threshold = self.pos_threshold if pos_threshold is None else pos_threshold
+        bert = self.model.bert
+        ids, tids, mask = batch['ids'], batch['tids'], batch['mask']
+        hidden = bert.embeddings(input_ids=ids, token_type_ids=tids)
+        attention_mask = bert.get_extended_attention_mask(mask, ids.size(), ids.device)
+        scores = torch.zeros(len(ids), device=ids.device)
+        exit_layer = torch.full((len(ids),), len(bert.encoder.layer), dtype=torch.long, device=ids.device)
+        # indexes of the pairs that are still running
+        active = torch.arange(len(ids), device=ids.device)
+        heads = dict(zip(self.exit_layers, self.exit_heads))
+        for layer_idx, layer in enumerate(bert.encoder.layer):
+            hidden = layer(hidden, attention_mask=attention_mask)[0]
+            layer_num = layer_idx + 1
+            if layer_num not in heads:
+                continue
+            probs = F.softmax(heads[layer_num](hidden[:, 0, :]), dim=-1)[:, 1]
+            done = (probs < neg_threshold) | (probs > pos_threshold)
+            scores[active[done]] = probs[done]
+            exit_layer[active[done]] = layer_num
+            keep = ~done
+            active, hidden, attention_mask = active[keep], hidden[keep], attention_mask[keep]
+            if len(active) == 0:
+                return scores, exit_layer
+        # the ambiguous pairs use the original classifier of the last layer
+        pooled = bert.pooler(hidden)
+        logits = self.model.classifier(self.model.dropout(pooled))
+        scores[active] = F.softmax(logits, dim=-1)[:, 1]
+        return scores, exit_layer
@@ -8,6 +8,8 @@ class LatentInteractionAgent(RetrievalBaseAgent):
         self.vocab, self.model = vocab, model
 
         self.pad, self.sep, self.cls = self.vocab.convert_tokens_to_ids(['[PAD]', '[SEP]', '[CLS]'])
+        # precomputed candidate embeddings (poly-encoder), loaded by load_candidate_cache
+        self.candidate_cache = None
 
         if args['mode'] == 'train':
             self.set_test_interval()
@@ -229,6 +231,8 @@ class LatentInteractionAgent(RetrievalBaseAgent):
     @torch.no_grad()
     def rerank(self, batches, inner_bsz=512):
         self.model.eval()
+        if self.candidate_cache is not None:
+            return self.rerank_with_cache(batches, inner_bsz=inner_bsz)
         scores = []
         for batch in tqdm(batches):
             subscores = []
@@ -243,3 +247,99 @@ class LatentInteractionAgent(RetrievalBaseAgent):
                 subscores.extend(self.model.predict(batch).tolist())
             scores.append(subscores)
         return scores
+
+    @torch.no_grad()
+    def inference(self, inf_iter, size=500000):
+        '''inference the token embeddings of the candidates for the colbert index;
+        the token embeddings are flattened (padding tokens are dropped) and saved in float16'''
+        self.model.eval()
+        pbar = tqdm(inf_iter)
+        embds, lengths, texts = [], [], []
+        for batch in pbar:
+            rid = batch['ids']
+            rid_mask = batch['mask']
+            text = batch['text']
+            res = self.model.module.get_cand(rid, rid_mask)    # [B, S, E]
+            embds.append(res[rid_mask.to(torch.bool)].half().cpu())    # [T, E]
+            lengths.extend(rid_mask.sum(dim=-1).tolist())
+            texts.extend(text)
+        embds = torch.cat(embds, dim=0).numpy()
+        lengths = np.array(lengths, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        for idx, i in enumerate(range(0, len(texts), size)):
+            embd = embds[offsets[i]:offsets[min(i+size, len(texts))]]
+            length = lengths[i:i+size]
+            text = texts[i:i+size]
+            torch.save(
+                (embd, length, text), 
+                f'{self.args["root_dir"]}/data/{self.args["dataset"]}/inference_{self.args["model"]}_{self.args["local_rank"]}_{idx}.pt'
+            )
+
+    @torch.no_grad()
+    def encode_queries(self, texts):
+        '''return the token embeddings of the queries and their masks for ColBERTSearcher'''
+        self.model.eval()
+        ids, ids_mask = self.totensor(texts, ctx=True)
+        vectors = self.model.get_ctx(ids, ids_mask)    # [B, S, E]
+        return vectors.cpu().numpy(), ids_mask.cpu().numpy()
+
+    @torch.no_grad()
+    def inference_candidate_cache(self, inf_iter, size=500000):
+        '''inference the candidate embeddings of the poly-encoder for the candidate cache'''
+        self.model.eval()
+        pbar = tqdm(inf_iter)
+        embds, texts = [], []
+        for batch in pbar:
+            rid = batch['ids']
+            rid_mask = batch['mask']
+            text = batch['text']
+            res = self.model.module.get_cand(rid, rid_mask).cpu()
+            embds.append(res)
+            texts.extend(text)
+        embds = torch.cat(embds, dim=0).numpy()
+
+        for idx, i in enumerate(range(0, len(embds), size)):
+            embd = embds[i:i+size]
+            text = texts[i:i+size]
+            torch.save(
+                (embd, text), 
+                f'{self.args["root_dir"]}/data/{self.args["dataset"]}/inference_{self.args["model"]}_{self.args["local_rank"]}_{idx}.pt'
+            )
+
+    def load_candidate_cache(self, path_cache, path_corpus):
+        self.candidate_cache = CandidateEmbeddingCache()
+        self.candidate_cache.load(path_cache, path_corpus)
+
+    def get_candidate_embeddings(self, candidates, candidate_ids=None, inner_bsz=512):
+        '''look up the candidates by the corpus ids, the candidates that are not in the cache are encoded on the fly'''
+        if candidate_ids is None:
+            candidate_ids = self.candidate_cache.lookup(candidates)
+        hit = [i for i, cid in enumerate(candidate_ids) if cid >= 0]
+        miss = [i for i, cid in enumerate(candidate_ids) if cid < 0]
+        rid_rep = torch.zeros(len(candidates), self.candidate_cache.embeddings.shape[1])
+        if torch.cuda.is_available():
+            rid_rep = rid_rep.cuda()
+        if hit:
+            cached = torch.from_numpy(self.candidate_cache.get([candidate_ids[i] for i in hit]))
+            rid_rep[hit] = cached.to(rid_rep.device)
+        for idx in range(0, len(miss), inner_bsz):
+            index = miss[idx:idx+inner_bsz]
+            rid, rid_mask = self.totensor([candidates[i] for i in index], ctx=False)
+            rid_rep[index] = self.model.get_cand(rid, rid_mask).to(rid_rep.dtype)
+        return rid_rep
+
+    @torch.no_grad()
+    def rerank_with_cache(self, batches, inner_bsz=512):
+        '''only the context encoding and the poly-code attention run at the query time;
+        batch['candidate_ids'] (optional) are the corpus ids of the candidates'''
+        scores = []
+        for batch in batches:
+            cid, cid_mask = self.totensor([batch['context']], ctx=True)
+            rid_rep = self.get_candidate_embeddings(
+                batch['candidates'], 
+                candidate_ids=batch.get('candidate_ids', None),
+                inner_bsz=inner_bsz
+            )
+            scores.append(self.model.predict_with_cache(cid, cid_mask, rid_rep).tolist())
+        return scores
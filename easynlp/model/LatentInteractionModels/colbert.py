@@ -1,6 +1,25 @@
 from model.utils import *
 
 
+def colbert_maxsim(cid_rep, rid_rep, cid_mask, rid_mask, paired=False):
+    '''vectorized and padding-aware MaxSim (late interaction):
+        cid_rep: [B_c, S_c, E]; cid_mask: [B_c, S_c]
+        rid_rep: [B_r, S_r, E]; rid_mask: [B_r, S_r]
+    if paired is True, B_c == B_r and the i-th context only interacts with the i-th candidate, return [B];
+    else, all the contexts interact with all the candidates, return [B_c, B_r]'''
+    if paired:
+        dp = torch.bmm(cid_rep, rid_rep.permute(0, 2, 1))    # [B, S_c, S_r]
+        dp = dp.masked_fill(rid_mask.unsqueeze(1) == 0, -np.inf)
+        dp = dp.max(dim=-1)[0]    # [B, S_c]
+        dp = dp.masked_fill(cid_mask == 0, 0.)
+    else:
+        dp = torch.einsum('ase,bte->abst', cid_rep, rid_rep)    # [B_c, B_r, S_c, S_r]
+        dp = dp.masked_fill(rid_mask[None, :, None, :] == 0, -np.inf)
+        dp = dp.max(dim=-1)[0]    # [B_c, B_r, S_c]
+        dp = dp.masked_fill(cid_mask.unsqueeze(1) == 0, 0.)
+    return dp.sum(dim=-1)
+
+
 class ColBERTEncoder(nn.Module):
     
     def __init__(self, **args):
@@ -11,36 +30,25 @@ class ColBERTEncoder(nn.Module):
         self.criterion = nn.CrossEntropyLoss()
         
     def _encode(self, cid, rid, nrid, cid_mask, rid_mask, nrid_mask):
-        batch_size = len(cid)
         cid_rep = self.ctx_encoder(cid, cid_mask, hidden=True)    # [B_c, S, E]
         rid_rep = self.can_encoder(rid, rid_mask, hidden=True)    # [B_r, S, E]
         nrid_rep = self.can_encoder(nrid, nrid_mask, hidden=True)  # [B_r, S, E]
         cid_rep, rid_rep, nrid_rep = F.normalize(cid_rep, dim=-1), F.normalize(rid_rep, dim=-1), F.normalize(nrid_rep, dim=-1)
-        # scores
-        scores = torch.bmm(cid_rep, rid_rep.permute(0, 2, 1))    # [B*B, S_c, S_r]
-        rid_length = rid_mask.sum(dim=-1).tolist()
-        for idx in range(batch_size):
-            scores[idx, :, rid_length[idx]:] = -np.inf
-        scores = scores.max(dim=-1)[0]
-        cid_length = cid_mask.sum(dim=-1).tolist()
-        rest = []
-        for idx in range(batch_size):
-            s = scores[idx, :cid_length[idx]].sum()
-            rest.append(s)
-        rest = torch.stack(rest)
-        # scores
-        scores = torch.bmm(cid_rep, nrid_rep.permute(0, 2, 1))    # [B, S_c, S_r]
-        rid_length = nrid_mask.sum(dim=-1).tolist()
-        for idx in range(batch_size):
-            scores[idx, :, rid_length[idx]:] = -np.inf
-        scores = scores.max(dim=-1)[0]
-        cid_length = cid_mask.sum(dim=-1).tolist()
-        nrest = []
-        for idx in range(batch_size):
-            s = scores[idx, :cid_length[idx]].sum()
-            nrest.append(s)
-        nrest = torch.stack(nrest)
+        rest = colbert_maxsim(cid_rep, rid_rep, cid_mask, rid_mask, paired=True)    # [B]
+        nrest = colbert_maxsim(cid_rep, nrid_rep, cid_mask, nrid_mask, paired=True)    # [B]
         return rest, nrest
+
+    @torch.no_grad()
+    def get_ctx(self, ids, attn_mask):
+        cid_rep = self.ctx_encoder(ids, attn_mask, hidden=True)
+        cid_rep = F.normalize(cid_rep, dim=-1)
+        return cid_rep    # [B, S, E]
+
+    @torch.no_grad()
+    def get_cand(self, ids, attn_mask):
+        rid_rep = self.can_encoder(ids, attn_mask, hidden=True)
+        rid_rep = F.normalize(rid_rep, dim=-1)
+        return rid_rep    # [B, S, E]
         
     @torch.no_grad()
     def predict(self, batch):
@@ -48,21 +56,10 @@ class ColBERTEncoder(nn.Module):
         cid_mask = torch.ones_like(cid)
         rid = batch['rids']
         rid_mask = batch['rids_mask']
-        batch_size, rseq_len = rid.size()
-        
-        cid_rep = self.ctx_encoder(cid, cid_mask, hidden=True).expand(len(rid), -1, -1)    # [B_r, S, E]
-        
-        rid_rep = self.can_encoder(rid, rid_mask, hidden=True)    # [B_r, S, E]
-        # rid_rep = torch.zeros(batch_size, rseq_len, 768).cuda()
-
-        cid_rep, rid_rep = F.normalize(cid_rep, dim=-1), F.normalize(rid_rep, dim=-1)
-        scores = torch.bmm(cid_rep, rid_rep.permute(0, 2, 1))    # [B, S_c, S_r]
-        rid_length = rid_mask.sum(dim=-1).tolist()
-        for idx in range(batch_size):
-            scores[idx, :, rid_length[idx]:] = -np.inf
-        scores = scores.max(dim=-1)[0]
-        rest = scores.sum(dim=-1)
-        return rest
+        cid_rep = self.get_ctx(cid, cid_mask)    # [1, S_c, E]
+        rid_rep = self.get_cand(rid, rid_mask)    # [B_r, S_r, E]
+        rest = colbert_maxsim(cid_rep, rid_rep, cid_mask, rid_mask)    # [1, B_r]
+        return rest.squeeze(dim=0)
         
     def forward(self, batch):
         cid = batch['ids']
@@ -130,13 +127,27 @@ class ColBERTV2Encoder(nn.Module):
         dp = torch.stack(torch.split(dp, seqlen_c, dim=-1), dim=-1).permute(0, 2, 1).sum(dim=-1).t()    # [B_c, B_r]
         return dp
         
+    @torch.no_grad()
+    def get_ctx(self, ids, attn_mask):
+        cid_rep = self.ctx_encoder(ids, attn_mask, hidden=True)
+        cid_rep = F.normalize(cid_rep, dim=-1)
+        return cid_rep    # [B, S, E]
+
+    @torch.no_grad()
+    def get_cand(self, ids, attn_mask):
+        rid_rep = self.can_encoder(ids, attn_mask, hidden=True)
+        rid_rep = F.normalize(rid_rep, dim=-1)
+        return rid_rep    # [B, S, E]
+        
     @torch.no_grad()
     def predict(self, batch):
         cid = batch['ids']
         cid_mask = torch.ones_like(cid)
         rid = batch['rids']
         rid_mask = batch['rids_mask']
-        dp = self._encode(cid, rid, cid_mask, rid_mask, test=False)
+        cid_rep = self.get_ctx(cid, cid_mask)    # [1, S_c, E]
+        rid_rep = self.get_cand(rid, rid_mask)    # [B_r, S_r, E]
+        dp = colbert_maxsim(cid_rep, rid_rep, cid_mask, rid_mask)    # [1, B_r]
         return dp.squeeze(dim=0)
         
     def forward(self, batch):
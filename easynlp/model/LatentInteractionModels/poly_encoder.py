@@ -1,6 +1,17 @@
 from model.utils import *
 
 
+def poly_attention_score(cid_rep, rid_rep):
+    '''only the context-side poly-code attention depends on the query:
+        cid_rep: [B_c, M, E] poly codes of the contexts; rid_rep: [B_r, E] candidate embeddings
+    return the matching scores [B_c, B_r]'''
+    w_ = torch.matmul(cid_rep, rid_rep.t()).permute(0, 2, 1)    # [B_c, B_r, M]
+    w_ /= np.sqrt(cid_rep.size(-1))
+    weights = F.softmax(w_, dim=-1)
+    cid_rep = torch.bmm(weights, cid_rep)    # [B_c, B_r, E]
+    return torch.einsum('ijk,jk->ij', cid_rep, rid_rep)
+
+
 class PolyEncoder(nn.Module):
     
     def __init__(self, **args):
@@ -28,6 +39,20 @@ class PolyEncoder(nn.Module):
         rid_rep = rid_rep.unsqueeze(0).expand(batch_size, -1, -1)
         return cid_rep, rid_rep
         
+    @torch.no_grad()
+    def get_ctx(self, ids, attn_mask):
+        return self.ctx_encoder(ids, attn_mask).permute(1, 0, 2)    # [B, M, E]
+
+    @torch.no_grad()
+    def get_cand(self, ids, attn_mask):
+        return self.can_encoder(ids, attn_mask)    # [B, E]
+
+    @torch.no_grad()
+    def predict_with_cache(self, cid, cid_mask, rid_rep):
+        '''rid_rep [B_r, E] is looked up from the precomputed candidate cache'''
+        cid_rep = self.get_ctx(cid, cid_mask)
+        return poly_attention_score(cid_rep, rid_rep).squeeze(0)    # [B_r]
+        
     @torch.no_grad()
     def predict(self, batch):
         cid = batch['ids']
@@ -86,6 +111,20 @@ class PolyEncoderHN(nn.Module):
         rid_rep = rid_rep.unsqueeze(0).expand(batch_size, -1, -1)
         return cid_rep, rid_rep
         
+    @torch.no_grad()
+    def get_ctx(self, ids, attn_mask):
+        return self.ctx_encoder(ids, attn_mask).permute(1, 0, 2)    # [B, M, E]
+
+    @torch.no_grad()
+    def get_cand(self, ids, attn_mask):
+        return self.can_encoder(ids, attn_mask)    # [B, E]
+
+    @torch.no_grad()
+    def predict_with_cache(self, cid, cid_mask, rid_rep):
+        '''rid_rep [B_r, E] is looked up from the precomputed candidate cache'''
+        cid_rep = self.get_ctx(cid, cid_mask)
+        return poly_attention_score(cid_rep, rid_rep).squeeze(0)    # [B_r]
+        
     @torch.no_grad()
     def predict(self, batch):
         cid = batch['ids']
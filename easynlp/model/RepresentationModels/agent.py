@@ -9,6 +9,10 @@ class RepresentationAgent(RetrievalBaseAgent):
         self.vocab, self.model = vocab, model
         self.vocab.add_tokens(['[EOS]'])
         self.load_last_step = None
+        # cpu onnx runtime backend of get_ctx/get_cand (load_onnx_backend)
+        self.onnx_ctx_encoder, self.onnx_cand_encoder = None, None
+        # background hard negative refresher of dual-bert-ance (init_hard_negative_refresher)
+        self.refresher = None
 
         self.pad = self.vocab.convert_tokens_to_ids('[PAD]')
         self.sep = self.vocab.convert_tokens_to_ids('[SEP]')
@@ -47,6 +51,8 @@ class RepresentationAgent(RetrievalBaseAgent):
                 self.train_model = self.train_model_seed
             elif self.args['model'] in ['dual-bert-tacl', 'dual-bert-tacl-hn']:
                 self.train_model = self.train_model_tacl
+            elif self.args['model'] in ['dual-bert'] and self.args.get('grad_cache', False):
+                self.train_model = self.train_model_grad_cache
             elif self.args['model'] in ['phrase-copy']:
                 if self.args['is_step_for_training']:
                     self.train_model = self.train_model_phrase_copy_step
@@ -514,6 +520,9 @@ class RepresentationAgent(RetrievalBaseAgent):
             # compatible with the curriculumn learning
             batch['mode'] = 'hard' if hard is True else 'easy'
 
+            if self.refresher is not None:
+                self.refresher.step(whole_batch_num + batch_num)
+
             self.optimizer.zero_grad()
 
             if self.args['fgm']:
@@ -564,6 +573,83 @@ class RepresentationAgent(RetrievalBaseAgent):
             recoder.add_scalar(f'train-whole/Acc', total_acc/batch_num, idx_)
         return batch_num
 
+    def train_model_grad_cache(self, train_iter, test_iter, recoder=None, idx_=0, hard=False, whole_batch_num=0):
+        '''gradient cache (dual-bert): the representations are computed chunk by chunk without the graph,
+        the contrastive loss is computed over the whole batch (and the batches of the other ranks),
+        then the forward of each chunk is recomputed and backpropagated with the cached gradients of its representations;
+        the in-batch negatives grow with the batch size while the activation memory is bounded by grad_cache_chunk_size'''
+        self.model.train()
+        model = self.model.module
+        chunk_size = self.args['grad_cache_chunk_size']
+        gather = self.args.get('grad_cache_gather', True) and dist.get_world_size() > 1
+        total_loss, total_acc = 0, 0
+        pbar = tqdm(train_iter)
+        batch_num = 0
+        for idx, batch in enumerate(pbar):
+            self.optimizer.zero_grad()
+            chunks = []
+            for side, keys in [('ctx', ('ids', 'ids_mask')), ('can', ('rids', 'rids_mask'))]:
+                for i in range(0, len(batch[keys[0]]), chunk_size):
+                    chunks.append({'encode': side, keys[0]: batch[keys[0]][i:i+chunk_size], keys[1]: batch[keys[1]][i:i+chunk_size]})
+
+            # 1. representations without the graph, the random states are kept for the same dropout masks
+            reps, states = [], []
+            with torch.no_grad():
+                for chunk in chunks:
+                    states.append(RandContext())
+                    with autocast():
+                        reps.append(self.model(chunk).float())
+            cid_rep = torch.cat([r for r, c in zip(reps, chunks) if c['encode'] == 'ctx']).requires_grad_()
+            rid_rep = torch.cat([r for r, c in zip(reps, chunks) if c['encode'] == 'can']).requires_grad_()
+
+            # 2. loss over the whole batch, the representations of the other ranks are the extra negatives
+            if gather:
+                loss, acc = model.contrastive_loss(*distributed_collect(cid_rep, rid_rep))
+            else:
+                loss, acc = model.contrastive_loss(cid_rep, rid_rep)
+            self.scaler.scale(loss).backward()
+            grads = list(torch.cat([cid_rep.grad, rid_rep.grad]).split([len(r) for r in reps]))
+
+            # 3. recompute the chunks and backpropagate the cached gradients, the gradients are synchronized once
+            with self.model.no_sync():
+                for chunk, state, grad in zip(chunks, states, grads):
+                    with state:
+                        with autocast():
+                            rep = self.model(chunk).float()
+                    torch.autograd.backward(rep, grad_tensors=grad)
+            if dist.get_world_size() > 1:
+                for param in self.model.parameters():
+                    if param.grad is not None:
+                        # sum: the gradients of each rank only come from its own samples when the batches are gathered
+                        dist.all_reduce(param.grad)
+                        if not gather:
+                            param.grad.div_(dist.get_world_size())
+            self.scaler.unscale_(self.optimizer)
+            clip_grad_norm_(self.model.parameters(), self.args['grad_clip'])
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.scheduler.step()
+
+            total_loss += loss.item()
+            total_acc += acc
+            batch_num += 1
+
+            if whole_batch_num + batch_num in self.args['test_step']:
+                self.test_now(test_iter, recoder)
+
+            if recoder:
+                recoder.add_scalar(f'train-epoch-{idx_}/Loss', total_loss/batch_num, idx)
+                recoder.add_scalar(f'train-epoch-{idx_}/RunLoss', loss.item(), idx)
+                recoder.add_scalar(f'train-epoch-{idx_}/Acc', total_acc/batch_num, idx)
+                recoder.add_scalar(f'train-epoch-{idx_}/RunAcc', acc, idx)
+             
+            pbar.set_description(f'[!] loss: {round(loss.item(), 4)}|{round(total_loss/batch_num, 4)}; acc: {round(acc, 4)}|{round(total_acc/batch_num, 4)}')
+
+        if recoder:
+            recoder.add_scalar(f'train-whole/Loss', total_loss/batch_num, idx_)
+            recoder.add_scalar(f'train-whole/Acc', total_acc/batch_num, idx_)
+        return batch_num
+
     @torch.no_grad()
     def test_model_acc(self, test_iter, print_output=False, rerank_agent=None, core_time=False):
         self.model.eval()
@@ -586,9 +672,8 @@ class RepresentationAgent(RetrievalBaseAgent):
     def test_model(self, test_iter, print_output=False, rerank_agent=None, core_time=False):
         self.model.eval()
         pbar = tqdm(test_iter)
-        total_mrr, total_prec_at_one, total_map = 0, 0, 0
-        total_examples, total_correct = 0, 0
-        k_list = [1, 2, 5, 10]
+        # the metrics are accumulated on device and computed once at the end
+        metric = RerankMetric(multi_positive=self.args['dataset'] in ["douban", "restoration-200k"])
         core_time_rest = 0
 
 
@@ -611,12 +696,14 @@ class RepresentationAgent(RetrievalBaseAgent):
 
 
             if self.args['mode'] in ['train']:
-                scores = self.model.module.predict(batch).cpu().tolist()    # [B]
+                scores = self.model.module.predict(batch)    # [B]
             else:
                 if core_time:
                     bt = time.time()
-                scores = self.model.predict(batch).cpu().tolist()    # [B]
+                scores = self.model.predict(batch)    # [B]
                 if core_time:
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
                     et = time.time()
                     core_time_rest += et - bt
 
@@ -633,13 +720,14 @@ class RepresentationAgent(RetrievalBaseAgent):
                 packup = {
                     'context': context,
                     'responses': responses,
-                    'scores': scores,
+                    'scores': scores.cpu().tolist(),
                 }
                 # only the scores has been update
                 scores = rerank_agent.compare_reorder(packup)
 
             # print output
             if print_output:
+                scores = scores.tolist() if torch.is_tensor(scores) else scores
                 if 'responses' in batch:
                     self.log_save_file.write(f'[CTX] {batch["context"]}\n')
                     for rtext, score in zip(responses, scores):
@@ -654,45 +742,12 @@ class RepresentationAgent(RetrievalBaseAgent):
                         self.log_save_file.write(f'[Score {score}] {rtext}\n')
                 self.log_save_file.write('\n')
 
-            rank_by_pred, pos_index, stack_scores = \
-            calculate_candidates_ranking(
-                np.array(scores), 
-                np.array(label.cpu().tolist()),
-                10)
-            num_correct = logits_recall_at_k(pos_index, k_list)
-            if self.args['dataset'] in ["douban", "restoration-200k"]:
-                total_prec_at_one += precision_at_one(rank_by_pred)
-                total_map += mean_average_precision(pos_index)
-                for pred in rank_by_pred:
-                    if sum(pred) == 0:
-                        total_examples -= 1
-            total_mrr += logits_mrr(pos_index)
-            total_correct = np.add(total_correct, num_correct)
-            total_examples += 1
-
-
-        avg_mrr = float(total_mrr / total_examples)
-        avg_prec_at_one = float(total_prec_at_one / total_examples)
-        avg_map = float(total_map / total_examples)
+            metric.add(scores, label)
+
+        outputs = metric.compute()
         if core_time:
-            return {
-                f'R10@{k_list[0]}': round(((total_correct[0]/total_examples)*100), 2),        
-                f'R10@{k_list[1]}': round(((total_correct[1]/total_examples)*100), 2),        
-                f'R10@{k_list[2]}': round(((total_correct[2]/total_examples)*100), 2),        
-                'MRR': round(100*avg_mrr, 2),
-                'P@1': round(100*avg_prec_at_one, 2),
-                'MAP': round(100*avg_map, 2),
-                'core_time': core_time_rest,
-            }
-        else:
-            return {
-                f'R10@{k_list[0]}': round(((total_correct[0]/total_examples)*100), 2),        
-                f'R10@{k_list[1]}': round(((total_correct[1]/total_examples)*100), 2),        
-                f'R10@{k_list[2]}': round(((total_correct[2]/total_examples)*100), 2),        
-                'MRR': round(100*avg_mrr, 2),
-                'P@1': round(100*avg_prec_at_one, 2),
-                'MAP': round(100*avg_map, 2),
-            }
+            outputs['core_time'] = core_time_rest
+        return outputs
     
     @torch.no_grad()
     def inference_writer(self, inf_iter, size=1000000):
@@ -951,41 +1006,80 @@ class RepresentationAgent(RetrievalBaseAgent):
             )
 
     def hier_totensor(self, texts):
-        ids = []
-        turn_length = []
-        for text in texts:
-            text = self.vocab.batch_encode_plus(text, add_special_tokens=False)['input_ids']
-            text = [[self.cls] + i[-(self.args['max_len']-2):] + [self.sep] for i in text]
-            text = [torch.LongTensor(i) for i in text[-self.args['max_turn_length']:]]
-            ids.extend(text)
-            turn_length.append(len(text))
-        ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-        ids_mask = generate_mask(ids)
-        ids, ids_mask = to_cuda(ids, ids_mask)
+        with trace_span('tokenize'):
+            ids = []
+            turn_length = []
+            for text in texts:
+                text = self.vocab.batch_encode_plus(text, add_special_tokens=False)['input_ids']
+                text = [[self.cls] + i[-(self.args['max_len']-2):] + [self.sep] for i in text]
+                text = [torch.LongTensor(i) for i in text[-self.args['max_turn_length']:]]
+                ids.extend(text)
+                turn_length.append(len(text))
+            ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
+            ids_mask = generate_mask(ids)
+        with trace_span('host_to_device'):
+            ids, ids_mask = to_cuda(ids, ids_mask)
         return ids, ids_mask, turn_length
 
     @torch.no_grad()
     def encode_queries(self, texts):
         self.model.eval()
+        # the tokenize and host_to_device spans are opened by totensor and hier_totensor
         if self.args['model'] in ['dual-bert-pos', 'dual-bert-hn-pos']:
             ids, ids_mask, pos_w = self.totensor(texts, ctx=True, position=True)
-            vectors = self.model.get_ctx(ids, ids_mask, pos_w)    # [B, E]
+            with trace_span('encoder_forward'):
+                vectors = self.model.get_ctx(ids, ids_mask, pos_w)    # [B, E]
         elif self.args['model'] in ['dual-bert-hier-trs', 'hash-dual-bert-hier-trs']:
             ids, ids_mask, turn_length = self.hier_totensor(texts)
-            vectors = self.model.get_ctx(ids, ids_mask, turn_length)
+            with trace_span('encoder_forward'):
+                vectors = self.model.get_ctx(ids, ids_mask, turn_length)
         else:
             ids, ids_mask = self.totensor(texts, ctx=True)
-            vectors = self.model.get_ctx(ids, ids_mask)    # [B, E]
+            if self.onnx_ctx_encoder is not None:
+                with trace_span('encoder_forward'):
+                    return self.onnx_ctx_encoder(ids, ids_mask)    # [B, E]
+            with trace_span('encoder_forward'):
+                vectors = self.model.get_ctx(ids, ids_mask)    # [B, E]
             # vectors = self.model.module.get_ctx(ids, ids_mask)    # [B, E]
-        return vectors.cpu().numpy()
+        with trace_span('device_to_host'):
+            vectors = vectors.cpu().numpy()
+        return vectors
 
     @torch.no_grad()
     def encode_candidates(self, texts):
         self.model.eval()
         ids, ids_mask = self.totensor(texts, ctx=False)
+        if self.onnx_cand_encoder is not None:
+            return self.onnx_cand_encoder(ids, ids_mask)
         vectors = self.model.get_cand(ids, ids_mask)    # [B, E]
         return vectors.cpu().numpy()
 
+    def check_onnx_support(self):
+        '''the onnx models only take (ids, ids_mask), the position weights and the turn lengths are not exported'''
+        if self.args['model'] in ['dual-bert-pos', 'dual-bert-hn-pos', 'dual-bert-hier-trs', 'hash-dual-bert-hier-trs']:
+            raise Exception(f'[!] the onnx backend does not support {self.args["model"]}, use the torch backend')
+
+    def export_onnx(self, quantize=True, max_len=64):
+        '''export get_ctx and get_cand into the onnx models (optional int8 quantization), return the paths'''
+        self.check_onnx_support()
+        paths = {}
+        for encoder, method in [('ctx', 'get_ctx'), ('cand', 'get_cand')]:
+            path = onnx_encoder_path(self.args, encoder=encoder)
+            export_encoder_to_onnx(self.model, path, method=method, max_len=max_len, vocab_size=len(self.vocab))
+            paths[encoder] = path
+            if quantize:
+                quantized_path = onnx_encoder_path(self.args, encoder=encoder, quantize=True)
+                quantize_onnx(path, quantized_path)
+                paths[f'{encoder}-int8'] = quantized_path
+        return paths
+
+    def load_onnx_backend(self, quantize=False, num_threads=0, candidate=False):
+        '''encode_queries (and encode_candidates if candidate is True) run the onnx models on cpu'''
+        self.check_onnx_support()
+        self.onnx_ctx_encoder = ONNXEncoder(onnx_encoder_path(self.args, 'ctx', quantize=quantize), num_threads=num_threads)
+        if candidate:
+            self.onnx_cand_encoder = ONNXEncoder(onnx_encoder_path(self.args, 'cand', quantize=quantize), num_threads=num_threads)
+
     @torch.no_grad()
     def rerank(self, batches, inner_bsz=2048):
         self.model.eval()
@@ -1000,7 +1094,10 @@ class RepresentationAgent(RetrievalBaseAgent):
                 batch['ids_mask'] = cid_mask
                 batch['rids'] = rid
                 batch['rids_mask'] = rid_mask
-                subscores.extend(self.model.predict(batch).tolist())
+                with trace_span('rerank_forward'):
+                    logits = self.model.predict(batch)
+                with trace_span('device_to_host'):
+                    subscores.extend(logits.tolist())
             scores.append(subscores)
         return scores
 
@@ -1336,6 +1433,10 @@ class RepresentationAgent(RetrievalBaseAgent):
             recoder.add_scalar(f'train-whole/DCAcc', total_dc_acc/batch_num, idx_)
         return batch_num
 
+    def init_hard_negative_refresher(self, dataset):
+        '''refresh the hard negatives of the train dataset by the snapshots of the encoders in the background (ance)'''
+        self.refresher = HardNegativeRefresher(self.model.module, dataset, self.args)
+
     @torch.no_grad()
     def inference_and_update_index(self, inf_iter, inner_size=500000):
         # inference the whole dataset, only one worker can be allowed to run the following steps
@@ -1345,35 +1446,35 @@ class RepresentationAgent(RetrievalBaseAgent):
             return
         # load all of the saved samples
         embds, texts = [], []
-        for i in tqdm(range(args['total_workers'])):
+        for i in tqdm(range(self.args['total_workers'])):
             for idx in range(100):
                 try:
                     embd, text = torch.load(
-                        f'{args["root_dir"]}/data/{args["dataset"]}/inference_{args["model"]}_{i}_{idx}.pt'
+                        f'{self.args["root_dir"]}/data/{self.args["dataset"]}/inference_{self.args["model"]}_{i}_{idx}.pt'
                     )
-                    print(f'[!] load {args["root_dir"]}/data/{args["dataset"]}/inference_{args["model"]}_{i}_{idx}.pt')
+                    print(f'[!] load {self.args["root_dir"]}/data/{self.args["dataset"]}/inference_{self.args["model"]}_{i}_{idx}.pt')
                 except:
                     break
                 embds.append(embd)
                 texts.extend(text)
-                already_added.append((i, idx))
             if len(embds) > 10000000:
                 break
         embds = np.concatenate(embds) 
 
-        # init the faiss searcher
+        # init the faiss searcher (inference_utils imports the model package)
+        from inference_utils.utils import Searcher
         self.searcher = Searcher(
-            args['index_type'], dimension=args['dimension']
+            self.args['index_type'], dimension=self.args['dimension']
         )
-        searcher._build(embds, texts, speedup=True)
+        self.searcher._build(embds, texts, speedup=True)
         print(f'[!] train the searcher over')
         
         # save the faiss searcher
-        model_name = args['model']
-        pretrained_model_name = args['pretrained_model']
+        model_name = self.args['model']
+        pretrained_model_name = self.args['pretrained_model'].replace('/', '_')
         self.searcher.save(
-            f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt',
-            f'{args["root_dir"]}/data/{args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
+            f'{self.args["root_dir"]}/data/{self.args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt',
+            f'{self.args["root_dir"]}/data/{self.args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt',
         )
         print(f'[!] update faiss index over')
     
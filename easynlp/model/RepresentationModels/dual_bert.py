@@ -91,6 +91,12 @@ class BERTDualEncoder(nn.Module):
         return score
     
     def forward(self, batch):
+        if 'encode' in batch:
+            # gradient cache: encode one chunk of the contexts or the candidates
+            if batch['encode'] == 'ctx':
+                return self.ctx_encoder(batch['ids'], batch['ids_mask'])
+            return self.can_encoder(batch['rids'], batch['rids_mask'])
+
         cid = batch['ids']
         rid = batch['rids']
         cid_mask = batch['ids_mask']
@@ -98,7 +104,10 @@ class BERTDualEncoder(nn.Module):
 
         cid_rep, rid_rep = self._encode(cid, rid, cid_mask, rid_mask)
         # cid_rep, rid_rep = distributed_collect(cid_rep, rid_rep)
+        return self.contrastive_loss(cid_rep, rid_rep)
 
+    def contrastive_loss(self, cid_rep, rid_rep):
+        '''the i-th candidate is the positive of the i-th context, and the others are the in-batch negatives'''
         dot_product = torch.matmul(cid_rep, rid_rep.t()) 
         # dot_product /= self.temp
         batch_size = len(cid_rep)
@@ -11,6 +11,7 @@ class TargetDialogAgent(RetrievalBaseAgent):
         self.pad = self.vocab.convert_tokens_to_ids('[PAD]')
         self.sep = self.vocab.convert_tokens_to_ids('[SEP]')
         self.cls = self.vocab.convert_tokens_to_ids('[CLS]')
+        self.reconstruct_from_index = False
 
         if args['mode'] == 'train':
             self.set_test_interval()
@@ -75,23 +76,25 @@ class TargetDialogAgent(RetrievalBaseAgent):
     def test_model(self, test_iter, print_output=False, rerank_agent=None, core_time=False):
         self.model.eval()
         pbar = tqdm(test_iter)
-        total_mrr, total_prec_at_one, total_map = 0, 0, 0
-        total_examples, total_correct = 0, 0
-        k_list = [1, 2, 5, 10]
+        # the metrics are accumulated on device and computed once at the end
+        metric = RerankMetric(multi_positive=self.args['dataset'] in ["douban", "restoration-200k"])
         core_time_rest = 0
         for idx, batch in enumerate(pbar):                
             label = batch['label']
             if self.args['mode'] in ['train']:
-                scores = self.model.module.predict(batch).cpu().tolist()    # [B]
+                scores = self.model.module.predict(batch)    # [B]
             else:
                 if core_time:
                     bt = time.time()
-                scores = self.model.predict(batch).cpu().tolist()    # [B]
+                scores = self.model.predict(batch)    # [B]
                 if core_time:
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
                     et = time.time()
                     core_time_rest += et - bt
 
             if print_output:
+                scores = scores.tolist()
                 if 'responses' in batch:
                     self.log_save_file.write(f'[CTX] {batch["context"]}\n')
                     for rtext, score in zip(responses, scores):
@@ -106,43 +109,12 @@ class TargetDialogAgent(RetrievalBaseAgent):
                         self.log_save_file.write(f'[Score {score}] {rtext}\n')
                 self.log_save_file.write('\n')
 
-            rank_by_pred, pos_index, stack_scores = \
-            calculate_candidates_ranking(
-                np.array(scores), 
-                np.array(label.cpu().tolist()),
-                10)
-            num_correct = logits_recall_at_k(pos_index, k_list)
-            if self.args['dataset'] in ["douban", "restoration-200k"]:
-                total_prec_at_one += precision_at_one(rank_by_pred)
-                total_map += mean_average_precision(pos_index)
-                for pred in rank_by_pred:
-                    if sum(pred) == 0:
-                        total_examples -= 1
-            total_mrr += logits_mrr(pos_index)
-            total_correct = np.add(total_correct, num_correct)
-            total_examples += 1
-        avg_mrr = float(total_mrr / total_examples)
-        avg_prec_at_one = float(total_prec_at_one / total_examples)
-        avg_map = float(total_map / total_examples)
+            metric.add(scores, label)
+
+        outputs = metric.compute()
         if core_time:
-            return {
-                f'R10@{k_list[0]}': round(((total_correct[0]/total_examples)*100), 2),        
-                f'R10@{k_list[1]}': round(((total_correct[1]/total_examples)*100), 2),        
-                f'R10@{k_list[2]}': round(((total_correct[2]/total_examples)*100), 2),        
-                'MRR': round(100*avg_mrr, 2),
-                'P@1': round(100*avg_prec_at_one, 2),
-                'MAP': round(100*avg_map, 2),
-                'core_time': core_time_rest,
-            }
-        else:
-            return {
-                f'R10@{k_list[0]}': round(((total_correct[0]/total_examples)*100), 2),        
-                f'R10@{k_list[1]}': round(((total_correct[1]/total_examples)*100), 2),        
-                f'R10@{k_list[2]}': round(((total_correct[2]/total_examples)*100), 2),        
-                'MRR': round(100*avg_mrr, 2),
-                'P@1': round(100*avg_prec_at_one, 2),
-                'MAP': round(100*avg_map, 2),
-            }
+            outputs['core_time'] = core_time_rest
+        return outputs
     
     def load_model(self, path):
         # ========== common case ========== #
@@ -184,24 +156,14 @@ class TargetDialogAgent(RetrievalBaseAgent):
         self.memory = memory
 
         # encode the memory by the response encoder
-        ids = self.vocab.batch_encode_plus(memory, add_special_tokens=False)['input_ids']
-        ids = [torch.LongTensor([self.cls] + i[:self.args['max_len']-2] + [self.sep]) for i in ids]
-        ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-        ids_mask = generate_mask(ids)
-        ids, ids_mask = to_cuda(ids, ids_mask)
-        self.memory_vector = self.model.get_cand(ids, ids_mask)    # [B, E]
+        self.session = self.init_session(memory, topic)
+        self.memory_vector = self.session['memory_vector']    # [B, E]
 
         print(f'[!] init the memory and topic over')
 
         # load the ann searcher
         if load_searcher:
-            model_name = self.args['model']
-            pretrained_model_name = self.args['pretrained_model'].replace('/', '_')
-            self.searcher = Searcher(self.args['index_type'], dimension=self.args['dimension'], q_q=False, nprobe=self.args['index_nprobe'])
-            faiss_ckpt_path = f'{self.args["root_dir"]}/data/{self.args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt'
-            corpus_ckpt_path = f'{self.args["root_dir"]}/data/{self.args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt'
-            self.searcher.load(faiss_ckpt_path, corpus_ckpt_path)
-            print(f'[!] init the ann searcher over')
+            self.load_searcher()
 
         # init the cache
         self.cache = []
@@ -213,94 +175,156 @@ class TargetDialogAgent(RetrievalBaseAgent):
         #     self.work([utterance])
         print(f'[!] init the given context lists over')
 
+    @torch.no_grad()
+    def init_session(self, memory, topic):
+        '''the state of one target-driven session, multiple sessions are processed together by work_batch'''
+        return {
+            'topic': topic,
+            'memory': memory,
+            'memory_vector': self.encode_candidates(memory),    # [M, E]
+            # the candidate-memory scores only depend on the candidate, cached by the candidate id
+            'memory_score': {},
+        }
+
+    def load_searcher(self):
+        model_name = self.args['model']
+        pretrained_model_name = self.args['pretrained_model'].replace('/', '_')
+        self.searcher = Searcher(self.args['index_type'], dimension=self.args['dimension'], q_q=False, nprobe=self.args['index_nprobe'])
+        faiss_ckpt_path = f'{self.args["root_dir"]}/data/{self.args["dataset"]}/{model_name}_{pretrained_model_name}_faiss.ckpt'
+        corpus_ckpt_path = f'{self.args["root_dir"]}/data/{self.args["dataset"]}/{model_name}_{pretrained_model_name}_corpus.ckpt'
+        self.searcher.load(faiss_ckpt_path, corpus_ckpt_path)
+        # the index is built by the response encoder of this model, so the candidate embeddings
+        # are fetched from the index instead of being encoded again
+        self.reconstruct_from_index = self.searcher.init_reconstruct()
+        print(f'[!] init the ann searcher over; reconstruct candidate embeddings from index: {self.reconstruct_from_index}')
+
+    @torch.no_grad()
+    def encode_contexts(self, strings, inner_bsz=256):
+        ids = self.vocab.batch_encode_plus(strings, add_special_tokens=False)['input_ids']
+        ids = [torch.LongTensor([self.cls] + i[-self.args['max_len']+2:] + [self.sep]) for i in ids]
+        rest = []
+        for idx in range(0, len(ids), inner_bsz):
+            sub_ids = pad_sequence(ids[idx:idx+inner_bsz], batch_first=True, padding_value=self.pad)
+            sub_ids_mask = generate_mask(sub_ids)
+            sub_ids, sub_ids_mask = to_cuda(sub_ids, sub_ids_mask)
+            rest.append(self.model.get_ctx_embedding(sub_ids, sub_ids_mask))
+        return torch.cat(rest)    # [B, E]
+
+    @torch.no_grad()
+    def encode_candidates(self, texts, inner_bsz=256):
+        ids = self.vocab.batch_encode_plus(texts, add_special_tokens=False)['input_ids']
+        ids = [torch.LongTensor([self.cls] + i[:self.args['max_len']-2] + [self.sep]) for i in ids]
+        rest = []
+        for idx in range(0, len(ids), inner_bsz):
+            sub_ids = pad_sequence(ids[idx:idx+inner_bsz], batch_first=True, padding_value=self.pad)
+            sub_ids_mask = generate_mask(sub_ids)
+            sub_ids, sub_ids_mask = to_cuda(sub_ids, sub_ids_mask)
+            rest.append(self.model.get_cand(sub_ids, sub_ids_mask))
+        return torch.cat(rest)    # [B, E]
+
+    @torch.no_grad()
+    def get_candidate_embeddings(self, texts, ids):
+        if self.reconstruct_from_index:
+            cand_rep = torch.from_numpy(self.searcher.reconstruct(ids)).float()
+            if torch.cuda.is_available():
+                cand_rep = cand_rep.cuda()
+            return cand_rep
+        return self.encode_candidates(texts)
+
+    @torch.no_grad()
+    def get_candidate_memory_score(self, session, ids, cand_rep):
+        cache = session['memory_score']
+        missing = [idx for idx, i in enumerate(ids) if i not in cache]
+        if missing:
+            scores = torch.matmul(cand_rep[missing], session['memory_vector'].t()).max(dim=-1)[0].tolist()
+            for idx, score in zip(missing, scores):
+                cache[ids[idx]] = score
+        return torch.tensor([cache[i] for i in ids], device=cand_rep.device)
+
     @torch.no_grad()
     def work_no_topic(self, context_list):
-        # 1. encode
-        string = ' [SEP] '.join(context_list)
-        ids = self.vocab.encode(string, add_special_tokens=False)
-        ids = torch.LongTensor([self.cls] + ids[-self.args['max_len']+2:] + [self.sep])
-        ids = ids.unsqueeze(0)
-        ids_mask = torch.ones_like(ids)
-        ids, ids_mask = to_cuda(ids, ids_mask)
-        
-        # 2. obtian context representations
-        cid_rep = self.model.get_ctx_embedding(ids, ids_mask)    # [B, E]
-        # 3. search candidates
-        candidates = self.searcher._search(cid_rep.cpu().numpy(), topk=self.args['work_topk'])[0]
-        candidates = list(set(candidates) - set(context_list))
-        return random.choice(candidates), -1
+        return self.work_no_topic_batch([context_list])[0]
+
+    @torch.no_grad()
+    def work_no_topic_batch(self, context_lists):
+        # 1. encode and obtian context representations
+        strings = [' [SEP] '.join(context_list) for context_list in context_lists]
+        cid_rep = self.encode_contexts(strings)    # [B, E]
+        # 2. search candidates
+        candidates = self.searcher._search(cid_rep.cpu().numpy(), topk=self.args['work_topk'])
+        rest = []
+        for context_list, candidates_ in zip(context_lists, candidates):
+            candidates_ = list(set(candidates_) - set(context_list))
+            rest.append((random.choice(candidates_), -1))
+        return rest
 
     @torch.no_grad()
     def work(self, context_list, context_candidate_alpha=0, context_candidate_memory_alpha=0, candidate_memory_alpha=0, past_alpha=0):
-        # 0. get the candidate embeddings of utterances in context_list to avoid the repetition 
-        # if len(context_list) > 1:
-        #     ids = self.vocab.batch_encode_plus(context_list[:-1], add_special_tokens=False)['input_ids']
-        #     ids = [torch.LongTensor([self.cls] + i[:self.args['max_len']-2] + [self.sep]) for i in ids]
-        #     ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-        #     ids_mask = generate_mask(ids)
-        #     ids, ids_mask = to_cuda(ids, ids_mask)
-        #     past_rep = self.model.get_cand(ids, ids_mask)    # [S, E]
-        #     # past_rep = self.model.get_ctx_embedding(ids, ids_mask)    # [S, E]
-
-        # 1. encode
-        string = ' [SEP] '.join(context_list)
-        ids = self.vocab.encode(string, add_special_tokens=False)
-        ids = torch.LongTensor([self.cls] + ids[-self.args['max_len']+2:] + [self.sep])
-        ids = ids.unsqueeze(0)
-        ids_mask = torch.ones_like(ids)
-        ids, ids_mask = to_cuda(ids, ids_mask)
-        
-        # 2. obtian context representations
-        cid_rep = self.model.get_ctx_embedding(ids, ids_mask)    # [B, E]
-
-        # 3. search candidates
-        candidates_ = self.searcher._search(cid_rep.cpu().numpy(), topk=self.args['work_topk'])[0]
+        return self.work_batch(
+            [context_list], 
+            [self.session], 
+            context_candidate_alpha=context_candidate_alpha, 
+            context_candidate_memory_alpha=context_candidate_memory_alpha, 
+            candidate_memory_alpha=candidate_memory_alpha, 
+            past_alpha=past_alpha
+        )[0]
+
+    @torch.no_grad()
+    def work_batch(self, context_lists, sessions, context_candidate_alpha=0, context_candidate_memory_alpha=0, candidate_memory_alpha=0, past_alpha=0):
+        '''context_lists and sessions are aligned, return the (best_candidate, distance) of each session'''
+        # 1. encode and obtian context representations
+        strings = [' [SEP] '.join(context_list) for context_list in context_lists]
+        cid_rep = self.encode_contexts(strings)    # [B, E]
+
+        # 2. search candidates
+        candidate_ids, candidate_texts = self.searcher._search_ids(cid_rep.cpu().numpy(), topk=self.args['work_topk'])
         ## filter the candidates with past utterances
-        candidates_ = list(set(candidates_) - set(context_list))
+        items = []
+        for context_list, ids_, texts_ in zip(context_lists, candidate_ids, candidate_texts):
+            past, d = set(context_list), {}
+            for i, t in zip(ids_, texts_):
+                if t not in past and t not in d:
+                    d[t] = i
+            items.append((list(d.keys()), list(d.values())))
 
-        batches = [{'context': context_list, 'candidates': candidates_}]
-        context_candidate_score = self.cross_encoder_agent.rerank(batches)[0]
-        context_candidate_score = torch.tensor(context_candidate_score).cuda()
+        # 3. cross-encoder scores of all the sessions
+        batches = [{'context': context_list, 'candidates': texts} for context_list, (texts, _) in zip(context_lists, items)]
+        context_candidate_scores = self.cross_encoder_agent.rerank(batches)
 
         # 4. encode the candidates by the context encoder for candidates rerank
-        candidates = [string + ' [SEP] ' + candidate for candidate in candidates_]
-        cids = self.vocab.batch_encode_plus(candidates, add_special_tokens=False)['input_ids']
-        cids = [torch.LongTensor([self.cls] + i[-self.args['max_len']+2:] + [self.sep]) for i in cids]
-        cids = pad_sequence(cids, batch_first=True, padding_value=self.pad)
-        cids_mask = generate_mask(cids)
-        cids, cids_mask = to_cuda(cids, cids_mask)
-        cid_rep_ = self.model.get_ctx_embedding(cids, cids_mask)    # [B, E]
-
-        # 6. response embedding
-        # encode the memory by the response encoder
-        ids = self.vocab.batch_encode_plus(candidates_, add_special_tokens=False)['input_ids']
-        ids = [torch.LongTensor([self.cls] + i[:self.args['max_len']-2] + [self.sep]) for i in ids]
-        ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-        ids_mask = generate_mask(ids)
-        ids, ids_mask = to_cuda(ids, ids_mask)
-        cand_rep = self.model.get_cand(ids, ids_mask)    # [B, E]
-        
-        candidate_memory_score = torch.matmul(cand_rep, self.memory_vector.t()).max(dim=-1)[0]
-        # context_candidate_score = torch.matmul(cid_rep, cand_rep.t())[0]
-        context_candidate_memory_score = torch.matmul(cid_rep_, self.memory_vector.t()).max(dim=-1)[0]    # [K]
-
-        # given the scores
-        # too high candidate_memory_score leads to the unnatural transition
-        # md = 0.5 * context_candidate_score + 0.25 * context_candidate_memory_score + 0.25 * candidate_memory_score
-        md = context_candidate_alpha * context_candidate_score +\
-                context_candidate_memory_alpha * context_candidate_memory_score +\
-                candidate_memory_alpha * candidate_memory_score
-        # if len(context_list) > 1:
-        #     past_candidate_score = torch.matmul(cand_rep, past_rep.t()).max(dim=-1)[0]    # [B]
-        #     # md -= 0.25 * past_candidate_score
-        #     md -= past_alpha * past_candidate_score
-
-        dis, best = md.max(dim=-1)
-        dis, best = dis.item(), best.item()    # distance range from -1 to 1
-
-        # 6. return the best candidates and update the cache
-        best_candidate = candidates_[best]
-        return best_candidate, dis
+        candidates = [string + ' [SEP] ' + candidate for string, (texts, _) in zip(strings, items) for candidate in texts]
+        cid_rep_ = self.encode_contexts(candidates)    # [B*K, E]
+
+        # 5. response embedding, fetched from the index
+        cand_rep = self.get_candidate_embeddings(
+            [t for texts, _ in items for t in texts],
+            [i for _, ids in items for i in ids],
+        )    # [B*K, E]
+
+        rest, offset = [], 0
+        for session, (texts, ids), context_candidate_score in zip(sessions, items, context_candidate_scores):
+            size = len(texts)
+            session_cid_rep = cid_rep_[offset:offset+size]
+            session_cand_rep = cand_rep[offset:offset+size]
+            offset += size
+
+            context_candidate_score = torch.tensor(context_candidate_score, device=session_cand_rep.device)
+            candidate_memory_score = self.get_candidate_memory_score(session, ids, session_cand_rep)    # [K]
+            context_candidate_memory_score = torch.matmul(session_cid_rep, session['memory_vector'].t()).max(dim=-1)[0]    # [K]
+
+            # given the scores
+            # too high candidate_memory_score leads to the unnatural transition
+            # md = 0.5 * context_candidate_score + 0.25 * context_candidate_memory_score + 0.25 * candidate_memory_score
+            md = context_candidate_alpha * context_candidate_score +\
+                    context_candidate_memory_alpha * context_candidate_memory_score +\
+                    candidate_memory_alpha * candidate_memory_score
+
+            dis, best = md.max(dim=-1)
+            dis, best = dis.item(), best.item()    # distance range from -1 to 1
+
+            # 6. return the best candidates
+            rest.append((texts[best], dis))
+        return rest
 
     @torch.no_grad()
     def update_cache(self, tensor):
@@ -12,3 +12,8 @@ from .distinct_metric import *
 from .contrastive_decoding import *
 from .simcse_model import *
 from .electra_speaker_models import *
+from .candidate_cache import *
+from .rank_metric import *
+from .tracing import *
+from .onnx_backend import *
+from .hn_refresh import *
@@ -1,6 +1,7 @@
 from .header import *
 from dataloader.util_func import *
 from .utils import *
+from .tracing import *
 
 '''
 Base Agent
@@ -211,56 +212,55 @@ class RetrievalBaseAgent:
         raise NotImplementedError
 
     def totensor(self, texts, ctx=True, position=False):
-        if ctx:
-            if type(texts[0]) == list:
-                if position is False:
-                    ids = []
-                    for text in texts:
-                        item = self.vocab.batch_encode_plus(text, add_special_tokens=False)['input_ids']
-                        context = []
-                        for u in item:
-                            context.extend(u+[self.sep])
-                        context.pop()
-                        context = context[-(self.args['max_len']-2):]
-                        context = [self.cls] + context + [self.sep]
-                        ids.append(torch.LongTensor(context))
+        with trace_span('tokenize'):
+            if ctx:
+                if type(texts[0]) == list:
+                    if position is False:
+                        ids = []
+                        for text in texts:
+                            item = self.vocab.batch_encode_plus(text, add_special_tokens=False)['input_ids']
+                            context = []
+                            for u in item:
+                                context.extend(u+[self.sep])
+                            context.pop()
+                            context = context[-(self.args['max_len']-2):]
+                            context = [self.cls] + context + [self.sep]
+                            ids.append(torch.LongTensor(context))
+                    else:
+                        ids = []
+                        pos_w = []
+                        for text in texts:
+                            item = self.vocab.batch_encode_plus(text, add_special_tokens=False)['input_ids']
+                            context = []
+                            pos = []
+                            w = self.args['min_w']
+                            for u in item:
+                                context.extend(u+[self.sep])
+                                pos.extend([w]*(len(u)+1))
+                                w += self.args['w_delta']
+                            context.pop()
+                            pos.pop()
+                            context = context[-(self.args['max_len']-2):]
+                            pos = pos[-(self.args['max_len']-2):]
+                            context = [self.cls] + context + [self.sep]
+                            pos = [self.args['min_w']] + pos + [w - self.args['w_delta']]
+                            ids.append(torch.LongTensor(context))
+                            pos_w.append(torch.tensor(pos))
                 else:
-                    ids = []
-                    pos_w = []
-                    for text in texts:
-                        item = self.vocab.batch_encode_plus(text, add_special_tokens=False)['input_ids']
-                        context = []
-                        pos = []
-                        w = self.args['min_w']
-                        for u in item:
-                            context.extend(u+[self.sep])
-                            pos.extend([w]*(len(u)+1))
-                            w += self.args['w_delta']
-                        context.pop()
-                        pos.pop()
-                        context = context[-(self.args['max_len']-2):]
-                        pos = pos[-(self.args['max_len']-2):]
-                        context = [self.cls] + context + [self.sep]
-                        pos = [self.args['min_w']] + pos + [w - self.args['w_delta']]
-                        ids.append(torch.LongTensor(context))
-                        pos_w.append(torch.tensor(pos))
+                    items = self.vocab.batch_encode_plus(texts)['input_ids']
+                    ids = [torch.LongTensor(length_limit(i, self.args['max_len'])) for i in items]
             else:
                 items = self.vocab.batch_encode_plus(texts)['input_ids']
-                ids = [torch.LongTensor(length_limit(i, self.args['max_len'])) for i in items]
-        else:
-            items = self.vocab.batch_encode_plus(texts)['input_ids']
-            ids = [torch.LongTensor(length_limit_res(i, self.args['res_max_len'], sep=self.sep)) for i in items]
-        if position is False:
-            ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-            mask = generate_mask(ids)
-            ids, mask = to_cuda(ids, mask)
-            return ids, mask
-        else:
+                ids = [torch.LongTensor(length_limit_res(i, self.args['res_max_len'], sep=self.sep)) for i in items]
             ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
             mask = generate_mask(ids)
-            pos_w = pad_sequence(pos_w, batch_first=True, padding_value=0.)
-            ids, mask, pos_w = to_cuda(ids, mask, pos_w)
-            return ids, mask, pos_w
+            if position:
+                pos_w = pad_sequence(pos_w, batch_first=True, padding_value=0.)
+        # the tokenize span is closed before the device copy, which is counted by its own span
+        with trace_span('host_to_device'):
+            if position is False:
+                return to_cuda(ids, mask)
+            return to_cuda(ids, mask, pos_w)
 
     def totensor_interaction(self, ctx_, responses_):
         '''for Interaction Models'''
@@ -289,16 +289,18 @@ class RetrievalBaseAgent:
         self.cls = self.vocab.convert_tokens_to_ids('[CLS]')
         self.sep = self.vocab.convert_tokens_to_ids('[SEP]')
         self.pad = self.vocab.convert_tokens_to_ids('[PAD]')
-        ids, tids = [], []
-        for idx in range(0, len(responses_), 512):
-            responses = responses_[idx:idx+512]
-            ids_, tids_ = _encode_one_session(ctx_, responses)
-            ids.extend(ids_)
-            tids.extend(tids_)
-        ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
-        tids = pad_sequence(tids, batch_first=True, padding_value=self.pad)
-        mask = generate_mask(ids)
-        ids, tids, mask = to_cuda(ids, tids, mask)
+        with trace_span('tokenize'):
+            ids, tids = [], []
+            for idx in range(0, len(responses_), 512):
+                responses = responses_[idx:idx+512]
+                ids_, tids_ = _encode_one_session(ctx_, responses)
+                ids.extend(ids_)
+                tids.extend(tids_)
+            ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
+            tids = pad_sequence(tids, batch_first=True, padding_value=self.pad)
+            mask = generate_mask(ids)
+        with trace_span('host_to_device'):
+            ids, tids, mask = to_cuda(ids, tids, mask)
         return ids, tids, mask
 
 
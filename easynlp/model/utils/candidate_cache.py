@@ -0,0 +1,48 @@
+from .header import *
+
+'''
+Memory-mapped candidate embedding cache:
+the candidate-side representations of a fixed response pool (e.g., the recall corpus)
+are precomputed offline, and the serving path looks them up by the corpus id
+'''
+
+class CandidateEmbeddingCache:
+
+    def __init__(self):
+        self.embeddings = None
+        self.corpus = []
+        self.text2id = {}
+
+    def _build(self, path_cache, embds, corpus):
+        '''embds: [N, E]; corpus: N texts, the position is the corpus id'''
+        assert len(embds) == len(corpus)
+        cache = np.lib.format.open_memmap(path_cache, mode='w+', dtype=np.float16, shape=embds.shape)
+        cache[:] = embds
+        cache.flush()
+        self.embeddings = np.load(path_cache, mmap_mode='r')
+        self.corpus = corpus
+        self.text2id = {text: i for i, text in enumerate(corpus)}
+        print(f'[!] build the candidate cache with {len(self.corpus)} samples: {path_cache}')
+
+    def save(self, path_corpus):
+        with open(path_corpus, 'wb') as f:
+            joblib.dump(self.corpus, f)
+
+    def load(self, path_cache, path_corpus):
+        self.embeddings = np.load(path_cache, mmap_mode='r')
+        with open(path_corpus, 'rb') as f:
+            self.corpus = joblib.load(f)
+        self.text2id = {text: i for i, text in enumerate(self.corpus)}
+        assert len(self.corpus) == len(self.embeddings)
+        print(f'[!] load the candidate cache with {len(self.corpus)} samples from {path_cache}')
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def lookup(self, texts):
+        '''return the corpus ids of the texts, -1 for the texts that are not in the cache'''
+        return [self.text2id.get(text, -1) for text in texts]
+
+    def get(self, ids):
+        '''ids: the corpus ids; return the float32 embeddings [len(ids), E]'''
+        return np.asarray(self.embeddings[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
@@ -0,0 +1,114 @@
+from .header import *
+import threading
+
+'''asynchronous hard negative refresh (ance) of the dual-bert training (dual-bert-ance):
+1. every ance_refresh_step steps, the rank 0 snapshots the ctx and can encoders into the cpu memory,
+   and the background thread loads the snapshot into the replica encoders on ance_device (e.g., the spare gpu);
+2. the replicas encode the corpus and the contexts of the train set, and the flat faiss index searches
+   the hard negatives of each context (the positive and the first ance_start candidates are skipped);
+3. the negatives are published atomically (os.replace) into data/<dataset>/ance_<model>_<version>_negatives.npy,
+   each rank checks the file at each step and swaps the negatives of its dataset by the reference,
+   so the training loop is not paused, and the stale negatives are used before the next publication'''
+
+
+class HardNegativeRefresher:
+
+    def __init__(self, model, dataset, args):
+        self.model = model
+        self.dataset = dataset
+        self.refresh_step = args['ance_refresh_step']
+        self.topk = args['ance_topk']
+        self.start = args['ance_start']
+        self.bsz = args['ance_bsz']
+        self.index_type = args['ance_index_type']
+        self.device = args['ance_device'] if args['ance_device'] else f'cuda:{args["local_rank"]}'
+        self.path = f'{args["root_dir"]}/data/{args["dataset"]}/ance_{args["model"]}_{args["version"]}_negatives.npy'
+        self.rank = dist.get_rank()
+        self.thread = None
+        self.replicas = None
+        # version (mtime) of the installed negatives, the file of the last run is ignored
+        self.installed = os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+        self.version = 0
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def step(self, current_step):
+        self.install()
+        if self.rank != 0 or current_step % self.refresh_step != 0:
+            return
+        if self.running():
+            print(f'[!] ance refresh is still running, skip the refresh of step {current_step}')
+            return
+        snapshot = self.snapshot()
+        self.thread = threading.Thread(target=self.refresh, args=(snapshot, current_step), name='ance-refresh', daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        '''copy the parameters of the encoders into the cpu memory, which is not changed by the optimizer'''
+        if self.replicas is None:
+            self.replicas = {
+                name: deepcopy(getattr(self.model, name)).to(self.device).eval() for name in ['ctx_encoder', 'can_encoder']
+            }
+        return {
+            name: {k: v.detach().to('cpu', copy=True) for k, v in getattr(self.model, name).state_dict().items()}
+            for name in ['ctx_encoder', 'can_encoder']
+        }
+
+    @torch.no_grad()
+    def encode(self, encoder, ids):
+        reps = []
+        for i in range(0, len(ids), self.bsz):
+            batch = pad_sequence([torch.LongTensor(x) for x in ids[i:i+self.bsz]], batch_first=True, padding_value=self.dataset.pad)
+            mask = (batch != self.dataset.pad).long()
+            batch, mask = batch.to(self.device), mask.to(self.device)
+            with autocast():
+                rep = encoder(batch, mask)
+            reps.append(rep.float().cpu().numpy())
+        return np.concatenate(reps).astype(np.float32)
+
+    def refresh(self, snapshot, current_step):
+        try:
+            begin = time.time()
+            for name, state in snapshot.items():
+                self.replicas[name].load_state_dict(state)
+            with torch.cuda.device(self.device):
+                cand_reps = self.encode(self.replicas['can_encoder'], self.dataset.corpus)
+                ctx_reps = self.encode(self.replicas['ctx_encoder'], [bundle['ids'] for bundle in self.dataset.data])
+            index = faiss.index_factory(cand_reps.shape[1], self.index_type, faiss.METRIC_INNER_PRODUCT)
+            if not index.is_trained:
+                index.train(cand_reps)
+            index.add(cand_reps)
+            _, I = index.search(ctx_reps, self.start + self.topk + 1)
+
+            negatives = np.full((len(I), self.topk), -1, dtype=np.int32)
+            for i, (row, bundle) in enumerate(zip(I, self.dataset.data)):
+                row = [j for j in row if j != -1 and j != bundle['pos']][self.start:self.start+self.topk]
+                negatives[i, :len(row)] = row
+            self.publish(negatives)
+            print(f'[!] ance refresh of step {current_step} is published: {len(negatives)} contexts, {round(time.time() - begin, 2)}s')
+        except Exception as error:
+            print(f'[!] ance refresh of step {current_step} failed: {error}')
+
+    def publish(self, negatives):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, negatives)
+        os.replace(tmp_path, self.path)
+
+    def install(self):
+        '''swap the negatives of the dataset if the new ones are published'''
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.installed:
+            return
+        negatives = np.load(self.path)
+        self.installed = mtime
+        if len(negatives) != len(self.dataset.data):
+            print(f'[!] the {len(negatives)} published negatives mismatch the {len(self.dataset.data)} contexts, ignore them')
+            return
+        self.dataset.update_hard_negatives(negatives)
+        self.version += 1
+        print(f'[!] rank {self.rank} installs the hard negatives of version {self.version}')
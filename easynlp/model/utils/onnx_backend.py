@@ -0,0 +1,92 @@
+from .header import *
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    ort = None
+
+'''cpu inference backend of the dual-encoder (BERTDualEncoder-style get_ctx/get_cand) by onnx runtime:
+1. the context or candidate encoder is exported into the onnx model with the dynamic batch size and sequence length;
+2. the weights of the onnx model can be dynamically quantized into int8;
+3. ONNXEncoder runs the onnx model on cpu, the input and output are the same as get_ctx/get_cand'''
+
+
+class EncoderExportWrapper(nn.Module):
+
+    '''wrap the get_ctx/get_cand method of the dual-encoder as the forward function for the export'''
+
+    def __init__(self, model, method='get_ctx'):
+        super(EncoderExportWrapper, self).__init__()
+        self.model = model
+        self.method = method
+
+    def forward(self, ids, ids_mask):
+        return getattr(self.model, self.method)(ids, ids_mask)
+
+
+def check_onnxruntime():
+    if ort is None:
+        raise Exception(f'[!] onnxruntime is not installed, run `pip install onnxruntime` to use the onnx backend')
+
+
+@torch.no_grad()
+def export_encoder_to_onnx(model, path, method='get_ctx', max_len=64, vocab_size=100, opset_version=13):
+    '''export the encoder on cpu, the batch size and the sequence length are dynamic'''
+    model.eval()
+    device = next(model.parameters()).device
+    wrapper = EncoderExportWrapper(model.cpu(), method=method)
+    ids = torch.randint(1, vocab_size, (2, max_len), dtype=torch.long)
+    ids_mask = torch.ones(2, max_len, dtype=torch.long)
+    torch.onnx.export(
+        model=wrapper,
+        args=(ids, ids_mask),
+        f=path,
+        export_params=True,
+        opset_version=opset_version,
+        do_constant_folding=True,
+        input_names=['ids', 'ids_mask'],
+        output_names=['embd'],
+        dynamic_axes={
+            'ids': {0: 'batch_size', 1: 'seq_len'},
+            'ids_mask': {0: 'batch_size', 1: 'seq_len'},
+            'embd': {0: 'batch_size'},
+        },
+    )
+    model.to(device)
+    print(f'[!] export the {method} encoder into {path}')
+
+
+def quantize_onnx(path, quantized_path):
+    '''dynamic int8 quantization of the weights (the activations are quantized on the fly)'''
+    check_onnxruntime()
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    print(f'[!] quantize {path} into {quantized_path}')
+
+
+class ONNXEncoder:
+
+    def __init__(self, path, num_threads=0):
+        check_onnxruntime()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.path = path
+        print(f'[!] load the onnx encoder from {path}')
+
+    def __call__(self, ids, ids_mask):
+        '''ids, ids_mask: [B, S] tensors or arrays; return the [B, E] float32 array'''
+        if torch.is_tensor(ids):
+            ids, ids_mask = ids.cpu().numpy(), ids_mask.cpu().numpy()
+        return self.session.run(
+            ['embd'],
+            {'ids': ids.astype(np.int64), 'ids_mask': ids_mask.astype(np.int64)}
+        )[0]
+
+
+def onnx_encoder_path(args, encoder='ctx', quantize=False):
+    '''ckpt/<dataset>/<model>/best_<pretrained_model>_<version>_<ctx/cand>[.int8].onnx'''
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    suffix = '.int8.onnx' if quantize else '.onnx'
+    return f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}_{encoder}{suffix}'
@@ -0,0 +1,72 @@
+from .header import *
+
+'''batched rerank metrics on device, same results as calculate_candidates_ranking + logits_recall_at_k/logits_mrr/precision_at_one/mean_average_precision'''
+
+
+class RerankMetric:
+
+    '''accumulate the score and label tensors of the test sessions (each session has candidate_num candidates),
+    and compute the R10@k, MRR, P@1 and MAP in one batched tensor operation.
+
+    multi_positive: for the datasets that have multiple or no positive candidates (douban, restoration-200k),
+    the sessions without positive candidates are not counted, and P@1 and MAP are reported'''
+
+    def __init__(self, candidate_num=10, k_list=[1, 2, 5, 10], multi_positive=False):
+        self.candidate_num = candidate_num
+        self.k_list = k_list
+        self.multi_positive = multi_positive
+        self.scores, self.labels = [], []
+
+    def add(self, scores, labels):
+        '''scores, labels: [B*candidate_num] or [B, candidate_num], the tensors stay on their device'''
+        if not torch.is_tensor(scores):
+            scores = torch.tensor(scores)
+        if not torch.is_tensor(labels):
+            labels = torch.tensor(labels)
+        self.scores.append(scores.detach().float().reshape(-1, self.candidate_num))
+        self.labels.append(labels.detach().to(self.scores[-1].device).reshape(-1, self.candidate_num))
+
+    def stable_argsort(self, scores):
+        '''descending order that keeps the original order of the candidates with the same score,
+        torch.sort(..., stable=True) needs torch>=1.9: the position of the candidate i is the number of the candidates
+        with the larger scores plus the number of the candidates before i with the same score'''
+        s_i, s_j = scores.unsqueeze(2), scores.unsqueeze(1)    # [S, C, 1], [S, 1, C]
+        before = torch.ones(self.candidate_num, self.candidate_num, dtype=torch.bool, device=scores.device).tril(-1)
+        position = ((s_j > s_i) | ((s_j == s_i) & before)).sum(dim=-1)    # [S, C], a permutation of 0..C-1
+        return position.argsort(dim=-1)
+
+    @torch.no_grad()
+    def compute(self):
+        scores = torch.cat(self.scores)    # [S, C]
+        labels = torch.cat(self.labels)    # [S, C]
+        index = self.stable_argsort(scores)
+        sorted_labels = (labels.gather(-1, index) == 1).float()    # [S, C]
+        pos_num = sorted_labels.sum(dim=-1)    # [S]
+        has_pos = pos_num > 0
+        safe_pos_num = pos_num.clamp(min=1)
+        rank = torch.arange(1, self.candidate_num + 1, device=scores.device).float()
+
+        cum_pos = sorted_labels.cumsum(dim=-1)    # [S, C]
+        recall = [cum_pos[:, min(k, self.candidate_num) - 1] / safe_pos_num for k in self.k_list]
+        first_pos = (sorted_labels * rank).masked_fill(sorted_labels == 0, float('inf')).min(dim=-1)[0]
+        mrr = torch.where(has_pos, 1. / first_pos, torch.zeros_like(first_pos))
+        p_1 = sorted_labels[:, 0]
+        ap = (cum_pos / rank * sorted_labels).sum(dim=-1) / safe_pos_num
+
+        if self.multi_positive:
+            total_examples = has_pos.sum().item()
+            total_prec_at_one, total_map = p_1.sum().item(), ap.sum().item()
+        else:
+            total_examples = len(scores)
+            total_prec_at_one, total_map = 0, 0
+        total_examples = max(total_examples, 1)
+        rest = {}
+        for k, r in zip(self.k_list[:3], recall[:3]):
+            rest[f'R10@{k}'] = round(r.sum().item() / total_examples * 100, 2)
+        rest['MRR'] = round(100 * mrr.sum().item() / total_examples, 2)
+        rest['P@1'] = round(100 * total_prec_at_one / total_examples, 2)
+        rest['MAP'] = round(100 * total_map / total_examples, 2)
+        return rest
+
+    def reset(self):
+        self.scores, self.labels = [], []
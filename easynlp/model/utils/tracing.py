@@ -0,0 +1,228 @@
+from .header import *
+from contextlib import contextmanager
+import threading
+import bisect
+import queue
+import atexit
+import uuid
+
+'''per-request tracing and the prometheus metrics of the deploy agents:
+1. TRACER.request opens the trace of one request (thread-local), TRACER.span (trace_span) records the time cost of one stage;
+2. the time cost of the requests and the stages are aggregated into the histograms of METRICS, rendered in the prometheus text format;
+3. the traces are sampled by sample_rate and written into the json lines file by the background JsonLinesWriter'''
+
+
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum, self.count = 0., 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines, cumulative = [], 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labels, le=bucket)} {cumulative}')
+        lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {self.count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if len(labels) == 0:
+        return ''
+    string = ','.join([f'{key}="{value}"' for key, value in labels])
+    return '{' + string + '}'
+
+
+class MetricsRegistry:
+
+    '''thread-safe counters and histograms, the labels are the dict of strings'''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters, self.histograms = OrderedDict(), OrderedDict()
+
+    def inc(self, name, labels=None, value=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            counter = self.counters.setdefault(name, OrderedDict())
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            histogram = self.histograms.setdefault(name, OrderedDict())
+            if key not in histogram:
+                histogram[key] = Histogram(self.buckets)
+            histogram[key].observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, counter in self.counters.items():
+                lines.append(f'# TYPE {name} counter')
+                for key, value in counter.items():
+                    lines.append(f'{name}{format_labels(key)} {value}')
+            for name, histogram in self.histograms.items():
+                lines.append(f'# TYPE {name} histogram')
+                for key, h in histogram.items():
+                    lines.extend(h.render(name, key))
+        return '\n'.join(lines) + '\n'
+
+
+def redact(record, fields):
+    '''copy of the record without the fields (any depth), the original record is not changed'''
+    if type(record) == dict:
+        return {key: redact(value, fields) for key, value in record.items() if key not in fields}
+    elif type(record) in [list, tuple]:
+        return [redact(value, fields) for value in record]
+    return record
+
+
+class JsonLinesWriter:
+
+    '''non-blocking json lines writer: the records are sampled and redacted in the request thread, and the redacted copies
+    (without the large fields, e.g., the embeddings) are handed over to the background thread by the bounded queue,
+    the records are dropped (counted in METRICS) instead of blocking the request thread when the queue is full'''
+
+    def __init__(self, path, name, queue_size=10000, sample_rate=1., redact_fields=[]):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.redact_fields = set(redact_fields)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.file = open(path, 'a')
+        self.thread = threading.Thread(target=self.run, name=f'{name}-log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def push(self, record):
+        if self.sample_rate < 1. and random.random() >= self.sample_rate:
+            METRICS.inc('easynlp_log_records_total', {'api': self.name, 'status': 'sampled_out'})
+            return
+        if self.queue.full():
+            METRICS.inc('easynlp_log_records_total', {'api': self.name, 'status': 'dropped'})
+            return
+        if self.redact_fields:
+            record = redact(record, self.redact_fields)
+        try:
+            self.queue.put_nowait((time.strftime('%Y-%m-%d %H:%M:%S'), record))
+        except queue.Full:
+            METRICS.inc('easynlp_log_records_total', {'api': self.name, 'status': 'dropped'})
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, record = item
+            try:
+                string = json.dumps({'time': timestamp, 'record': record}, ensure_ascii=False, separators=(',', ':'), default=str)
+                self.file.write(f'{string}\n')
+                METRICS.inc('easynlp_log_records_total', {'api': self.name, 'status': 'written'})
+            except Exception as error:
+                print(f'[!] {self.name} log writer error: {error}')
+                METRICS.inc('easynlp_log_records_total', {'api': self.name, 'status': 'error'})
+            if self.queue.empty():
+                self.file.flush()
+        self.file.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class Tracer:
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.local = threading.local()
+        self.sample_rate, self.cuda_sync, self.writer = 0., False, None
+
+    def configure(self, sample_rate=0., path=None, cuda_sync=False, queue_size=10000):
+        '''cuda_sync: synchronize the cuda stream at the boundaries of the spans,
+        otherwise the time cost of the asynchronous kernels is counted in the next blocking stage (device_to_host)'''
+        self.sample_rate, self.cuda_sync = sample_rate, cuda_sync
+        if path and sample_rate > 0 and self.writer is None:
+            self.writer = JsonLinesWriter(path, 'trace', queue_size=queue_size)
+            print(f'[!] sample {sample_rate} of the traces into {path}')
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    def request_id(self):
+        trace = self.current()
+        return trace['request_id'] if trace else None
+
+    def annotate(self, **kwargs):
+        trace = self.current()
+        if trace is not None:
+            trace.update(kwargs)
+
+    @contextmanager
+    def request(self, api_name, request_id=None):
+        trace = {
+            'request_id': request_id if request_id else uuid.uuid4().hex,
+            'api': api_name,
+            'timestamp': time.time(),
+            'status': 'succ',
+            'spans': [],
+        }
+        self.local.trace = trace
+        trace['begin'] = time.perf_counter()
+        try:
+            yield trace
+        except Exception:
+            trace['status'] = 'error'
+            raise
+        finally:
+            self.local.trace = None
+            trace['duration'] = time.perf_counter() - trace.pop('begin')
+            self.metrics.observe('easynlp_request_duration_seconds', trace['duration'], {'api': api_name})
+            self.metrics.inc('easynlp_requests_total', {'api': api_name, 'status': trace['status']})
+            if self.writer is not None and random.random() < self.sample_rate:
+                self.writer.push(trace)
+
+    @contextmanager
+    def span(self, name):
+        trace = self.current()
+        if trace is None:
+            # not in the deploy request, no overhead
+            yield
+            return
+        self.synchronize()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            duration = time.perf_counter() - begin
+            trace['spans'].append({'name': name, 'offset': begin - trace['begin'], 'duration': duration})
+            self.metrics.observe('easynlp_stage_duration_seconds', duration, {'api': trace['api'], 'stage': name})
+
+    def synchronize(self):
+        if self.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+
+METRICS = MetricsRegistry()
+TRACER = Tracer(METRICS)
+
+
+def trace_span(name):
+    return TRACER.span(name)
@@ -501,36 +501,23 @@ class PageRank:
         self.graph = graph
 
     def iter(self):
-        # init
-        raw_g = [[0 for _ in range(self.n)] for _ in range(self.n)]
-        for i, j in self.graph:
-            raw_g[i][j] = 1
-        adj = np.full([self.n, self.n], raw_g, dtype=float)
-        # normalization
-        for i in range(self.n):
-            if adj[i].sum() > 0:
-                adj[i] /= adj[i].sum()
-
-        pr = np.full([1, self.n], self.init_num, dtype=float)
-        jump = np.full(
-            [2, 1], 
-            [
-                [self.alpha], 
-                [1-self.alpha]
-            ], 
-            dtype=float
-        )
+        # sparse adjacency matrix, duplicated edges are merged
+        if len(self.graph) > 0:
+            edges = np.unique(np.array(self.graph, dtype=np.int64).reshape(-1, 2), axis=0)
+            rows, cols = edges[:, 0], edges[:, 1]
+        else:
+            rows, cols = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # row normalization by the out degree
+        degree = np.bincount(rows, minlength=self.n).astype(float)
+        data = 1. / degree[rows]
+        adj = sp.csr_matrix((data, (rows, cols)), shape=(self.n, self.n))
+        adj_t = adj.transpose().tocsr()
+
+        pr = np.full(self.n, self.init_num, dtype=float)
         for _ in range(self.iter_num):
-            pr = np.dot(pr, adj)    # [1, n]
-            
-            pr_jump = np.full([self.n, 2], [[0, 1/self.n]])
-            pr_jump[:, :-1] = pr.transpose()
-
-            pr = np.dot(pr_jump, jump)    # [n, 1]
-
-            pr = pr.transpose()    # [1, n]
+            pr = self.alpha * adj_t.dot(pr) + (1 - self.alpha) / self.n    # [n]
             pr = pr / pr.sum()
-        return pr.squeeze()    # [n]
+        return pr    # [n]
 
 
 # ========== Topo Sort ========= #
@@ -714,6 +701,26 @@ def distributed_collect_encoder_hidden_states(rep, max_size=256):
     reps = torch.cat(reps, dim=0)
     return reps
 
+class RandContext:
+
+    '''capture the cpu and cuda random states before the forward, and replay them (with RandContext(): ...)
+    to reproduce the same dropout masks when the forward is recomputed, e.g., the gradient cache'''
+
+    def __init__(self):
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_state = torch.cuda.get_rng_state()
+        self.fork = None
+
+    def __enter__(self):
+        self.fork = torch.random.fork_rng(devices=[torch.cuda.current_device()])
+        self.fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        torch.cuda.set_rng_state(self.cuda_state)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fork.__exit__(exc_type, exc_value, traceback)
+        self.fork = None
+
 # FGM
 class FGM:
 
@@ -0,0 +1,179 @@
+from header import *
+from config import *
+from multiprocessing import Pool
+from itertools import islice
+import ast
+import glob
+
+'''offline pretokenization of the super-large gpt2 corpus into the binary token shards (GPT2PretokenizedShardDataset):
+1. each line (or the multi-line record of --multiline, e.g., arxiv) is parsed as the json/python dict, and the text of --field is
+   tokenized by the workers, the documents are concatenated with the eos token;
+2. the tokens are appended into the raw shard files (shard_00000.bin, ...) of the fixed dtype (uint16 if the vocabulary fits),
+   each shard has at most --shard_tokens tokens;
+3. index.json (dtype, eos, shards and their number of tokens) is written at last, the shards without the index are not used
+
+    python pretokenize.py --dataset chinese_pretrain --model gpt2-contrastive-search --mode train --inputs '/path/train.txt0*'
+'''
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(description='pretokenize parameters')
+    parser.add_argument('--dataset', default='chinese_pretrain', type=str)
+    parser.add_argument('--model', default='gpt2-contrastive-search', type=str)
+    parser.add_argument('--mode', default='train', type=str, help='train/test')
+    parser.add_argument('--inputs', type=str, help='comma separated files or glob patterns of the raw corpus')
+    parser.add_argument('--output_dir', default=None, type=str, help='default: <root_dir>/data/<dataset>/pretokenized/<mode>')
+    parser.add_argument('--field', default='content', type=str, help='content for the chinese corpus, contents for arxiv')
+    parser.add_argument('--multiline', action='store_true', help='the record may be split into multiple lines')
+    parser.add_argument('--shard_tokens', default=2**30, type=int)
+    parser.add_argument('--workers', default=16, type=int)
+    parser.add_argument('--chunk_size', default=1024, type=int, help='records of each task of the workers')
+    return parser.parse_args()
+
+
+def parse_record(text):
+    '''json first, the python literal (the corpus written by str(dict)) as the fallback, never eval'''
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def iter_records(path, multiline=False, max_try=5):
+    with open(path, encoding='utf-8') as f:
+        if not multiline:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+            return
+        # concatenate the lines until the record is parsed, the broken record is dropped after max_try lines
+        cache, try_num = '', 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            cache += line
+            try:
+                parse_record(cache)
+            except (ValueError, SyntaxError):
+                try_num += 1
+                if try_num > max_try:
+                    cache, try_num = '', 0
+                continue
+            yield cache
+            cache, try_num = '', 0
+
+
+def chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def eos_token_id(vocab):
+    '''the chinese gpt2 (bert tokenizer) ends the document by [SEP]'''
+    return vocab.eos_token_id if vocab.eos_token_id is not None else vocab.sep_token_id
+
+
+tokenizer, eos, field = None, None, None
+
+def init_worker(tokenizer_path, field_name):
+    global tokenizer, eos, field
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True)
+    eos = eos_token_id(tokenizer)
+    field = field_name
+
+
+def encode_chunk(records):
+    '''return the int64 tokens of the documents (ended by eos) and the number of the documents'''
+    tokens, num = [], 0
+    for record in records:
+        try:
+            text = parse_record(record)[field]
+        except (ValueError, SyntaxError, KeyError, TypeError):
+            continue
+        ids = tokenizer.encode(text.replace('\n', ' '), add_special_tokens=False)
+        if ids:
+            tokens.extend(ids)
+            tokens.append(eos)
+            num += 1
+    return np.array(tokens, dtype=np.int64), num
+
+
+class ShardWriter:
+
+    def __init__(self, output_dir, dtype, shard_tokens):
+        self.output_dir = output_dir
+        self.dtype = dtype
+        self.shard_tokens = shard_tokens
+        self.shards = []
+        self.handler = None
+
+    def open_shard(self):
+        name = f'shard_{len(self.shards):05d}.bin'
+        self.handler = open(f'{self.output_dir}/{name}', 'wb')
+        self.shards.append({'path': name, 'tokens': 0, 'documents': 0})
+
+    def write(self, tokens, documents):
+        if len(tokens) == 0:
+            return
+        while len(tokens) > 0:
+            if self.handler is None or self.shards[-1]['tokens'] >= self.shard_tokens:
+                self.close()
+                self.open_shard()
+            shard = self.shards[-1]
+            piece = tokens[:self.shard_tokens - shard['tokens']]
+            self.handler.write(piece.astype(self.dtype).tobytes())
+            shard['tokens'] += len(piece)
+            tokens = tokens[len(piece):]
+        self.shards[-1]['documents'] += documents
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+            self.handler = None
+
+
+def main(**args):
+    config = load_config(args)
+    args.update(config)
+    output_dir = args['output_dir'] if args['output_dir'] else f'{args["root_dir"]}/data/{args["dataset"]}/pretokenized/{args["mode"]}'
+    os.makedirs(output_dir, exist_ok=True)
+    paths = sorted(chain(*[glob.glob(pattern) for pattern in args['inputs'].split(',')]))
+    if len(paths) == 0:
+        raise Exception(f'[!] no input files match {args["inputs"]}')
+
+    vocab = AutoTokenizer.from_pretrained(args['tokenizer'], use_fast=True)
+    dtype = 'uint16' if len(vocab) <= np.iinfo(np.uint16).max + 1 else 'int32'
+    writer = ShardWriter(output_dir, dtype, args['shard_tokens'])
+    begin = time.time()
+    with Pool(args['workers'], initializer=init_worker, initargs=(args['tokenizer'], args['field'])) as pool:
+        for path in paths:
+            records = chunks(iter_records(path, multiline=args['multiline']), args['chunk_size'])
+            pbar = tqdm(pool.imap(encode_chunk, records))
+            for tokens, num in pbar:
+                writer.write(tokens, num)
+                pbar.set_description(f'[!] {path}: {sum(s["tokens"] for s in writer.shards)} tokens')
+    writer.close()
+
+    index = {
+        'dtype': dtype,
+        'eos': eos_token_id(vocab),
+        'tokenizer': args['tokenizer'],
+        'inputs': paths,
+        'tokens': sum(s['tokens'] for s in writer.shards),
+        'documents': sum(s['documents'] for s in writer.shards),
+        'shards': writer.shards,
+    }
+    with open(f'{output_dir}/index.json.tmp', 'w') as f:
+        json.dump(index, f, ensure_ascii=False, indent=4)
+    os.replace(f'{output_dir}/index.json.tmp', f'{output_dir}/index.json')
+    print(f'[!] save {index["tokens"]} tokens of {index["documents"]} documents into {len(writer.shards)} shards of {output_dir}, {round(time.time() - begin, 2)}s')
+
+
+if __name__ == '__main__':
+    args = vars(parser_args())
+    main(**args)
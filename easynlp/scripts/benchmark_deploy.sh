@@ -0,0 +1,23 @@
+#!/bin/bash
+
+# mode: inprocess (flask test client) or http (the service deployed by deploy.sh)
+# rate: requests per second, 0 means closed-loop
+mode=$1
+dataset=$2
+concurrency=$3
+rate=$4
+# cpu-only: tiny randomly initialized bert and the synthetic faiss index (config/synthetic.yaml)
+CUDA_VISIBLE_DEVICES="" python benchmark_deploy.py \
+    --mode $mode \
+    --apis recall,rerank,pipeline \
+    --dataset $dataset \
+    --size 200 \
+    --warmup 10 \
+    --block_size 4 \
+    --topk 10 \
+    --concurrency $concurrency \
+    --rate $rate \
+    --port 23331 \
+    --num_threads 4 \
+    --seed 0 \
+    --synthetic
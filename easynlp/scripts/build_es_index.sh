@@ -1,8 +1,13 @@
 #!/bin/bash
 
+# ./scripts/build_es_index.sh <dataset> <recall_mode> [--resume]
 dataset=$1
 recall_mode=$2
 python -m es.init \
     --dataset $dataset \
     --recall_mode $recall_mode \
-    --maximum_sentence_num 1000000
+    --maximum_sentence_num 1000000 \
+    --bulk_threads 4 \
+    --bulk_chunk_size 5000 \
+    --max_retries 5 \
+    ${@:3}
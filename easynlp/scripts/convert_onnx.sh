@@ -6,10 +6,13 @@ model=$2
 cuda=$3 
 # ========== metadata ========== #
 
-root_dir=$(cat config/base.yaml | shyaml get-value root_dir)
-version=$(cat config/base.yaml | shyaml get-value version)
-
-gpu_ids=(${cuda//,/ })
+# export the context and candidate encoders of the dual-encoder into onnx (and int8) models,
+# and report the parity and the latency of the torch and onnx backends
+# set cuda as "" to compare the latency on cpu
 CUDA_VISIBLE_DEVICES=$cuda python convert_to_onnx.py \
     --dataset $dataset \
-    --model $model
+    --model $model \
+    --quantize \
+    --parity_size 512 \
+    --bsz 32 \
+    --num_threads 4
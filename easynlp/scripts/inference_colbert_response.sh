@@ -0,0 +1,16 @@
+#!/bin/bash
+export NCCL_IB_DISABLE=1
+
+# ./scripts/inference_colbert_response.sh <dataset> <colbert/colbertv2> <cuda_ids>
+dataset=$1
+model=$2
+cuda=$3
+
+gpu_ids=(${cuda//,/ })
+CUDA_VISIBLE_DEVICES=$cuda python -m torch.distributed.launch --nproc_per_node=${#gpu_ids[@]} --master_addr 127.0.0.1 --master_port 28205 inference.py \
+    --dataset $dataset \
+    --model $model \
+    --nums ${#gpu_ids[@]} \
+    --work_mode colbert-response \
+    --cut_size 500000 \
+    --pool_size 256
@@ -1,5 +1,6 @@
 #!/bin/bash
 
+# extra arguments after <dataset> <model> <cuda>, e.g., --sharded_index
 dataset=$1
 model=$2
 cuda=$3
@@ -12,4 +13,5 @@ CUDA_VISIBLE_DEVICES=$cuda python -m torch.distributed.launch --nproc_per_node=$
     --work_mode gray \
     --cut_size 500000 \
     --gray_topk 20 \
-    --gray_start 1024
+    --gray_start 1024 \
+    ${@:4}
@@ -1,6 +1,7 @@
 #!/bin/bash
 export NCCL_IB_DISABLE=1
 
+# extra arguments after <dataset> <model> <cuda>, e.g., --sharded_index
 dataset=$1
 model=$2
 cuda=$3
@@ -12,4 +13,5 @@ CUDA_VISIBLE_DEVICES=$cuda python -m torch.distributed.launch --nproc_per_node=$
     --nums ${#gpu_ids[@]} \
     --work_mode response \
     --cut_size 500000 \
-    --pool_size 256
+    --pool_size 256 \
+    ${@:4}
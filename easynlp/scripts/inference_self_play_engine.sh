@@ -0,0 +1,19 @@
+#!/bin/bash
+export NCCL_IB_DISABLE=1
+
+# ./scripts/inference_self_play_engine.sh <dataset> <model> <cuda_ids>
+# each gpu plays its own shard of the sessions, make sure the faiss index of the model has been built (work_mode=response)
+dataset=$1
+model=$2
+cuda=$3
+
+gpu_ids=(${cuda//,/ })
+CUDA_VISIBLE_DEVICES=$cuda python -m torch.distributed.launch --nproc_per_node=${#gpu_ids[@]} --master_addr 127.0.0.1 --master_port 28207 inference.py \
+    --dataset $dataset \
+    --model $model \
+    --nums ${#gpu_ids[@]} \
+    --work_mode self-play-engine \
+    --gen_dataset_num 500000 \
+    --gen_dataset_ctx_length 5 \
+    --gen_dataset_topk 5 \
+    --self_play_session_num 1024
@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# ./scripts/pretokenize.sh <dataset> <mode> <inputs> [--multiline --field contents]
+# inputs: comma separated files or glob patterns (quoted) of the raw corpus
+dataset=$1
+mode=$2
+inputs=$3
+python pretokenize.py \
+    --dataset $dataset \
+    --model gpt2-contrastive-search \
+    --mode $mode \
+    --inputs "$inputs" \
+    --shard_tokens 1073741824 \
+    --workers 16 \
+    ${@:4}
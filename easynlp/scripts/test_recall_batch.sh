@@ -0,0 +1,21 @@
+#!/bin/bash
+
+# ========== metadata ========== #
+dataset=$1
+model=$2
+cuda=$3 
+# ========== metadata ========== #
+
+# batched recall benchmark: Top-1/5/20/100/500/1000 curve in one multi-query search
+# add --skip_ppl and --skip_relevance to skip the gpt2 ppl and dual-bert relevance stages
+CUDA_VISIBLE_DEVICES=$cuda python test.py \
+    --dataset $dataset \
+    --model $model \
+    --multi_gpu $cuda \
+    --mode recall_batch \
+    --recall_mode q-r \
+    --recall_topk 20 \
+    --recall_bsz 256 \
+    --recall_k_list 1,5,20,100,500,1000 \
+    --skip_ppl \
+    --skip_relevance
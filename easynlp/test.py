@@ -28,6 +28,10 @@ def parser_args():
     parser.add_argument('--no-log', action='store_false', dest='log')
     parser.add_argument('--candidate_size', type=int, default=100)
     parser.add_argument('--recall_topk', type=int, default=20)
+    parser.add_argument('--recall_bsz', type=int, default=256)
+    parser.add_argument('--recall_k_list', type=str, default='1,5,20,100,500,1000')
+    parser.add_argument('--skip_ppl', action='store_true', dest='skip_ppl')
+    parser.add_argument('--skip_relevance', action='store_true', dest='skip_relevance')
     return parser.parse_args()
 
 def prepare_self_play_test_inference(**args):
@@ -114,26 +118,8 @@ def prepare_self_play_inference(**args):
     return test_iter, (agent, partner_agent), (searcher, partner_searcher)
 
 
-def prepare_inference(**args):
-    '''prepare the dataloader and the faiss index for recall test'''
-    # use test mode args load test dataset and model
-    inf_args = deepcopy(args)
-    args['mode'] = 'test'
-    config = load_config(args)
-    args.update(config)
-    agent = load_model(args)
-    # print('test', args)
-    
-    random.seed(args['seed'])
-    torch.manual_seed(args['seed'])
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed_all(args['seed'])
-    
-    pretrained_model_name = args['pretrained_model'].replace('/', '_')
-    save_path = f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt'
-    agent.load_model(save_path)
-
-    # ========== load the relevane evaluation model (dual-bert) ========== #
+def load_relevance_agent(args):
+    '''the relevance evaluation model (dual-bert)'''
     inf_args_relevance = deepcopy(args)
     inf_args_relevance['mode'] = 'test'
     inf_args_relevance['model'] = 'dual-bert'
@@ -144,8 +130,10 @@ def prepare_inference(**args):
     save_path = f'{inf_args_relevance["root_dir"]}/ckpt/{inf_args_relevance["dataset"]}/{inf_args_relevance["model"]}/best_{pretrained_model_name}_{inf_args_relevance["version"]}.pt'
     relevance_agent.load_model(save_path)
     print(f'[!] build the relevance evaluation model over')
+    return relevance_agent
 
-    # ========== load the ppl evaluation model (gpt2) ========== #
+def load_ppl_agent(args):
+    '''the ppl evaluation model (gpt2)'''
     inf_args_ppl = deepcopy(args)
     inf_args_ppl['mode'] = 'test'
     inf_args_ppl['model'] = 'gpt2-original'
@@ -156,6 +144,35 @@ def prepare_inference(**args):
     save_path = f'{inf_args_ppl["root_dir"]}/ckpt/{inf_args_ppl["dataset"]}/{inf_args_ppl["model"]}/best_{pretrained_model_name}_{inf_args_ppl["version"]}.pt'
     ppl_agent.load_model(save_path)
     print(f'[!] build the ppl evaluation model over')
+    return ppl_agent
+
+def prepare_inference(load_relevance=True, load_ppl=True, **args):
+    '''prepare the dataloader and the faiss index for recall test'''
+    # use test mode args load test dataset and model
+    inf_args = deepcopy(args)
+    args['mode'] = 'test'
+    config = load_config(args)
+    args.update(config)
+    agent = load_model(args)
+    # print('test', args)
+    
+    random.seed(args['seed'])
+    torch.manual_seed(args['seed'])
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(args['seed'])
+    
+    pretrained_model_name = args['pretrained_model'].replace('/', '_')
+    save_path = f'{args["root_dir"]}/ckpt/{args["dataset"]}/{args["model"]}/best_{pretrained_model_name}_{args["version"]}.pt'
+    agent.load_model(save_path)
+
+    relevance_agent, ppl_agent = None, None
+    # ========== load the relevane evaluation model (dual-bert) ========== #
+    if load_relevance:
+        relevance_agent = load_relevance_agent(args)
+
+    # ========== load the ppl evaluation model (gpt2) ========== #
+    if load_ppl:
+        ppl_agent = load_ppl_agent(args)
 
     # ========== load the dataset ========== #
     test_data, test_iter, _ = load_dataset(args)
@@ -297,23 +314,31 @@ def main_es_recall(**args):
     )
 
     # test recall (Top-20, Top-100)
-    pbar = tqdm(test_iter)
-    counter, acc = 0, 0
-    cost_time = []
-    log_collector = []
-    ppl, relevance = [], []
-    for batch in pbar:
+    batches, contexts = [], []
+    for batch in test_iter:
         if 'ids' in batch:
             context = agent.convert_to_text(batch['ids'])
         elif 'context' in batch:
             context = batch['context']
         else:
             raise Exception(f'[!] Error during test es recall')
+        batches.append(batch)
+        contexts.append(context)
+    # the whole contexts are searched by the concurrent msearch chunks (no truncation), and the results are returned in order
+    bt = time.time()
+    results = searcher.msearch(contexts, topk=inf_args['topk'], limit=None)
+    throughput = len(contexts) / max(time.time() - bt, 1e-6)
 
+    pbar = tqdm(list(zip(batches, contexts, results)))
+    counter, acc = 0, 0
+    log_collector = []
+    ppl, relevance = [], []
+    cost_time = []
+    for batch, context, rest in pbar:
+        # the latency of the single query
         bt = time.time()
-        rest = searcher.search(context, topk=inf_args['topk'])
-        et = time.time()
-        cost_time.append(et - bt)
+        searcher.search(context, topk=inf_args['topk'])
+        cost_time.append(time.time() - bt)
         batch['candidates'] = rest
 
         gt_candidate = batch['text']
@@ -344,9 +369,11 @@ def main_es_recall(**args):
     print(f'[!] Relevance-{inf_args["topk"]}: {relevance_metric}')
     print(f'[!] PPL-{inf_args["topk"]}: {ppl_metric}')
     print(f'[!] Average Times: {avg_time} ms')
+    print(f'[!] Throughput: {round(throughput, 2)} queries/s')
     with open(f'{inf_args["root_dir"]}/rest/{inf_args["dataset"]}/{inf_args["model"]}/test_result_recall_{pretrained_model_name}.txt', 'w') as f:
         print(f'Top-{inf_args["topk"]}: {topk_metric}', file=f)
         print(f'Average Times: {avg_time} ms', file=f)
+        print(f'Throughput: {round(throughput, 2)} queries/s', file=f)
     return 
 
 def main_recall(**args):
@@ -440,6 +467,104 @@ def main_recall(**args):
                 f.write('\n')
 
 
+def encode_recall_contexts(agent, model_name, batches):
+    '''encode the contexts of the test samples in one batch'''
+    if model_name in ['dual-bert', 'hash-bert', 'lsh',  'bpr']:
+        if 'ids' in batches[0]:
+            ids = pad_sequence([batch['ids'] for batch in batches], batch_first=True, padding_value=agent.pad)
+            ids_mask = generate_mask(ids, pad_token_idx=agent.pad)
+            ids, ids_mask = to_cuda(ids, ids_mask)
+        elif 'context' in batches[0]:
+            ids, ids_mask = agent.totensor([batch['context'] for batch in batches], ctx=True)
+        else:
+            raise Exception(f'[!] process test dataset error')
+        vectors = agent.model.get_ctx(ids, ids_mask)    # [B, E]
+    else:
+        # the hierarchical context encoders have the per-sample turn_length, encode one by one
+        vectors = torch.cat([agent.model.get_ctx(batch['ids'], batch['ids_mask'], batch['turn_length']) for batch in batches])
+    try:
+        vectors = vectors.cpu().numpy()
+    except:
+        pass
+    return vectors
+
+def main_recall_batch(**args):
+    '''recall benchmark: the test contexts are encoded in large batches, one multi-query faiss search at the max k,
+    and the Top-k hit curve is computed from the id matching in one pass;
+    the ppl and relevance scorers run as separate stages on the top recall_topk candidates (--skip_ppl, --skip_relevance)'''
+    test_iter, inf_args, searcher, agent, relevance_agent, ppl_agent = prepare_inference(
+        load_relevance=not args['skip_relevance'],
+        load_ppl=not args['skip_ppl'],
+        **args
+    )
+    k_list = [int(k) for k in args['recall_k_list'].split(',')]
+    max_k = max(k_list)
+    # the ground-truth are matched by the corpus ids
+    text2ids = {}
+    for i, text in enumerate(searcher.corpus):
+        text2ids.setdefault(text, []).append(i)
+
+    # 1. batched context encoding and multi-query search
+    samples = [batch for batch in test_iter if len(batch['text']) > 0]
+    encode_time, search_time = 0, 0
+    candidate_ids, candidates = [], []
+    for idx in tqdm(range(0, len(samples), args['recall_bsz'])):
+        batches = samples[idx:idx+args['recall_bsz']]
+        bt = time.time()
+        vectors = encode_recall_contexts(agent, args['model'], batches)
+        encode_time += time.time() - bt
+
+        bt = time.time()
+        ids, rest = searcher._search_ids(vectors, topk=max_k)
+        search_time += time.time() - bt
+        candidate_ids.extend(ids)
+        candidates.extend(rest)
+
+    # 2. Top-k hit curve
+    corpus_size = len(searcher.corpus)
+    index = np.full((len(samples), max_k), -1, dtype=np.int64)
+    for i, ids in enumerate(candidate_ids):
+        index[i, :len(ids)] = ids
+    keys = np.arange(len(samples))[:, None] * corpus_size + index    # [Q, K]
+    gt_keys = [i * corpus_size + j for i, batch in enumerate(samples) for text in batch['text'] for j in text2ids.get(text, [])]
+    hit = np.isin(keys, np.array(gt_keys, dtype=np.int64)) & (index != -1)
+    first_hit = np.where(hit.any(axis=-1), hit.argmax(axis=-1), max_k)
+    curve = {k: round(float((first_hit < k).mean()), 4) for k in k_list}
+
+    # 3. relevance and ppl stages on the top recall_topk candidates
+    topk = inf_args['recall_topk']
+    relevance_metric, ppl_metric = None, None
+    if relevance_agent is not None:
+        relevance = []
+        for batch, rest in tqdm(list(zip(samples, candidates))):
+            batch['candidates'] = rest[:topk]
+            relevance.append(relevance_agent.rerank_recall_evaluation(batch))
+        relevance_metric = round(np.mean(relevance)*100, 2)
+    if ppl_agent is not None:
+        ppl = []
+        for batch, rest in tqdm(list(zip(samples, candidates))):
+            batch['candidates'] = rest[:topk]
+            ppl.append(ppl_agent.rerank(batch))
+        ppl_metric = round(np.mean(ppl), 4)
+
+    avg_encode_time = round(encode_time / len(samples) * 1000, 2)    # ms
+    avg_search_time = round(search_time / len(samples) * 1000, 2)    # ms
+    pretrained_model_name = inf_args['pretrained_model'].replace('/', '_')
+    with open(f'{inf_args["root_dir"]}/rest/{inf_args["dataset"]}/{inf_args["model"]}/test_result_recall_{pretrained_model_name}.txt', 'w') as f:
+        for k in k_list:
+            print(f'[!] Top-{k}: {curve[k]}')
+            print(f'Top-{k}: {curve[k]}', file=f)
+        if relevance_metric is not None:
+            print(f'[!] Relevance-{topk}: {relevance_metric}')
+            print(f'Relevance-{topk}: {relevance_metric}', file=f)
+        if ppl_metric is not None:
+            print(f'[!] PPL-{topk}: {ppl_metric}')
+            print(f'PPL-{topk}: {ppl_metric}', file=f)
+        print(f'[!] Average Encode Times: {avg_encode_time} ms; Average Search Times: {avg_search_time} ms')
+        print(f'Average Encode Times: {avg_encode_time} ms', file=f)
+        print(f'Average Search Times: {avg_search_time} ms', file=f)
+
+
 def main_acc_test(**args):
     args['mode'] = 'test'
     new_args = deepcopy(args)
@@ -742,6 +867,9 @@ if __name__ == "__main__":
     if args['mode'] == 'recall':
         print(f'[!] Make sure that the inference script of model({args["model"]}) on dataset({args["dataset"]}) has been done.')
         main_recall(**args)
+    elif args['mode'] == 'recall_batch':
+        print(f'[!] Make sure that the inference script of model({args["model"]}) on dataset({args["dataset"]}) has been done.')
+        main_recall_batch(**args)
     elif args['mode'] == 'es_recall':
         main_es_recall(**args)
     elif args['mode'] == 'rerank':
@@ -336,7 +336,7 @@ def test_recall_self_play(args):
             avg_times.append(rest['header']['core_time_cost_ms'])
         candidate = rest['item_list'][0]['candidates'][0]['text']
         vectors = rest['item_list'][0]['candidates'][0]['vectors']
-        vector.append(np.array(vectors[0]))
+        vector.append(np.array(vectors))
         data = json.loads(data)
         data['segment_list'][0]['str'] = f'{data["segment_list"][0]["str"]} [SEP] {candidate}'
         pbar.set_description(f'[!] time: {round(np.mean(avg_times), 2)} ms; error: {error_counter}')
@@ -84,9 +84,11 @@ def main_target_dialog(**args):
     success_num = 0
     valid_num = 0
     turn_counters = []
-    pbar = tqdm(test_iter)
-    idx = 0
-    for ctx, topic in pbar:
+    agent.load_searcher()
+
+    # collect the valid sessions
+    sessions = []
+    for ctx, topic in test_iter:
         # random select the topic and memory
         # topic, memory = select_topic_and_memory(k2m)
         try:
@@ -105,52 +107,67 @@ def main_target_dialog(**args):
             continue
         if len(memory) > agent.args['max_memory_size']:
             memory = random.sample(memory, agent.args['max_memory_size'])
-
-        agent.init(memory, topic, context_list, load_searcher=idx==0)
-        dialog, dialog_history = [], deepcopy(context_list)
-        turn_counter = 0
-        is_succ = False
-        for turn_id in tqdm(range(agent.args["max_turn_num"])):
-            candidate, dis_1 = agent.work(
-                dialog_history,
+        sessions.append((context_list, topic, memory))
+
+    # the sessions in one chunk are processed by the agent in lockstep
+    session_batch_size = agent.args.get('session_batch_size', 1)
+    pbar = tqdm(range(0, len(sessions), session_batch_size))
+    for idx in pbar:
+        chunk = sessions[idx:idx+session_batch_size]
+        states = [agent.init_session(memory, topic) for _, topic, memory in chunk]
+        dialogs = [[] for _ in chunk]
+        dialog_histories = [deepcopy(context_list) for context_list, _, _ in chunk]
+        turn_counter = [0 for _ in chunk]
+        is_succ = [False for _ in chunk]
+        for turn_id in range(agent.args["max_turn_num"]):
+            active = [i for i in range(len(chunk)) if is_succ[i] is False]
+            if len(active) == 0:
+                break
+            rest = agent.work_batch(
+                [dialog_histories[i] for i in active],
+                [states[i] for i in active],
                 context_candidate_alpha=agent.args['context_candidate_alpha'],
                 context_candidate_memory_alpha=agent.args['context_candidate_memory_alpha'],
                 candidate_memory_alpha=agent.args['candidate_memory_alpha'],
                 past_alpha=agent.args['past_alpha']
             )
-            dialog_history.append(candidate)
-            if topic in candidate:
-                dialog.append(('chatbot', candidate, dis_1))
-                success_num += 1
-                is_succ = True
-                break
-            utterance, dis_2 = agent.work_no_topic(dialog_history)
-            dialog_history.append(utterance)
-            if topic in utterance:
-                dialog.append(('human', utterance, dis_2))
-                success_num += 1
-                is_succ = True
-                break
-
-            dialog.append(('chatbot', candidate, dis_1))
-            dialog.append(('human', utterance, dis_2))
-            turn_counter += 1
-        if is_succ:
-            turn_counters.append(turn_counter)
-
-        # write the log
-        context = ' [SEP] '.join(context_list)
-        f.write(f'[Context] {context}\n')
-        f.write(f'[Topic] {topic}\n')
-        counter = 0
-        for label, u, dis in dialog:
-            f.write(f'[Distance {round(dis, 2)}] {label}: {u}\n')
-            counter += 1
-        f.write('\n')
+            human_active = []
+            for i, (candidate, dis_1) in zip(active, rest):
+                topic = chunk[i][1]
+                dialog_histories[i].append(candidate)
+                dialogs[i].append(('chatbot', candidate, dis_1))
+                if topic in candidate:
+                    success_num += 1
+                    is_succ[i] = True
+                else:
+                    human_active.append(i)
+            if len(human_active) == 0:
+                continue
+            rest = agent.work_no_topic_batch([dialog_histories[i] for i in human_active])
+            for i, (utterance, dis_2) in zip(human_active, rest):
+                topic = chunk[i][1]
+                dialog_histories[i].append(utterance)
+                dialogs[i].append(('human', utterance, dis_2))
+                if topic in utterance:
+                    success_num += 1
+                    is_succ[i] = True
+                else:
+                    turn_counter[i] += 1
+
+        for (context_list, topic, _), dialog, succ, counter_ in zip(chunk, dialogs, is_succ, turn_counter):
+            if succ:
+                turn_counters.append(counter_)
+
+            # write the log
+            context = ' [SEP] '.join(context_list)
+            f.write(f'[Context] {context}\n')
+            f.write(f'[Topic] {topic}\n')
+            for label, u, dis in dialog:
+                f.write(f'[Distance {round(dis, 2)}] {label}: {u}\n')
+            f.write('\n')
         f.flush()
 
         pbar.set_description(f'[!] success rate: {round(success_num/valid_num, 2)}; average turns: {round(np.mean(turn_counters), 2)}')
-        idx += 1
     f.close()
 
 if __name__ == "__main__":
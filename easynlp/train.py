@@ -115,6 +115,9 @@ def main(**args):
     else:
         obtain_steps_parameters(train_data, args)
         agent = load_model(args)
+        if args['model'] in ['dual-bert-ance']:
+            # the hard negatives of the train_data are refreshed in the background
+            agent.init_hard_negative_refresher(train_data)
         batch_num = 0
         for epoch_i in range(args['epoch']):
             sampler.set_epoch(epoch_i)    # shuffle for DDP
@@ -65,6 +65,9 @@ def main(**args):
     if agent.load_last_step:
         current_step = agent.load_last_step + 1
         print(f'[!] load latest step: {current_step}')
+        if hasattr(train_data, 'set_step'):
+            # the pretokenized shards continue from the samples consumed before current_step
+            train_data.set_step(current_step)
     for _ in range(100000000):
         for batch in train_iter:
             agent.train_model(